@@ -24,7 +24,14 @@
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 """
 
-import os, sys, json, logging, asyncio, time, uuid, hashlib, secrets
+import os, sys, json, logging, asyncio, time, uuid, hashlib, secrets, threading
+import mmap, struct, zlib, queue, weakref, random, re, bisect
+import http.client
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial, wraps
+from contextlib import contextmanager
+from array import array
+from itertools import accumulate, chain
 
 # Force UTF-8 for Windows console
 if sys.platform.startswith('win'):
@@ -33,10 +40,11 @@ if sys.platform.startswith('win'):
         sys.stderr.reconfigure(encoding='utf-8')
     except:
         pass
-from typing import Dict, List, Optional, Any, Tuple
-from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Any, Tuple, Callable
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit, urlencode
 from pathlib import Path
-from collections import defaultdict, deque
+from collections import defaultdict, deque, OrderedDict, namedtuple, Counter
 import statistics
 
 # Database imports
@@ -44,6 +52,7 @@ import sqlite3
 try:
     import pymysql
     import pymysql.cursors
+    from pymysql.constants import SERVER_STATUS
     HAS_MYSQL = True
 except:
     HAS_MYSQL = False
@@ -51,7 +60,7 @@ except:
 import fastapi
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, HTMLResponse
+from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, HTMLResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from fastapi.encoders import jsonable_encoder
@@ -63,10 +72,10 @@ except:
     HAS_GEMINI = False
 
 try:
-    from supabase import create_client, Client
-    HAS_SUPABASE = True
+    import numpy as np
+    HAS_NUMPY = True
 except:
-    HAS_SUPABASE = False
+    HAS_NUMPY = False
 
 # ============================================================================
 # CONFIGURATION
@@ -89,58 +98,2935 @@ MYSQL_CONFIG = {
 SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_KEY')
 SUPABASE_USER_ID = os.getenv('SUPABASE_USER_ID', "d3d21cfa-1380-423f-82a4-6fdc44e3f48e")
+SUPABASE_REST_PATH = os.getenv('SUPABASE_REST_PATH', '/rest/v1')  # PostgREST tự host: ''
+SUPABASE_POOL_SIZE = int(os.getenv('SUPABASE_POOL_SIZE', 8))  # connection keep-alive giữ lại
+SUPABASE_TIMEOUT = float(os.getenv('SUPABASE_TIMEOUT', 10.0))  # giây / request
+SUPABASE_RETRIES = int(os.getenv('SUPABASE_RETRIES', 3))
+SUPABASE_BACKOFF = float(os.getenv('SUPABASE_BACKOFF', 0.2))  # giây, nhân đôi mỗi lần retry (+ jitter)
+SUPABASE_BACKOFF_MAX = float(os.getenv('SUPABASE_BACKOFF_MAX', 5.0))
+SUPABASE_BATCH_SIZE = int(os.getenv('SUPABASE_BATCH_SIZE', 1000))  # số dòng / request bulk insert
+SUPABASE_PAGE_SIZE = int(os.getenv('SUPABASE_PAGE_SIZE', 1000))  # = max-rows mặc định của Supabase
+SUPABASE_DEFER_MAX_AGE = float(os.getenv('SUPABASE_DEFER_MAX_AGE', 2.0))  # giây giữ ai_decisions trước khi gửi lô
+SUPABASE_DEFER_MAX_ROWS = int(os.getenv('SUPABASE_DEFER_MAX_ROWS', 10000))  # số dòng tối đa giữ lại để gửi lại khi lô lỗi
+
+# Ingestion Configuration
+MAX_BATCH_READINGS = int(os.getenv('MAX_BATCH_READINGS', 10000))
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 500))
+INGEST_FLUSH_INTERVAL = float(os.getenv('INGEST_FLUSH_INTERVAL', 0.5))  # giây
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', 20000))
+INGEST_ENQUEUE_TIMEOUT = float(os.getenv('INGEST_ENQUEUE_TIMEOUT', 2.0))  # giây chờ khi hàng đợi đầy
+INGEST_STREAM_WINDOW = int(os.getenv('INGEST_STREAM_WINDOW', 5000))  # số reading tối đa chưa ghi xong / kết nối
+INGEST_MAX_LINE = int(os.getenv('INGEST_MAX_LINE', 65536))  # ký tự tối đa 1 dòng NDJSON
+SENSOR_STATE_FLUSH_INTERVAL = float(os.getenv('SENSOR_STATE_FLUSH_INTERVAL', 10.0))  # giây
+SENSOR_ONLINE_WINDOW = 300  # sensor được coi là real-time nếu cập nhật trong 5 phút
+
+# Event bus trong process (push-on-write cho /ws và agents)
+EVENT_QUEUE_SIZE = int(os.getenv('EVENT_QUEUE_SIZE', 1000))  # sự kiện tối đa chờ / subscriber
+AGENT_POLL_INTERVAL = float(os.getenv('AGENT_POLL_INTERVAL', 15.0))  # giây giữa 2 lần chạy khi không có sự kiện
+AGENT_MIN_INTERVAL = float(os.getenv('AGENT_MIN_INTERVAL', 1.0))  # giây tối thiểu giữa 2 lần chạy do sự kiện
+
+# Live dashboard (/ws): snapshot dựng lại khi có sự kiện, dùng chung cho mọi client
+WS_BROADCAST_INTERVAL = float(os.getenv('WS_BROADCAST_INTERVAL', 30.0))  # giây tối đa giữa 2 snapshot khi không có sự kiện
+WS_MIN_INTERVAL = float(os.getenv('WS_MIN_INTERVAL', 0.25))  # giây tối thiểu giữa 2 snapshot (gom sự kiện)
+WS_SEND_TIMEOUT = float(os.getenv('WS_SEND_TIMEOUT', 5.0))  # giây; client chậm hơn bị ngắt
+
+# Server-Sent Events (/api/stream) cho màn hình chỉ đọc
+SSE_QUEUE_SIZE = int(os.getenv('SSE_QUEUE_SIZE', 32))  # frame chờ / client; đầy thì gộp thành snapshot
+SSE_REPLAY_SIZE = int(os.getenv('SSE_REPLAY_SIZE', 120))  # số delta giữ lại cho Last-Event-ID
+SSE_REPLAY_GRACE = float(os.getenv('SSE_REPLAY_GRACE', 60.0))  # giây giữ nhóm sau khi client cuối rời
+SSE_HEARTBEAT = float(os.getenv('SSE_HEARTBEAT', 15.0))  # giây giữa 2 comment giữ kết nối
+SSE_RETRY = float(os.getenv('SSE_RETRY', 3.0))  # giây trình duyệt chờ trước khi kết nối lại
+
+# Cache response GET (TTL theo endpoint, 0 = tắt; LRU theo số entry)
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 512))
+CACHE_TTLS = {"rooms": 60, "devices": 15, "analytics": 30, "schedules": 60, "ai_status": 5}
+CACHE_TTLS.update(json.loads(os.getenv('CACHE_TTLS', '{}')))
+# Prefix topic event bus → tag bị bump (entry gắn tag đó hết hiệu lực ngay)
+CACHE_EVENT_TAGS = {
+    "room.": ("rooms", "devices", "schedules", "analytics"),
+    "sensor.": ("analytics",),
+    "device.": ("devices",),
+    "schedule.": ("schedules",)
+}
+
+# Nén dữ liệu khi ingest (deadband / swinging door), tolerance theo sensor_type
+INGEST_COMPRESSION = os.getenv('INGEST_COMPRESSION', '0') == '1'
+COMPRESSION_PROFILES = {
+    "temperature": {"mode": "swinging_door", "tolerance": 0.2, "max_interval": 900},
+    "humidity": {"mode": "swinging_door", "tolerance": 1.0, "max_interval": 900},
+    "power": {"mode": "swinging_door", "tolerance": 0.05, "max_interval": 300},
+    "occupancy": {"mode": "deadband", "tolerance": 0, "max_interval": 900},
+    "light": {"mode": "deadband", "tolerance": 10, "max_interval": 900}
+}
+COMPRESSION_PROFILES.update(json.loads(os.getenv('INGEST_COMPRESSION_PROFILES', '{}')))
+
+# Rollup (1 phút, 15 phút, 1 giờ, 1 ngày) cho analytics
+ROLLUP_RESOLUTIONS = (60, 900, 3600, 86400)
+ANALYTICS_TARGET_POINTS = int(os.getenv('ANALYTICS_TARGET_POINTS', 600))  # số điểm mục tiêu / chuỗi
+ADDITIVE_SENSOR_TYPES = ("power", "occupancy")  # cộng dồn giữa các sensor, các loại khác lấy trung bình
+ANALYTICS_AGGS = ("avg", "min", "max", "sum", "count")  # hàm gộp cho ?bucket=
+ANALYTICS_MAX_BUCKETS = int(os.getenv('ANALYTICS_MAX_BUCKETS', 5000))  # số bucket tối đa / response
+ROOMS_ANALYTICS_SORT = ("efficiency_score", "energy_kwh", "avg_occupancy", "avg_temperature", "max_temperature", "room_id")
+
+# Điện năng: tích phân hình thang reading power (W) → kWh theo ngày, cộng dồn room → floor → building → campus
+ENERGY_MAX_GAP = float(os.getenv('ENERGY_MAX_GAP', 900))  # khoảng trống dài hơn (giây) không được tính
+ENERGY_KEEP_DAYS = int(os.getenv('ENERGY_KEEP_DAYS', 7))  # số ngày giữ trong RAM
+ENERGY_LATE_WINDOW = float(os.getenv('ENERGY_LATE_WINDOW', 900))  # reading đến muộn tối đa (giây trước điểm cuối) vẫn được tính
+ENERGY_ROLLUP = int(os.getenv('ENERGY_ROLLUP', 900))  # rollup (giây) dùng tính kWh cho analytics, độc lập resolution hiển thị
+
+# Retention: reading cũ hơn RETENTION_DAYS được chuyển sang archive cột (1 file / sensor / ngày)
+RETENTION_DAYS = float(os.getenv('RETENTION_DAYS', 30))  # 0 = tắt
+RETENTION_INTERVAL = float(os.getenv('RETENTION_INTERVAL', 6 * 3600))  # giây giữa 2 lần chạy
+RETENTION_CHUNK = int(os.getenv('RETENTION_CHUNK', 50000))
+ARCHIVE_VALUE_SCALE = 1000  # lưu giá trị với độ chính xác 0.001
+MIGRATION_CHUNK = int(os.getenv('MIGRATION_CHUNK', 20000))  # số dòng / khối khi backfill
+
+# SQLite: phân vùng sensor_readings theo ngày/tuần (mỗi phân vùng 1 file, ATTACH khi cần)
+SQLITE_PARTITIONING = os.getenv('SQLITE_PARTITIONING', '').lower()  # '', 'day' hoặc 'week'
+SQLITE_MAX_ATTACHED = 8  # SQLite mặc định cho phép tối đa 10 database ATTACH
+
+# SQLite engine: WAL + 1 luồng ghi riêng + pool connection chỉ đọc
+SQLITE_READERS = int(os.getenv('SQLITE_READERS', 4))
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL').upper()  # NORMAL an toàn với WAL
+SQLITE_CACHE_MB = int(os.getenv('SQLITE_CACHE_MB', 64))  # page cache / connection
+SQLITE_MMAP_MB = int(os.getenv('SQLITE_MMAP_MB', 256))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+SQLITE_READER_TIMEOUT = float(os.getenv('SQLITE_READER_TIMEOUT', 30.0))  # giây chờ reader rảnh
+SQLITE_GROUP_COMMIT_MAX = int(os.getenv('SQLITE_GROUP_COMMIT_MAX', 256))  # số job tối đa / lần commit
+SQLITE_STATEMENT_CACHE = 256  # prepared statement / connection (đủ cho toàn bộ SQL_STATEMENTS)
+
+# MySQL connection pool
+MYSQL_POOL_MIN = int(os.getenv('MYSQL_POOL_MIN', 2))
+MYSQL_POOL_MAX = int(os.getenv('MYSQL_POOL_MAX', 16))
+MYSQL_POOL_TIMEOUT = float(os.getenv('MYSQL_POOL_TIMEOUT', 10.0))  # giây chờ connection rảnh
+MYSQL_POOL_IDLE_TIMEOUT = float(os.getenv('MYSQL_POOL_IDLE_TIMEOUT', 300.0))  # đóng connection rảnh quá lâu (trên mức min)
+MYSQL_POOL_CHECK_AFTER = float(os.getenv('MYSQL_POOL_CHECK_AFTER', 30.0))  # ping khi checkout nếu rảnh lâu hơn
+
+# Read replica MySQL (tùy chọn): "host[:port],..." cùng user/password/database với primary
+MYSQL_REPLICAS = [host.strip() for host in os.getenv('MYSQL_REPLICAS', '').split(',') if host.strip()]
+MYSQL_REPLICA_POOL_MAX = int(os.getenv('MYSQL_REPLICA_POOL_MAX', 8))
+REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', 5.0))  # giây; replica trễ hơn → đọc primary
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv('REPLICA_LAG_CHECK_INTERVAL', 2.0))
+REPLICA_RYW_WINDOW = float(os.getenv('REPLICA_RYW_WINDOW', 1.0))  # giây cộng thêm vào lag cho read-your-writes
+# SHOW REPLICA STATUS rỗng (instance không cấu hình replication): mặc định coi là không dùng được, '1' → coi như đồng bộ
+REPLICA_ASSUME_SYNC = os.getenv('REPLICA_ASSUME_SYNC', '0') == '1'
+# Bảng chấp nhận đọc hơi cũ (chuỗi analytics) → không ép về primary sau khi ghi
+REPLICA_STALE_OK_TABLES = set(os.getenv('REPLICA_STALE_OK_TABLES', 'sensor_readings,sensor_rollups,ai_knowledge,safety_watchdog_logs').split(','))
+
+# Async data access: executor giới hạn + (số lời gọi đồng thời, timeout giây) theo nhóm method
+DAL_MAX_WORKERS = int(os.getenv('DAL_MAX_WORKERS', 16))
+DAL_LIMITS = {
+    "ingest": (8, 15.0),
+    "control": (4, 5.0),
+    "analytics": (3, 30.0),
+    "maintenance": (1, 900.0),
+    "default": (8, 10.0)
+}
+DAL_LIMITS.update({k: tuple(v) for k, v in json.loads(os.getenv('DAL_LIMITS', '{}')).items()})
+DAL_METHOD_GROUPS = {
+    "log_sensor_reading": "ingest",
+    "log_sensor_readings_batch": "ingest",
+    "flush_sensor_state": "ingest",
+    "control_device": "control",
+    "log_ai_decision": "control",
+    "log_safety_event": "control",
+    "save_alert": "control",
+    "add_alert": "control",
+    "verify_user": "control",
+    "get_analytics_data": "analytics",
+    "get_room_analytics": "analytics",
+    "get_rooms_analytics": "analytics",
+    "smart_search": "analytics",
+    "run_retention": "maintenance",
+    "backfill_rollups": "maintenance",
+    "flush_compressor": "maintenance"
+}
 
 def find_file(filename: str) -> Path:
     local = Path(__file__).parent / filename
     return local if local.exists() else Path(filename)
 
-# Determine if running on Vercel
-# Determine if running on Vercel
-IS_VERCEL = (
-    os.environ.get('VERCEL') == '1' or 
-    os.environ.get('VERCEL_ENV') is not None or
-    os.environ.get('NOW_REGION') is not None or
-    os.path.exists('/var/task')
-)
+# Determine if running on Vercel
+# Determine if running on Vercel
+IS_VERCEL = (
+    os.environ.get('VERCEL') == '1' or 
+    os.environ.get('VERCEL_ENV') is not None or
+    os.environ.get('NOW_REGION') is not None or
+    os.path.exists('/var/task')
+)
+
+log_handlers = [logging.StreamHandler(sys.stdout)]
+if not IS_VERCEL:
+    try:
+        log_handlers.append(logging.FileHandler('ecoschool_ultimate.log', encoding='utf-8'))
+    except:
+        pass
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [%(levelname)s] %(name)s: %(message)s',
+    handlers=log_handlers
+)
+# Ensure stdout is utf-8
+if sys.platform.startswith('win'):
+    sys.stdout.reconfigure(encoding='utf-8')
+logger = logging.getLogger("EcoSchool")
+
+if ENERGY_ROLLUP not in ROLLUP_RESOLUTIONS:
+    # Không có rollup ở resolution này → kWh analytics luôn = 0; dùng resolution gần nhất
+    _energy_rollup = min(ROLLUP_RESOLUTIONS, key=lambda r: abs(r - ENERGY_ROLLUP))
+    logger.warning(f"⚠️  ENERGY_ROLLUP={ENERGY_ROLLUP} is not in ROLLUP_RESOLUTIONS {ROLLUP_RESOLUTIONS}, using {_energy_rollup}")
+    ENERGY_ROLLUP = _energy_rollup
+
+app = FastAPI(title="EcoSchool AI Ultimate", version="12.0")
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+
+# Load HTML files with absolute paths
+BASE_DIR = Path(__file__).parent
+
+def load_html(filename: str) -> str:
+    path = BASE_DIR / filename
+    if path.exists():
+        return path.read_text(encoding='utf-8')
+    logger.error(f"❌ HTML file not found: {path}")
+    return ""
+
+LOGIN_HTML = load_html("login.html")
+DASHBOARD_HTML = load_html("dashboard_ultimate.html")
+
+# Mount static files
+try:
+    app.mount("/assets", StaticFiles(directory=str(Path(__file__).parent / "assets")), name="assets")
+except:
+    pass
+
+# ============================================================================
+# 🧮 IN-MEMORY SENSOR STATE (Last-Value Cache)
+# ============================================================================
+
+def to_epoch(value) -> Optional[float]:
+    """Chuẩn hóa timestamp (datetime MySQL / REAL SQLite / ISO Supabase) về Unix epoch"""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, str):
+        # timestamptz từ PostgREST (ISO 8601)
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    return float(value)
+
+def is_finite_number(value) -> bool:
+    """Số thực hữu hạn (không nhận bool, NaN, ±inf, chuỗi)"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value == value \
+        and value not in (float('inf'), float('-inf'))
+
+BUCKET_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+AUTO_BUCKETS = (60, 120, 300, 600, 900, 1800, 3600, 7200, 10800, 21600, 43200, 86400, 172800, 604800)
+
+def parse_bucket(spec: str, hours: float) -> int:
+    """'30s' / '5m' / '1h' / '1d' / '300' / 'auto' → số giây mỗi bucket (ValueError nếu không hợp lệ)"""
+    spec = str(spec).strip().lower()
+    if spec == "auto":
+        # Bước "đẹp" nhỏ nhất giữ chuỗi quanh ANALYTICS_TARGET_POINTS điểm
+        target = hours * 3600 / ANALYTICS_TARGET_POINTS
+        return next((b for b in AUTO_BUCKETS if b >= target), AUTO_BUCKETS[-1])
+    unit = BUCKET_UNITS.get(spec[-1:])
+    try:
+        seconds = int(float(spec[:-1] if unit else spec) * (unit or 1))
+    except ValueError:
+        raise ValueError(f"invalid bucket: {spec} (e.g. 30s, 5m, 1h, 1d, auto)")
+    if seconds <= 0:
+        raise ValueError(f"invalid bucket: {spec}")
+    if hours * 3600 / seconds > ANALYTICS_MAX_BUCKETS:
+        raise ValueError(f"bucket {spec} too small for {hours}h (max {ANALYTICS_MAX_BUCKETS} buckets)")
+    return seconds
+
+def bucket_partials(partials, bucket: int, agg: str) -> Dict[int, float]:
+    """
+    Gộp các phần tổng (timestamp, sum, min, max, count) — 1 reading hoặc 1 bucket rollup — vào bucket cố định
+    → avg / sum / min / max / count luôn tính trên toàn bộ reading của mọi sensor, dù nguồn là rollup hay dữ liệu gốc
+    """
+    acc: Dict[int, List[float]] = {}
+    for ts, total, low, high, count in partials:
+        if not count:
+            continue
+        key = int(to_epoch(ts) // bucket) * bucket
+        a = acc.get(key)
+        if a is None:
+            acc[key] = [total, low, high, count]  # sum, min, max, count
+        else:
+            a[0] += total
+            if low < a[1]:
+                a[1] = low
+            if high > a[2]:
+                a[2] = high
+            a[3] += count
+    pick = {
+        "avg": lambda a: a[0] / a[3],
+        "sum": lambda a: a[0],
+        "min": lambda a: a[1],
+        "max": lambda a: a[2],
+        "count": lambda a: a[3]
+    }[agg]
+    return {key: pick(a) for key, a in acc.items()}
+
+def lttb_indices(xs: List[float], ys: List[float], max_points: int) -> List[int]:
+    """
+    Largest-Triangle-Three-Buckets: chọn max_points chỉ số giữ hình dạng chuỗi (đỉnh / đáy vẫn hiện)
+    - Giữ điểm đầu + cuối, chia phần giữa thành max_points - 2 bucket
+    - Mỗi bucket chọn điểm tạo tam giác lớn nhất với điểm đã chọn trước và trung bình bucket sau
+    """
+    n = len(xs)
+    if max_points >= n or max_points < 3:
+        return list(range(n))
+    edges = [1 + (n - 2) * i // (max_points - 2) for i in range(max_points - 1)]  # edges[-1] = n - 1
+    keep = [0]
+    a = 0
+    if HAS_NUMPY:
+        x = np.asarray(xs, dtype=float)
+        y = np.asarray(ys, dtype=float)
+        for i in range(max_points - 2):
+            lo, hi = edges[i], edges[i + 1]
+            nlo, nhi = (hi, edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+            cx, cy = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+            # Diện tích (x2) tam giác (a, điểm trong bucket, trọng tâm bucket sau) cho cả bucket 1 lần
+            area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+            a = lo + int(area.argmax())
+            keep.append(a)
+    else:
+        for i in range(max_points - 2):
+            lo, hi = edges[i], edges[i + 1]
+            nlo, nhi = (hi, edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+            cx = sum(xs[nlo:nhi]) / (nhi - nlo)
+            cy = sum(ys[nlo:nhi]) / (nhi - nlo)
+            xa, ya = xs[a], ys[a]
+            a = max(range(lo, hi), key=lambda j: abs((xa - cx) * (ys[j] - ya) - (xa - xs[j]) * (cy - ya)))
+            keep.append(a)
+    keep.append(n - 1)
+    return keep
+
+def downsample_points(points: List[Dict], max_points: Optional[int]) -> List[Dict]:
+    """LTTB cho chuỗi [{timestamp, value}] (None = giữ nguyên)"""
+    if not max_points or len(points) <= max_points:
+        return points
+    points = [p for p in points if p["value"] is not None]
+    keep = lttb_indices([to_epoch(p["timestamp"]) for p in points], [p["value"] for p in points], max_points)
+    return [points[i] for i in keep]
+
+def downsample_columns(timestamps: List[int], series: Dict[str, List], max_points: Optional[int]) -> Tuple[List[int], Dict[str, List]]:
+    """
+    LTTB cho dạng cột (timestamps[] + series{}[]): mỗi chuỗi được max_points / số chuỗi điểm,
+    trục thời gian chung = hợp các điểm được chọn → tổng số điểm ≤ max_points
+    - max_points < 3 × số chuỗi (LTTB cần ≥ 3 điểm / chuỗi) → lấy max_points bucket cách đều
+    """
+    if not max_points or len(timestamps) <= max_points:
+        return timestamps, series
+    share = max_points // max(len(series), 1)
+    if share < 3:
+        n = len(timestamps)
+        keep = sorted({(n - 1) * i // max(max_points - 1, 1) for i in range(max_points)})
+    else:
+        keep = set()
+        for values in series.values():
+            present = [i for i, v in enumerate(values) if v is not None]
+            keep.update(present[j] for j in lttb_indices([timestamps[i] for i in present], [values[i] for i in present], share))
+        keep = sorted(keep)
+    return [timestamps[i] for i in keep], {name: [values[i] for i in keep] for name, values in series.items()}
+
+def group_stats(codes: List[int], values: List[float], groups: int) -> Tuple[List[float], List[int], List[float], List[float]]:
+    """sum / count / min / max của values theo nhóm (codes[i] = nhóm 0..groups-1 của values[i])"""
+    if HAS_NUMPY:
+        c = np.asarray(codes, dtype=np.intp)
+        v = np.asarray(values, dtype=float)
+        mins = np.full(groups, np.inf)
+        maxs = np.full(groups, -np.inf)
+        np.minimum.at(mins, c, v)
+        np.maximum.at(maxs, c, v)
+        return (np.bincount(c, weights=v, minlength=groups).tolist(), np.bincount(c, minlength=groups).tolist(),
+                mins.tolist(), maxs.tolist())
+    sums, counts = [0.0] * groups, [0] * groups
+    mins, maxs = [float("inf")] * groups, [float("-inf")] * groups
+    for code, value in zip(codes, values):
+        sums[code] += value
+        counts[code] += 1
+        if value < mins[code]:
+            mins[code] = value
+        if value > maxs[code]:
+            maxs[code] = value
+    return sums, counts, mins, maxs
+
+def room_efficiency(total_energy: float, avg_occupancy: float) -> Tuple[float, List[str]]:
+    """Điểm hiệu quả năng lượng của phòng + khuyến nghị"""
+    score = round((1 - (total_energy / (avg_occupancy * 10))) * 100, 1) if avg_occupancy > 0 else 0
+    recommendations = []
+    if score < 60:
+        recommendations.append("Tiêu thụ điện cao, cần tối ưu hóa")
+    if avg_occupancy == 0 and total_energy > 0:
+        recommendations.append("Tắt thiết bị khi không có người")
+    return score, recommendations
+
+class SensorStateCache:
+    """
+    Bảng trạng thái sensor trong RAM (nguồn dữ liệu chính cho real-time):
+    - sensor → room, type, last value, last update, status
+    - Ingest cập nhật trực tiếp, bảng `sensors` được flush lazily
+    - Aggregate theo phòng và theo loại sensor cập nhật tăng dần
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sensors: Dict[str, Dict] = {}
+        self._dirty = set()
+        self.type_aggregates: Dict[str, Dict] = defaultdict(lambda: {"sum": 0.0, "count": 0})
+        self.room_aggregates: Dict[str, Dict[str, Dict]] = defaultdict(lambda: defaultdict(lambda: {"sum": 0.0, "count": 0}))
+
+    def load(self, rows: List[Tuple]):
+        """Nạp toàn bộ bảng sensors (1 query lúc khởi động, row dạng namedtuple)"""
+        with self._lock:
+            self.sensors.clear()
+            self._dirty.clear()
+            self.type_aggregates.clear()
+            self.room_aggregates.clear()
+            for row in rows:
+                entry = {
+                    "sensor_id": row.sensor_id,
+                    "room_id": row.room_id,
+                    "sensor_type": row.sensor_type,
+                    "unit": row.unit,
+                    "last_value": row.last_value or 0,
+                    "last_update": to_epoch(row.last_update),
+                    "status": row.status,
+                    "room_name": row.room_name
+                }
+                self.sensors[entry['sensor_id']] = entry
+                self._aggregate(entry, 1)
+
+    def _aggregate(self, entry: Dict, sign: int):
+        if entry['status'] != 'ONLINE':
+            return
+        value = entry['last_value'] or 0
+        for agg in (self.type_aggregates[entry['sensor_type']], self.room_aggregates[entry['room_id']][entry['sensor_type']]):
+            agg["sum"] += sign * value
+            agg["count"] += sign
+
+    def add_sensor(self, sensor_id: str, room_id: str, sensor_type: str, unit: str, room_name: Optional[str]):
+        with self._lock:
+            old = self.sensors.get(sensor_id)
+            if old:
+                self._aggregate(old, -1)
+            self.sensors[sensor_id] = {
+                "sensor_id": sensor_id,
+                "room_id": room_id,
+                "sensor_type": sensor_type,
+                "unit": unit,
+                "last_value": 0,
+                "last_update": time.time(),
+                "status": "WAITING",
+                "room_name": room_name
+            }
+
+    def remove_sensor(self, sensor_id: str):
+        with self._lock:
+            entry = self.sensors.pop(sensor_id, None)
+            if entry:
+                self._aggregate(entry, -1)
+            self._dirty.discard(sensor_id)
+
+    def remove_room(self, room_id: str):
+        with self._lock:
+            for sensor_id in [sid for sid, e in self.sensors.items() if e['room_id'] == room_id]:
+                self._aggregate(self.sensors.pop(sensor_id), -1)
+                self._dirty.discard(sensor_id)
+            self.room_aggregates.pop(room_id, None)
+
+    def has(self, sensor_id: str) -> bool:
+        return sensor_id in self.sensors
+
+    def update(self, sensor_id: str, value: float, ts: float) -> bool:
+        """Cập nhật last value (bỏ qua reading cũ hơn giá trị hiện tại)"""
+        with self._lock:
+            entry = self.sensors.get(sensor_id)
+            if entry is None:
+                return False
+            if entry['status'] == 'ONLINE' and entry['last_update'] and ts < entry['last_update']:
+                return True
+            self._aggregate(entry, -1)
+            entry['last_value'] = value
+            entry['last_update'] = ts
+            entry['status'] = 'ONLINE'
+            self._aggregate(entry, 1)
+            self._dirty.add(sensor_id)
+            return True
+
+    def take_dirty(self) -> List[Tuple[str, float, float]]:
+        """Lấy (và xóa) danh sách sensor cần flush xuống bảng sensors"""
+        with self._lock:
+            rows = [(sid, self.sensors[sid]['last_value'], self.sensors[sid]['last_update'])
+                    for sid in self._dirty if sid in self.sensors]
+            self._dirty.clear()
+            return rows
+
+    def mark_dirty(self, sensor_ids: List[str]):
+        with self._lock:
+            self._dirty.update(sid for sid in sensor_ids if sid in self.sensors)
+
+    def snapshot(self, max_age: Optional[float] = SENSOR_ONLINE_WINDOW) -> List[Dict]:
+        """Danh sách sensor ONLINE (cập nhật trong max_age giây)"""
+        cutoff = time.time() - max_age if max_age else None
+        with self._lock:
+            return [dict(e) for e in self.sensors.values()
+                    if e['status'] == 'ONLINE' and (cutoff is None or (e['last_update'] or 0) > cutoff)]
+
+    def get_aggregates(self) -> Dict:
+        """Aggregate tính sẵn theo loại sensor và theo phòng"""
+        def fmt(agg):
+            return {"sum": agg["sum"], "count": agg["count"], "avg": agg["sum"] / agg["count"] if agg["count"] else 0}
+        with self._lock:
+            return {
+                "by_type": {t: fmt(a) for t, a in self.type_aggregates.items() if a["count"]},
+                "by_room": {rid: {t: fmt(a) for t, a in types.items() if a["count"]}
+                            for rid, types in self.room_aggregates.items()}
+            }
+
+# ============================================================================
+# 🗜️ INGEST COMPRESSION (Deadband + Swinging Door)
+# ============================================================================
+
+class ReadingCompressor:
+    """
+    Nén chuỗi reading theo từng sensor trước khi ghi sensor_readings:
+    - deadband: chỉ lưu khi giá trị lệch > tolerance so với điểm đã lưu
+    - swinging_door: chỉ lưu các điểm cần để nội suy tuyến tính lại chuỗi trong tolerance
+    - max_interval: luôn lưu ít nhất 1 điểm mỗi max_interval giây
+    Reading có quality khác GOOD được lưu nguyên vẹn.
+    """
+
+    def __init__(self, profiles: Dict[str, Dict]):
+        self.profiles = profiles
+        self._lock = threading.Lock()
+        self._state: Dict[str, Dict] = {}
+        self.received: Dict[str, int] = defaultdict(int)
+        self.stored: Dict[str, int] = defaultdict(int)
+
+    def process(self, sensor_id: str, sensor_type: str, value: float, ts: float, quality: str = "GOOD") -> List[Tuple]:
+        """Trả về danh sách (sensor_id, value, ts, quality) cần lưu"""
+        point = (sensor_id, value, ts, quality)
+        profile = self.profiles.get(sensor_type)
+        with self._lock:
+            self.received[sensor_type] += 1
+            if not profile or quality != "GOOD":
+                out = [point]
+            elif profile["mode"] == "deadband":
+                out = self._deadband(profile, point)
+            else:
+                out = self._swinging_door(profile, point)
+            self.stored[sensor_type] += len(out)
+            return out
+
+    def _deadband(self, profile: Dict, point: Tuple) -> List[Tuple]:
+        sensor_id, value, ts, _ = point
+        st = self._state.get(sensor_id)
+        if (st is None or abs(value - st["value"]) > profile["tolerance"]
+                or ts - st["ts"] >= profile["max_interval"] or ts < st["ts"]):
+            self._state[sensor_id] = {"value": value, "ts": ts}
+            return [point]
+        return []
+
+    def _swinging_door(self, profile: Dict, point: Tuple) -> List[Tuple]:
+        sensor_id, value, ts, _ = point
+        tol = profile["tolerance"]
+        st = self._state.get(sensor_id)
+        if st is None or ts <= st["ts"] or (st["snapshot"] and ts <= st["snapshot"][2]):
+            self._state[sensor_id] = self._open_door(point, None)
+            return [point]
+
+        dt = ts - st["ts"]
+        up = min(st["up"], (value + tol - st["value"]) / dt)
+        low = max(st["low"], (value - tol - st["value"]) / dt)
+
+        if low > up or dt >= profile["max_interval"]:
+            snapshot = st["snapshot"]
+            if snapshot is None:
+                self._state[sensor_id] = self._open_door(point, None)
+                return [point]
+            # Cửa đóng: lưu snapshot trước đó, mở cửa mới từ snapshot tới điểm hiện tại
+            archived = self._archive_point(st)
+            self._state[sensor_id] = self._open_door(archived, point, tol)
+            return [archived]
+
+        st.update(up=up, low=low, snapshot=point)
+        return []
+
+    @staticmethod
+    def _archive_point(st: Dict) -> Tuple:
+        """Snapshot được lưu với giá trị nằm trên đường nội suy hợp lệ (lệch ≤ tolerance)"""
+        sensor_id, value, ts, quality = st["snapshot"]
+        slope = (value - st["value"]) / (ts - st["ts"])
+        slope = min(max(slope, st["low"]), st["up"])
+        return (sensor_id, st["value"] + slope * (ts - st["ts"]), ts, quality)
+
+    @staticmethod
+    def _open_door(archived: Tuple, snapshot: Optional[Tuple], tol: float = 0) -> Dict:
+        _, a_value, a_ts, _ = archived
+        st = {"value": a_value, "ts": a_ts, "snapshot": snapshot, "up": float('inf'), "low": float('-inf')}
+        if snapshot is not None:
+            _, value, ts, _ = snapshot
+            st["up"] = (value + tol - a_value) / (ts - a_ts)
+            st["low"] = (value - tol - a_value) / (ts - a_ts)
+        return st
+
+    def checkpoint(self, sensor_ids=None) -> Dict[str, Optional[Dict]]:
+        """Sao lưu state của các sensor (mặc định: tất cả) trước khi ghi; khôi phục bằng restore() nếu ghi DB thất bại"""
+        with self._lock:
+            if sensor_ids is None:
+                sensor_ids = list(self._state)
+            return {sid: dict(self._state[sid]) if sid in self._state else None for sid in set(sensor_ids)}
+
+    def restore(self, checkpoint: Dict[str, Optional[Dict]]):
+        """Trả state về checkpoint: các điểm chưa ghi được sẽ được xét lại ở lần ghi sau"""
+        with self._lock:
+            for sid, st in checkpoint.items():
+                if st is None:
+                    self._state.pop(sid, None)
+                else:
+                    self._state[sid] = st
+
+    def flush(self) -> List[Tuple]:
+        """Lấy các snapshot đang giữ (gọi khi shutdown để không mất điểm cuối)"""
+        with self._lock:
+            out = []
+            for sensor_id, st in list(self._state.items()):
+                if st.get("snapshot"):
+                    archived = self._archive_point(st)
+                    out.append(archived)
+                    self._state[sensor_id] = self._open_door(archived, None)
+            return out
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            received = sum(self.received.values())
+            stored = sum(self.stored.values())
+            return {
+                "enabled": True,
+                "received": received,
+                "stored": stored,
+                "ratio": round(received / stored, 2) if stored else 0,
+                "by_type": {t: {"received": n, "stored": self.stored[t],
+                                "ratio": round(n / self.stored[t], 2) if self.stored[t] else 0}
+                            for t, n in self.received.items()}
+            }
+
+# ============================================================================
+# 🗃️ COLUMNAR READING ARCHIVE (Retention)
+# ============================================================================
+
+class ReadingArchive:
+    """
+    Archive chỉ ghi nối (append-only) cho reading cũ:
+    - 1 segment = 1 sensor-ngày: <dir>/<sensor_id>/<YYYY-MM-DD>.seg
+    - Mỗi block: header + cột timestamp (ms) và cột value (x ARCHIVE_VALUE_SCALE),
+      delta-encode int64 rồi nén zlib
+    - Đọc qua mmap
+    """
+
+    MAGIC = b'ESA1'
+    HEADER = struct.Struct('<4sIII')  # magic, count, ts_bytes, value_bytes
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+        self._lock = threading.Lock()
+
+    def _segment_path(self, sensor_id: str, day: str) -> Path:
+        safe_id = "".join(c if c.isalnum() or c in "-_." else "_" for c in sensor_id)
+        return self.root / safe_id / f"{day}.seg"
+
+    @staticmethod
+    def _day(ts: float) -> str:
+        return datetime.fromtimestamp(ts).strftime('%Y-%m-%d')
+
+    @staticmethod
+    def _delta(values: List[int]) -> bytes:
+        prev = 0
+        out = array('q')
+        for v in values:
+            out.append(v - prev)
+            prev = v
+        return zlib.compress(out.tobytes())
+
+    @staticmethod
+    def _undelta(data) -> List[int]:
+        deltas = array('q')
+        deltas.frombytes(zlib.decompress(data))
+        return list(accumulate(deltas))
+
+    def append(self, sensor_id: str, points: List[Tuple[float, float]]) -> int:
+        """Ghi nối các điểm (ts, value) vào segment theo ngày"""
+        by_day: Dict[str, List[Tuple[float, float]]] = defaultdict(list)
+        for ts, value in points:
+            by_day[self._day(ts)].append((ts, value))
+
+        with self._lock:
+            for day, day_points in by_day.items():
+                day_points.sort()
+                ts_col = self._delta([int(round(ts * 1000)) for ts, _ in day_points])
+                val_col = self._delta([int(round(v * ARCHIVE_VALUE_SCALE)) for _, v in day_points])
+                path = self._segment_path(sensor_id, day)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with open(path, 'ab') as f:
+                    f.write(self.HEADER.pack(self.MAGIC, len(day_points), len(ts_col), len(val_col)))
+                    f.write(ts_col)
+                    f.write(val_col)
+                    f.flush()
+                    os.fsync(f.fileno())
+        return len(points)
+
+    def read_segment(self, sensor_id: str, day: str) -> List[Tuple[float, float]]:
+        path = self._segment_path(sensor_id, day)
+        if not path.exists() or path.stat().st_size == 0:
+            return []
+        points = {}
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offset = 0
+            while offset + self.HEADER.size <= len(mm):
+                magic, count, ts_len, val_len = self.HEADER.unpack_from(mm, offset)
+                if magic != self.MAGIC:
+                    logger.error(f"❌ Corrupt archive segment: {path} @ {offset}")
+                    break
+                offset += self.HEADER.size
+                ts_col = self._undelta(mm[offset:offset + ts_len])
+                offset += ts_len
+                val_col = self._undelta(mm[offset:offset + val_len])
+                offset += val_len
+                # Trùng timestamp (retention chạy lại sau lỗi) chỉ giữ 1 điểm
+                for ts_ms, v in zip(ts_col, val_col):
+                    points[ts_ms] = v
+        return [(ts_ms / 1000, v / ARCHIVE_VALUE_SCALE) for ts_ms, v in sorted(points.items())]
+
+    def query(self, sensor_ids: List[str], start: float, end: float) -> List[Dict]:
+        """Các điểm {timestamp, value} trong [start, end) của nhiều sensor, sắp theo thời gian"""
+        days = []
+        day = datetime.fromtimestamp(start).date()
+        while day <= datetime.fromtimestamp(end).date():
+            days.append(day.strftime('%Y-%m-%d'))
+            day += timedelta(days=1)
+        rows = []
+        for sensor_id in sensor_ids:
+            for d in days:
+                rows.extend({"timestamp": ts, "value": v}
+                            for ts, v in self.read_segment(sensor_id, d) if start <= ts < end)
+        rows.sort(key=lambda r: r["timestamp"])
+        return rows
+
+    def get_stats(self) -> Dict:
+        segments = list(self.root.glob('*/*.seg')) if self.root.exists() else []
+        return {
+            "path": str(self.root),
+            "segments": len(segments),
+            "bytes": sum(p.stat().st_size for p in segments)
+        }
+
+# ============================================================================
+# 🧩 SQLITE TIME PARTITIONS (ATTACH per day / week)
+# ============================================================================
+
+class SQLitePartitionManager:
+    """
+    Lưu sensor_readings thành nhiều file SQLite theo ngày/tuần:
+    - Ghi vào đúng phân vùng theo timestamp
+    - Query router chỉ ATTACH các phân vùng giao với khoảng thời gian
+    - Xóa phân vùng = DETACH + xóa file (O(1))
+    """
+
+    def __init__(self, root: str, scheme: str = "day"):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.scheme = scheme
+        self.period = 86400 if scheme == "day" else 7 * 86400
+        self._lock = threading.RLock()
+        self._attached: Dict[int, "OrderedDict[str, None]"] = {}
+        self._keys = {p.stem[len("readings_"):] for p in self.root.glob("readings_*.db")}
+        self.split_batches = 0  # lô ghi trải trên > SQLITE_MAX_ATTACHED phân vùng (không nguyên tử)
+
+    def key_for(self, ts: float) -> str:
+        day = datetime.fromtimestamp(ts).date()
+        if self.scheme == "week":
+            return "w" + (day - timedelta(days=day.weekday())).strftime('%Y%m%d')
+        return "d" + day.strftime('%Y%m%d')
+
+    def key_range(self, key: str) -> Tuple[float, float]:
+        start = datetime.strptime(key[1:], '%Y%m%d')
+        end = start + timedelta(days=7 if key[0] == "w" else 1)
+        return start.timestamp(), end.timestamp()
+
+    def path(self, key: str) -> Path:
+        return self.root / f"readings_{key}.db"
+
+    def keys(self) -> List[str]:
+        with self._lock:
+            return sorted(self._keys)
+
+    def keys_for_range(self, start: float, end: float) -> List[str]:
+        """Các phân vùng đang tồn tại giao với [start, end)"""
+        with self._lock:
+            return sorted(k for k in self._keys if self.key_range(k)[1] > start and self.key_range(k)[0] < end)
+
+    def attach(self, conn, keys: List[str], create: bool = False) -> List[str]:
+        """ATTACH các phân vùng vào connection (LRU khi vượt giới hạn), trả về alias"""
+        with self._lock:
+            attached = self._attached.setdefault(id(conn), OrderedDict())
+            needed = {f"p_{key}" for key in keys}
+            aliases = []
+            for key in keys:
+                alias = f"p_{key}"
+                if alias in attached:
+                    attached.move_to_end(alias)
+                    aliases.append(alias)
+                    continue
+                if key not in self._keys and not create:
+                    continue
+                # ATTACH/DETACH không chạy được trong transaction; không commit hộ transaction đang mở
+                if conn.in_transaction:
+                    raise RuntimeError(f"Partition {key} must be attached before the write transaction starts")
+                while len(attached) >= SQLITE_MAX_ATTACHED:
+                    victim = next((a for a in attached if a not in needed), None)
+                    if victim is None:
+                        raise RuntimeError(f"Cannot attach more than {SQLITE_MAX_ATTACHED} partitions at once")
+                    del attached[victim]
+                    conn.execute(f"DETACH DATABASE {victim}")
+                conn.execute(f"ATTACH DATABASE ? AS {alias}", (str(self.path(key)),))
+                if key not in self._keys:
+                    conn.execute(f"""CREATE TABLE IF NOT EXISTS {alias}.sensor_readings
+                                    (id INTEGER PRIMARY KEY AUTOINCREMENT, sensor_id TEXT,
+                                     value REAL, timestamp REAL, quality TEXT,
+                                     room_id TEXT, sensor_type TEXT)""")
+                    self._upgrade(conn, alias)
+                    self._keys.add(key)
+                attached[alias] = None
+                aliases.append(alias)
+            return aliases
+
+    def _upgrade(self, conn, alias: str):
+        """Phân vùng tạo trước migration 003: thêm room_id/sensor_type, backfill và tạo index phủ"""
+        conn.execute(f"PRAGMA {alias}.journal_mode = WAL")
+        columns = {row[1] for row in conn.execute(f"PRAGMA {alias}.table_info(sensor_readings)")}
+        if "room_id" not in columns:
+            conn.execute(f"ALTER TABLE {alias}.sensor_readings ADD COLUMN room_id TEXT")
+            conn.execute(f"ALTER TABLE {alias}.sensor_readings ADD COLUMN sensor_type TEXT")
+            conn.execute(f"""
+                UPDATE {alias}.sensor_readings SET
+                    room_id = (SELECT room_id FROM main.sensors s WHERE s.sensor_id = sensor_readings.sensor_id),
+                    sensor_type = (SELECT sensor_type FROM main.sensors s WHERE s.sensor_id = sensor_readings.sensor_id)
+            """)
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {alias}.idx_readings_sensor_time ON sensor_readings(sensor_id, timestamp)")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {alias}.idx_readings_type_time ON sensor_readings(sensor_type, timestamp, value)")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {alias}.idx_readings_room_type_time ON sensor_readings(room_id, sensor_type, timestamp, value)")
+        conn.commit()
+
+    def upgrade_all(self, conn):
+        """Chạy 1 lần lúc khởi động trên connection ghi: nâng cấp mọi phân vùng hiện có"""
+        for key in self.keys():
+            self._upgrade(conn, self.attach(conn, [key])[0])
+
+    def source_groups(self, conn, start: float, end: float):
+        """
+        Query router: lần lượt ATTACH các nhóm phân vùng giao với [start, end)
+        (mỗi nhóm ≤ SQLITE_MAX_ATTACHED) và trả về tên bảng cần đọc
+        """
+        keys = self.keys_for_range(start, end)
+        for i in range(0, len(keys), SQLITE_MAX_ATTACHED):
+            yield [f"{alias}.sensor_readings" for alias in self.attach(conn, keys[i:i + SQLITE_MAX_ATTACHED])]
+
+    def drop(self, key: str, connections: List) -> bool:
+        """Xóa cả phân vùng: DETACH khỏi mọi connection rồi xóa file"""
+        alias = f"p_{key}"
+        with self._lock:
+            for conn in connections:
+                attached = self._attached.get(id(conn), {})
+                if alias in attached:
+                    if conn.in_transaction:
+                        conn.commit()
+                    conn.execute(f"DETACH DATABASE {alias}")
+                    del attached[alias]
+            self._keys.discard(key)
+            path = self.path(key)
+            if path.exists():
+                path.unlink()
+                return True
+            return False
+
+    def get_stats(self) -> Dict:
+        keys = self.keys()
+        return {
+            "scheme": self.scheme,
+            "partitions": len(keys),
+            "oldest": keys[0] if keys else None,
+            "newest": keys[-1] if keys else None,
+            "split_batches": self.split_batches,
+            "bytes": sum(self.path(k).stat().st_size for k in keys if self.path(k).exists())
+        }
+
+# ============================================================================
+# ✍️ SQLITE ENGINE (WAL + WRITER THREAD + READ POOL)
+# ============================================================================
+
+class SQLiteEngine:
+    """
+    SQLite profile cho nhiều luồng đồng thời:
+    - WAL: reader không chặn writer và ngược lại
+    - 1 luồng ghi riêng sở hữu connection ghi; mỗi job ghi là 1 transaction trọn vẹn
+      (fn chạy mọi câu lệnh, lỗi → chỉ rollback phần của job đó qua SAVEPOINT)
+    - Các job liên tiếp trong hàng đợi được commit chung 1 lần (group commit)
+    - Pool connection chỉ đọc (mode=ro) phục vụ SELECT song song
+    """
+
+    def __init__(self, path: str, readers: int = SQLITE_READERS):
+        self.path = path
+        self.max_readers = max(1, readers)
+        self._jobs: "queue.Queue" = queue.Queue()
+        self._pool: "queue.LifoQueue" = queue.LifoQueue()
+        self._readers: List[sqlite3.Connection] = []
+        self._pool_lock = threading.Lock()
+        self.stats = {"writes": 0, "commits": 0, "rollbacks": 0, "reads": 0, "max_group": 0}
+        ready = Future()
+        self._thread = threading.Thread(target=self._writer_loop, args=(ready,), name="sqlite-writer", daemon=True)
+        self._thread.start()
+        ready.result()
+
+    def _configure(self, conn: sqlite3.Connection):
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA cache_size = {-SQLITE_CACHE_MB * 1024}")
+        conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_MB * 1024 * 1024}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+
+    # --- Writer ---
+
+    def _writer_loop(self, ready: Future):
+        try:
+            self.writer = sqlite3.connect(self.path, check_same_thread=False, cached_statements=SQLITE_STATEMENT_CACHE)
+            self._configure(self.writer)
+            self.journal_mode = self.writer.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+            self.writer.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+        except Exception as e:
+            ready.set_exception(e)
+            return
+        ready.set_result(True)
+        while True:
+            batch = [self._jobs.get()]
+            while len(batch) < SQLITE_GROUP_COMMIT_MAX:
+                try:
+                    batch.append(self._jobs.get_nowait())
+                except queue.Empty:
+                    break
+            done: List[Tuple[Future, Any]] = []  # job đã chạy xong, chờ commit chung
+            stop = False
+            for fn, fut, transactional, prepare in batch:
+                if fn is None:
+                    stop = True
+                elif transactional:
+                    if prepare is not None:
+                        # Bước chuẩn bị ngoài transaction (ATTACH) chạy ngay trước transaction của chính job
+                        self._commit(done)
+                        done = []
+                        try:
+                            prepare(self.writer)
+                        except BaseException as e:
+                            fut.set_exception(e)
+                            continue
+                        finally:
+                            if self.writer.in_transaction:
+                                self.writer.commit()
+                    self._run_job(fn, fut, done)
+                else:
+                    # ATTACH / DETACH / PRAGMA: commit nhóm hiện tại rồi chạy ngoài transaction
+                    self._commit(done)
+                    done = []
+                    try:
+                        fut.set_result(fn(self.writer))
+                    except BaseException as e:
+                        fut.set_exception(e)
+                    finally:
+                        if self.writer.in_transaction:
+                            self.writer.commit()
+            # Future chỉ hoàn tất khi dữ liệu đã được commit
+            self._commit(done)
+            if stop:
+                self.writer.close()
+                for fn, fut, _, _ in batch:
+                    if fn is None:
+                        fut.set_result(None)
+                return
+
+    def _run_job(self, fn, fut: Future, done: List[Tuple[Future, Any]]):
+        """1 job = 1 SAVEPOINT trong transaction của nhóm: lỗi chỉ hoàn tác câu lệnh của chính job"""
+        conn = self.writer
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        conn.execute("SAVEPOINT job")
+        try:
+            result = fn(conn)
+        except BaseException as e:
+            conn.execute("ROLLBACK TO job")
+            conn.execute("RELEASE job")
+            self.stats["rollbacks"] += 1
+            fut.set_exception(e)
+            return
+        conn.execute("RELEASE job")
+        self.stats["writes"] += 1
+        done.append((fut, result))
+
+    def _commit(self, done: List[Tuple[Future, Any]]):
+        if not done:
+            return
+        try:
+            if self.writer.in_transaction:
+                self.writer.commit()
+                self.stats["commits"] += 1
+        except BaseException as e:
+            if self.writer.in_transaction:
+                self.writer.rollback()
+            for fut, _ in done:
+                fut.set_exception(e)
+            return
+        self.stats["max_group"] = max(self.stats["max_group"], len(done))
+        for fut, result in done:
+            fut.set_result(result)
+
+    def in_writer(self) -> bool:
+        return threading.current_thread() is self._thread
+
+    def _submit(self, fn, transactional: bool = True, prepare=None):
+        fut = Future()
+        self._jobs.put((fn, fut, transactional, prepare))
+        return fut.result()
+
+    def write(self, fn, prepare=None):
+        """
+        Chạy fn(connection ghi) trên luồng ghi như 1 transaction: trả kết quả khi đã commit,
+        fn raise → mọi câu lệnh của fn bị rollback. fn không được tự commit / rollback.
+        prepare(connection): chạy ngoài transaction ngay trước fn (ATTACH phân vùng cần ghi).
+        Gọi lồng từ trong 1 job → chạy luôn trong transaction của job đó.
+        """
+        if self.in_writer():
+            return fn(self.writer)
+        return self._submit(fn, prepare=prepare)
+
+    def autocommit(self, fn):
+        """Chạy fn(connection ghi) ngoài transaction (ATTACH / DETACH / PRAGMA journal_mode)"""
+        if self.in_writer():
+            if self.writer.in_transaction:
+                raise RuntimeError("autocommit job cannot run inside a write transaction")
+            return fn(self.writer)
+        return self._submit(fn, transactional=False)
+
+    # --- Readers ---
+
+    def _open_reader(self) -> sqlite3.Connection:
+        uri = f"{Path(self.path).resolve().as_uri()}?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=SQLITE_STATEMENT_CACHE)
+        self._configure(conn)
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    @contextmanager
+    def reader(self):
+        """Mượn 1 connection chỉ đọc từ pool (tạo thêm khi chưa đủ SQLITE_READERS)"""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                conn = self._open_reader() if len(self._readers) < self.max_readers else None
+                if conn is not None:
+                    self._readers.append(conn)
+            if conn is None:
+                try:
+                    conn = self._pool.get(timeout=SQLITE_READER_TIMEOUT)
+                except queue.Empty:
+                    raise TimeoutError(f"No SQLite reader free after {SQLITE_READER_TIMEOUT:g}s "
+                                       f"({self.max_readers} readers, all borrowed)") from None
+        try:
+            self.stats["reads"] += 1
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._pool.put(conn)
+
+    @contextmanager
+    def all_readers(self):
+        """
+        Giữ toàn bộ reader (chờ reader đang bận trả về) — dùng khi DETACH phân vùng
+        Chờ ngoài _pool_lock: luồng đang giữ 1 reader và cần thêm reader vẫn mở được connection mới
+        """
+        held = []
+        deadline = time.monotonic() + SQLITE_READER_TIMEOUT
+        while True:
+            # Đếm lại mỗi vòng: pool có thể vừa mở thêm reader trong lúc chờ
+            with self._pool_lock:
+                count = len(self._readers)
+            if len(held) >= count:
+                break
+            try:
+                held.append(self._pool.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                for conn in held:
+                    self._pool.put(conn)
+                raise TimeoutError(f"Could not hold all {count} SQLite readers within {SQLITE_READER_TIMEOUT:g}s "
+                                   f"({len(held)} returned)") from None
+        try:
+            yield held
+        finally:
+            for conn in held:
+                self._pool.put(conn)
+
+    def close(self):
+        self._submit(None)
+        with self._pool_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers = []
+
+    def get_stats(self) -> Dict:
+        return {
+            **self.stats,
+            "journal_mode": self.journal_mode,
+            "synchronous": SQLITE_SYNCHRONOUS,
+            "readers": len(self._readers),
+            "readers_idle": self._pool.qsize(),
+            "write_queue": self._jobs.qsize()
+        }
+
+
+class SQLiteCursorProxy:
+    """
+    Cursor giống sqlite3.Cursor: SELECT chạy trên reader pool,
+    mọi câu lệnh khác được chuyển sang luồng ghi
+    """
+
+    def __init__(self, engine: SQLiteEngine, raw: bool = False):
+        self.engine = engine
+        self.raw = raw
+        self._rows: List = []
+        self.rowcount = -1
+        self.lastrowid = None
+        self.description = None
+
+    @staticmethod
+    def _is_read(sql: str) -> bool:
+        head = sql.lstrip()[:6].upper()
+        return head.startswith("SELECT") or head.startswith("WITH")
+
+    def _run(self, cursor: sqlite3.Cursor, method: str, sql: str, params):
+        if self.raw:
+            cursor.row_factory = None
+        getattr(cursor, method)(sql, params)
+        return cursor.fetchall(), cursor.rowcount, cursor.lastrowid, cursor.description
+
+    def _execute(self, method: str, sql: str, params):
+        # Mỗi lệnh ghi là 1 job (transaction riêng); transaction nhiều lệnh dùng engine.write(fn)
+        if self._is_read(sql) and method == "execute" and not self.engine.in_writer():
+            with self.engine.reader() as conn:
+                result = self._run(conn.cursor(), method, sql, params)
+        else:
+            result = self.engine.write(lambda conn: self._run(conn.cursor(), method, sql, params))
+        self._rows, self.rowcount, self.lastrowid, self.description = result
+        self._rows.reverse()
+        return self
+
+    def execute(self, sql: str, params=()):
+        return self._execute("execute", sql, params)
+
+    def executemany(self, sql: str, seq):
+        return self._execute("executemany", sql, list(seq))
+
+    def fetchone(self):
+        return self._rows.pop() if self._rows else None
+
+    def fetchmany(self, size: int = 1):
+        return [self._rows.pop() for _ in range(min(size, len(self._rows)))]
+
+    def fetchall(self):
+        rows, self._rows = self._rows[::-1], []
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class SQLiteConnectionProxy:
+    """
+    Thay cho sqlite3.Connection dùng chung: cursor() đi qua SQLiteEngine.
+    Không có transaction dùng chung giữa các luồng: mỗi lệnh ghi tự commit,
+    nhiều lệnh cần nguyên tử → UltimateDatabaseManager._transaction (1 job trên luồng ghi)
+    """
+
+    def __init__(self, engine: SQLiteEngine):
+        self.engine = engine
+        self.row_factory = sqlite3.Row
+
+    def cursor(self, raw: bool = False):
+        return SQLiteCursorProxy(self.engine, raw)
+
+    def execute(self, sql: str, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql: str, seq):
+        return self.cursor().executemany(sql, seq)
+
+    def commit(self):
+        """No-op: lệnh ghi đã được commit khi execute() trả về"""
+
+    def close(self):
+        self.engine.close()
+
+# ============================================================================
+# 🐬 MYSQL CONNECTION POOL
+# ============================================================================
+
+class MySQLPool:
+    """
+    Pool connection PyMySQL (thay cho 1 connection dùng chung + ping mỗi query):
+    - min/max size, chờ tối đa MYSQL_POOL_TIMEOUT khi pool cạn
+    - Health check khi checkout (chỉ ping connection đã rảnh > MYSQL_POOL_CHECK_AFTER)
+    - Tự đóng connection rảnh quá MYSQL_POOL_IDLE_TIMEOUT (giữ lại min_size)
+    """
+
+    def __init__(self, config: Dict, min_size: int = MYSQL_POOL_MIN, max_size: int = MYSQL_POOL_MAX):
+        self.config = config
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self._idle: deque = deque()  # (connection, thời điểm trả về)
+        self._size = 0
+        self._cond = threading.Condition()
+        self._last_reap = time.time()
+        self.stats = {"checkouts": 0, "waits": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0, "timeouts": 0,
+                      "created": 0, "reconnects": 0, "reaped": 0, "discarded": 0, "in_use": 0}
+        for _ in range(min_size):
+            self._idle.append((self._connect(), time.time()))
+            self._size += 1
+
+    def _connect(self):
+        self.stats["created"] += 1
+        return pymysql.connect(
+            host=self.config["host"],
+            user=self.config["user"],
+            password=self.config["password"],
+            database=self.config["database"],
+            port=self.config.get("port", 3306),
+            autocommit=True,
+            cursorclass=pymysql.cursors.DictCursor
+        )
+
+    def acquire(self, timeout: float = MYSQL_POOL_TIMEOUT):
+        started = time.perf_counter()
+        with self._cond:
+            while not self._idle and self._size >= self.max_size:
+                self.stats["waits"] += 1
+                remaining = timeout - (time.perf_counter() - started)
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    if not self._idle and self._size >= self.max_size:
+                        self.stats["timeouts"] += 1
+                        raise TimeoutError(f"MySQL pool exhausted ({self.max_size} connections in use)")
+            if self._idle:
+                conn, idle_since = self._idle.pop()
+            else:
+                conn, idle_since = None, None
+                self._size += 1
+            self.stats["checkouts"] += 1
+            self.stats["in_use"] += 1
+            waited = (time.perf_counter() - started) * 1000
+            self.stats["wait_ms_total"] += waited
+            self.stats["wait_ms_max"] = max(self.stats["wait_ms_max"], round(waited, 2))
+        try:
+            if conn is None:
+                conn = self._connect()
+            elif time.time() - idle_since > MYSQL_POOL_CHECK_AFTER:
+                try:
+                    conn.ping(reconnect=False)
+                except Exception:
+                    self._close(conn)
+                    self.stats["reconnects"] += 1
+                    conn = self._connect()
+            return conn
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self.stats["in_use"] -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn, broken: bool = False):
+        """Trả connection về pool (broken=True → đóng và bỏ đi)"""
+        if not broken:
+            try:
+                if not conn.open or not conn.get_autocommit():
+                    broken = True
+                elif conn.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+                    # Transaction dở dang (lỗi giữa begin/commit) → rollback trước khi tái sử dụng
+                    conn.rollback()
+            except Exception:
+                broken = True
+        with self._cond:
+            self.stats["in_use"] -= 1
+            if broken:
+                self._size -= 1
+                self.stats["discarded"] += 1
+            else:
+                self._idle.append((conn, time.time()))
+            self._reap()
+            self._cond.notify()
+        if broken:
+            self._close(conn)
+
+    def _reap(self):
+        """Đóng connection rảnh quá lâu (gọi khi đang giữ _cond)"""
+        now = time.time()
+        if now - self._last_reap < MYSQL_POOL_IDLE_TIMEOUT / 10:
+            return
+        self._last_reap = now
+        # _idle: trái = rảnh lâu nhất
+        while self._idle and self._size > self.min_size and now - self._idle[0][1] > MYSQL_POOL_IDLE_TIMEOUT:
+            conn, _ = self._idle.popleft()
+            self._size -= 1
+            self.stats["reaped"] += 1
+            self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        with self._cond:
+            while self._idle:
+                self._close(self._idle.popleft()[0])
+                self._size -= 1
+
+    def get_stats(self) -> Dict:
+        with self._cond:
+            return {
+                **self.stats,
+                "size": self._size,
+                "idle": len(self._idle),
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "avg_wait_ms": round(self.stats["wait_ms_total"] / self.stats["checkouts"], 3) if self.stats["checkouts"] else 0.0
+            }
+
+
+class PooledCursor:
+    """
+    DictCursor mượn 1 connection từ MySQLPool; close() / with / GC đều trả connection về pool.
+    Lỗi kết nối trong khối with → connection bị loại khỏi pool.
+    """
+
+    def __init__(self, pool: MySQLPool, raw: bool = False):
+        self.pool = pool
+        self.connection = pool.acquire()
+        self._cursor = self.connection.cursor(pymysql.cursors.Cursor if raw else None)
+        self.closed = False
+
+    def __getattr__(self, name: str):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def close(self, broken: bool = False):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._cursor.close()
+        except Exception:
+            broken = True
+        self.pool.release(self.connection, broken)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(broken=exc_type is not None and issubclass(exc_type, (pymysql.err.OperationalError, pymysql.err.InterfaceError)))
+
+    def __del__(self):
+        self.close()
+
+
+class MySQLConnectionProxy:
+    """
+    Thay cho connection pymysql dùng chung: begin/commit/rollback áp dụng lên
+    connection của cursor gần nhất còn mở trong luồng hiện tại
+    """
+
+    def __init__(self, pool: MySQLPool):
+        self.pool = pool
+        self._local = threading.local()
+
+    def cursor(self, raw: bool = False) -> PooledCursor:
+        cursor = PooledCursor(self.pool, raw)
+        # weakref: cursor bị bỏ quên vẫn được GC thu hồi và trả connection về pool
+        self._local.cursors = self._open_cursors() + [weakref.ref(cursor)]
+        return cursor
+
+    def _open_cursors(self) -> List:
+        return [ref for ref in getattr(self._local, "cursors", []) if ref() is not None and not ref().closed]
+
+    def _current(self):
+        cursors = self._open_cursors()
+        cursor = cursors[-1]() if cursors else None
+        return cursor.connection if cursor is not None else None
+
+    def begin(self):
+        conn = self._current()
+        if conn is not None:
+            conn.begin()
+
+    def commit(self):
+        conn = self._current()
+        if conn is not None:
+            conn.commit()
+
+    def rollback(self):
+        conn = self._current()
+        if conn is not None:
+            conn.rollback()
+
+    def close(self):
+        self.pool.close()
+
+class MySQLReplicaRouter:
+    """
+    Định tuyến đọc sang replica MySQL (ghi luôn vào primary):
+    - Mỗi replica 1 MySQLPool riêng; chọn replica lag thấp nhất, round-robin khi bằng nhau
+    - Lag đo bằng SHOW REPLICA STATUS, cache REPLICA_LAG_CHECK_INTERVAL giây; lag > REPLICA_MAX_LAG, lỗi
+      hoặc status rỗng (trừ khi REPLICA_ASSUME_SYNC) → bỏ qua
+    - Mỗi replica 1 lock đo lag: chỉ 1 luồng đo lại, luồng khác dùng giá trị cache trong lúc đó
+    - Read-your-writes: ghi qua QueryLayer đánh dấu thời điểm theo bảng (lúc COMMIT nếu trong transaction);
+      đọc bảng vừa ghi trong (lag replica + REPLICA_RYW_WINDOW) giây → đọc primary (trừ REPLICA_STALE_OK_TABLES)
+    """
+
+    def __init__(self, hosts: List[str], config: Dict):
+        self.replicas: List[Dict] = []
+        self._writes: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._round_robin = 0
+        self.stats = {"replica_reads": 0, "primary_reads": 0, "ryw_fallbacks": 0, "lag_fallbacks": 0}
+        for host in hosts:
+            name, _, port = host.partition(":")
+            replica_config = dict(config, host=name, port=int(port) if port else config.get("port", 3306))
+            try:
+                pool = MySQLPool(replica_config, min_size=1, max_size=MYSQL_REPLICA_POOL_MAX)
+            except Exception as e:
+                logger.warning(f"⚠️  MySQL replica {host} unavailable: {e}")
+                continue
+            self.add_replica(host, pool)
+
+    def add_replica(self, host: str, pool):
+        self.replicas.append({"host": host, "pool": pool, "lag": 0.0, "checked_at": 0.0, "reads": 0,
+                              "lag_lock": threading.Lock()})
+
+    def mark_write(self, tables):
+        now = time.monotonic()
+        with self._lock:
+            for table in tables:
+                self._writes[table] = now
+
+    def _lag(self, replica: Dict) -> float:
+        """Lag (giây) của replica, đo lại tối đa 1 lần / REPLICA_LAG_CHECK_INTERVAL (luồng khác đang đo → giá trị cache)"""
+        lock = replica["lag_lock"]
+        if not lock.acquire(blocking=False):
+            if replica["checked_at"]:
+                return replica["lag"]
+            lock.acquire()  # chưa đo lần nào → chờ lần đo đầu, không coi replica là đồng bộ
+        try:
+            now = time.monotonic()
+            if now - replica["checked_at"] < REPLICA_LAG_CHECK_INTERVAL:
+                return replica["lag"]
+            replica["lag"] = self._measure_lag(replica)
+            replica["checked_at"] = now
+            return replica["lag"]
+        finally:
+            lock.release()
+
+    def _measure_lag(self, replica: Dict) -> float:
+        """SHOW REPLICA STATUS trên 1 connection của replica (gọi khi giữ lag_lock)"""
+        pool = replica["pool"]
+        try:
+            conn = pool.acquire()
+            broken = False
+            try:
+                with conn.cursor() as cursor:
+                    try:
+                        cursor.execute("SHOW REPLICA STATUS")
+                    except pymysql.err.ProgrammingError:
+                        cursor.execute("SHOW SLAVE STATUS")  # MySQL < 8.0.22 / MariaDB
+                    status = cursor.fetchone()
+            except Exception:
+                broken = True
+                raise
+            finally:
+                pool.release(conn, broken)
+            if not status:
+                # Không cấu hình replication (hoặc thiếu quyền REPLICATION CLIENT) → không biết lag
+                if not REPLICA_ASSUME_SYNC:
+                    logger.warning(f"⚠️  MySQL replica {replica['host']}: empty replica status (set REPLICA_ASSUME_SYNC=1 to use it anyway)")
+                lag = 0.0 if REPLICA_ASSUME_SYNC else float("inf")
+            else:
+                seconds = status.get("Seconds_Behind_Source", status.get("Seconds_Behind_Master"))
+                lag = float(seconds) if seconds is not None else float("inf")  # NULL: replication đang dừng
+        except Exception as e:
+            logger.warning(f"⚠️  MySQL replica {replica['host']} lag check failed: {e}")
+            lag = float("inf")
+        return lag
+
+    def route(self, tables) -> Optional[MySQLPool]:
+        """Pool replica để đọc các bảng này; None → đọc primary"""
+        now = time.monotonic()
+        candidates = [(self._lag(replica), replica) for replica in self.replicas]
+        candidates = [(lag, replica) for lag, replica in candidates if lag <= REPLICA_MAX_LAG]
+        with self._lock:
+            if not candidates:
+                self.stats["lag_fallbacks"] += 1
+                self.stats["primary_reads"] += 1
+                return None
+            last_write = max((self._writes.get(table, float("-inf")) for table in tables
+                              if table not in REPLICA_STALE_OK_TABLES), default=float("-inf"))
+            fresh = [(lag, replica) for lag, replica in candidates if now - last_write > lag + REPLICA_RYW_WINDOW]
+            if not fresh:
+                self.stats["ryw_fallbacks"] += 1
+                self.stats["primary_reads"] += 1
+                return None
+            best_lag = min(lag for lag, _ in fresh)
+            best = [replica for lag, replica in fresh if lag == best_lag]
+            self._round_robin += 1
+            replica = best[self._round_robin % len(best)]
+            replica["reads"] += 1
+            self.stats["replica_reads"] += 1
+            return replica["pool"]
+
+    def close(self):
+        for replica in self.replicas:
+            replica["pool"].close()
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self.stats)
+            replicas = [(r["host"], r["lag"], r["reads"], r["pool"]) for r in self.replicas]
+        stats["replicas"] = [{"host": host, "lag": lag, "reads": reads, "pool": pool.get_stats()}
+                             for host, lag, reads, pool in replicas]
+        return stats
+
+# ============================================================================
+# 🧾 SQL STATEMENT REGISTRY (viết 1 lần, biên dịch theo dialect)
+# ============================================================================
+
+# Placeholder trung lập "?" (MySQL → %s). {replace} = REPLACE / INSERT OR REPLACE.
+# Câu lệnh khác nhau thật sự giữa 2 dialect khai báo dạng {"mysql": ..., "sqlite": ...}
+SQL_STATEMENTS: Dict[str, Any] = {
+    # Users
+    "users.verify": "SELECT role, language FROM users WHERE username = ? AND password_hash = ?",
+    "users.verify_full": "SELECT * FROM users WHERE username = ? AND password_hash = ?",
+    # Rooms
+    "rooms.get": "SELECT * FROM rooms WHERE room_id = ?",
+    "rooms.name": "SELECT room_id, name FROM rooms WHERE room_id = ?",
+    "rooms.active": "SELECT * FROM rooms WHERE is_active = 1 ORDER BY created_at DESC",
+    "rooms.insert": "INSERT INTO rooms (room_id, name, area, floor, building, created_at, is_active) VALUES (?, ?, ?, ?, ?, ?, 1)",
+    "rooms.delete": "DELETE FROM rooms WHERE room_id = ?",
+    "rooms.search": """
+        SELECT r.*, COUNT(s.sensor_id) as sensor_count
+        FROM rooms r
+        LEFT JOIN sensors s ON r.room_id = s.room_id
+        WHERE r.room_id LIKE ? OR r.name LIKE ? OR r.building LIKE ?
+        GROUP BY r.room_id
+    """,
+    # Enterprise
+    "buildings.insert": "INSERT INTO buildings (building_id, name, address, total_floors, manager_name, is_active, created_at) VALUES (?, ?, ?, ?, ?, 1, ?)",
+    "floors.insert": "INSERT INTO floors (floor_id, building_id, floor_number, name, safety_status, energy_target) VALUES (?, ?, ?, ?, 'SAFE', ?)",
+    "floors.all": "SELECT floor_id, building_id, floor_number, name, energy_target FROM floors",
+    "schedules.insert": """
+        INSERT INTO enterprise_schedules (room_id, event_name, start_time, end_time, min_temp, max_temp, priority, is_completed)
+        VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+    """,
+    "schedules.upcoming": "SELECT * FROM enterprise_schedules WHERE is_completed = 0 ORDER BY start_time ASC LIMIT ?",
+    # Sensors
+    "sensors.with_room": """
+        SELECT s.sensor_id, s.room_id, s.sensor_type, s.unit, s.last_value, s.last_update, s.status, r.name as room_name
+        FROM sensors s
+        LEFT JOIN rooms r ON s.room_id = r.room_id
+    """,
+    "sensors.by_room": "SELECT * FROM sensors WHERE room_id = ?",
+    "sensors.insert": "INSERT INTO sensors (sensor_id, room_id, sensor_type, unit, last_value, last_update, status) VALUES (?, ?, ?, ?, 0, ?, 'WAITING')",
+    "sensors.delete": "DELETE FROM sensors WHERE sensor_id = ?",
+    "sensors.delete_by_room": "DELETE FROM sensors WHERE room_id = ?",
+    "sensors.update_last": "UPDATE sensors SET last_value = ?, last_update = ?, status = 'ONLINE' WHERE sensor_id = ?",
+    "sensors.search": """
+        SELECT s.*, r.name as room_name
+        FROM sensors s
+        LEFT JOIN rooms r ON s.room_id = r.room_id
+        WHERE s.sensor_id LIKE ? OR s.sensor_type LIKE ?
+    """,
+    # IoT devices
+    "devices.insert": "INSERT INTO iot_devices (device_id, room_id, device_type, device_name, status, last_command, last_update) VALUES (?, ?, ?, ?, 'OFF', '', ?)",
+    "devices.control": "UPDATE iot_devices SET status = ?, last_command = ?, last_update = ? WHERE device_id = ?",
+    "devices.by_room": "SELECT * FROM iot_devices WHERE room_id = ?",
+    "devices.delete_by_room": "DELETE FROM iot_devices WHERE room_id = ?",
+    "devices.with_room": """
+        SELECT d.*, r.name as room_name
+        FROM iot_devices d
+        LEFT JOIN rooms r ON d.room_id = r.room_id
+        ORDER BY d.last_update DESC
+    """,
+    "devices.search": """
+        SELECT d.*, r.name as room_name
+        FROM iot_devices d
+        LEFT JOIN rooms r ON d.room_id = r.room_id
+        WHERE d.device_id LIKE ? OR d.device_name LIKE ? OR d.device_type LIKE ?
+    """,
+    # Readings & rollups
+    "readings.insert": "INSERT INTO sensor_readings (sensor_id, value, timestamp, quality, room_id, sensor_type) VALUES (?, ?, ?, ?, ?, ?)",
+    "readings.series": "SELECT timestamp, value FROM sensor_readings WHERE sensor_type = ? AND timestamp > ? ORDER BY timestamp",
+    "readings.series_room": "SELECT timestamp, value FROM sensor_readings WHERE sensor_type = ? AND timestamp > ? AND room_id = ? ORDER BY timestamp",
+    "readings.power_since": "SELECT sensor_id, value, timestamp FROM sensor_readings WHERE sensor_type = 'power' AND timestamp >= ?",
+    "readings.expired": "SELECT id, sensor_id, timestamp, value FROM sensor_readings WHERE timestamp < ? ORDER BY id LIMIT ?",
+    "readings.delete_expired": "DELETE FROM sensor_readings WHERE id <= ? AND timestamp < ?",
+    "rollups.delete_range": "DELETE FROM sensor_rollups WHERE bucket_start >= ? AND bucket_start < ?",
+    "readings.between": "SELECT sensor_id, value, timestamp FROM sensor_readings WHERE timestamp >= ? AND timestamp < ?",
+    "readings.min_ts": "SELECT MIN(timestamp) FROM sensor_readings",
+    # Bookkeeping: thời điểm áp dụng migration, tiến độ job nền (app_meta)
+    "migrations.applied_at": "SELECT applied_at FROM schema_migrations WHERE version = ?",
+    "meta.get": "SELECT value FROM app_meta WHERE name = ?",
+    "meta.set": {
+        "mysql": "INSERT INTO app_meta (name, value) VALUES (?, ?) ON DUPLICATE KEY UPDATE value = VALUES(value)",
+        "sqlite": "INSERT INTO app_meta (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = excluded.value"
+    },
+    "rollups.series_sum": """
+        SELECT bucket_start, SUM(sum_value / count) FROM sensor_rollups
+        WHERE resolution = ? AND sensor_type = ? AND bucket_start >= ?
+        GROUP BY bucket_start ORDER BY bucket_start
+    """,
+    "rollups.series_avg": """
+        SELECT bucket_start, AVG(sum_value / count) FROM sensor_rollups
+        WHERE resolution = ? AND sensor_type = ? AND bucket_start >= ?
+        GROUP BY bucket_start ORDER BY bucket_start
+    """,
+    "rollups.series_room_sum": """
+        SELECT bucket_start, SUM(sum_value / count) FROM sensor_rollups
+        WHERE resolution = ? AND sensor_type = ? AND bucket_start >= ? AND room_id = ?
+        GROUP BY bucket_start ORDER BY bucket_start
+    """,
+    "rollups.series_room_avg": """
+        SELECT bucket_start, AVG(sum_value / count) FROM sensor_rollups
+        WHERE resolution = ? AND sensor_type = ? AND bucket_start >= ? AND room_id = ?
+        GROUP BY bucket_start ORDER BY bucket_start
+    """,
+    # Công suất TB của phòng theo bucket (Σ trung bình các sensor power) → kWh = W × thời gian bucket
+    "rollups.energy": """
+        SELECT room_id, bucket_start, SUM(sum_value / count) FROM sensor_rollups
+        WHERE resolution = ? AND sensor_type = 'power' AND bucket_start >= ?
+        GROUP BY room_id, bucket_start
+    """,
+    "rollups.energy_room": """
+        SELECT room_id, bucket_start, SUM(sum_value / count) FROM sensor_rollups
+        WHERE resolution = ? AND sensor_type = 'power' AND bucket_start >= ? AND room_id = ?
+        GROUP BY room_id, bucket_start
+    """,
+    # Công suất TB từng sensor power theo bucket trong [start, end) → kWh các ngày trước cho EnergyLedger
+    "rollups.energy_sensors": """
+        SELECT sensor_id, room_id, bucket_start, sum_value / count FROM sensor_rollups
+        WHERE resolution = ? AND sensor_type = 'power' AND bucket_start >= ? AND bucket_start < ?
+    """,
+    # Phần tổng của mọi sensor 1 loại theo bucket rollup (analytics ?bucket=)
+    "rollups.buckets": """
+        SELECT bucket_start, SUM(sum_value), MIN(min_value), MAX(max_value), SUM(count) FROM sensor_rollups
+        WHERE resolution = ? AND sensor_type = ? AND bucket_start >= ?
+        GROUP BY bucket_start
+    """,
+    # Mỗi (phòng, loại) 1 dòng: sum / min / max / count của mọi reading (analytics nhiều phòng)
+    "rollups.rooms": """
+        SELECT room_id, sensor_type, SUM(sum_value), MIN(min_value), MAX(max_value), SUM(count) FROM sensor_rollups
+        WHERE resolution = ? AND bucket_start >= ? AND sensor_type IN ('power', 'occupancy', 'temperature')
+        GROUP BY room_id, sensor_type
+    """,
+    "readings.rooms": """
+        SELECT room_id, sensor_type, value FROM sensor_readings
+        WHERE timestamp > ? AND sensor_type IN ('power', 'occupancy', 'temperature')
+    """,
+    # sum / count reading occupancy theo (phòng, sensor) → số người TB của phòng (_avg_occupancy)
+    "rollups.occupancy": """
+        SELECT room_id, sensor_id, SUM(sum_value), SUM(count) FROM sensor_rollups
+        WHERE resolution = ? AND sensor_type = 'occupancy' AND bucket_start >= ?
+        GROUP BY room_id, sensor_id
+    """,
+    "rollups.occupancy_room": """
+        SELECT room_id, sensor_id, SUM(sum_value), SUM(count) FROM sensor_rollups
+        WHERE resolution = ? AND sensor_type = 'occupancy' AND bucket_start >= ? AND room_id = ?
+        GROUP BY room_id, sensor_id
+    """,
+    "readings.occupancy": """
+        SELECT room_id, sensor_id, SUM(value), COUNT(value) FROM sensor_readings
+        WHERE sensor_type = 'occupancy' AND timestamp > ?
+        GROUP BY room_id, sensor_id
+    """,
+    "readings.occupancy_room": """
+        SELECT room_id, sensor_id, SUM(value), COUNT(value) FROM sensor_readings
+        WHERE sensor_type = 'occupancy' AND timestamp > ? AND room_id = ?
+        GROUP BY room_id, sensor_id
+    """,
+    "rollups.upsert": {
+        "mysql": """
+            INSERT INTO sensor_rollups (resolution, bucket_start, sensor_id, room_id, sensor_type,
+                min_value, max_value, sum_value, count, last_value, last_ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON DUPLICATE KEY UPDATE
+                min_value = LEAST(min_value, VALUES(min_value)),
+                max_value = GREATEST(max_value, VALUES(max_value)),
+                sum_value = sum_value + VALUES(sum_value),
+                count = count + VALUES(count),
+                last_value = IF(VALUES(last_ts) >= last_ts, VALUES(last_value), last_value),
+                last_ts = GREATEST(last_ts, VALUES(last_ts))
+        """,
+        "sqlite": """
+            INSERT INTO sensor_rollups (resolution, bucket_start, sensor_id, room_id, sensor_type,
+                min_value, max_value, sum_value, count, last_value, last_ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (resolution, sensor_id, bucket_start) DO UPDATE SET
+                min_value = MIN(min_value, excluded.min_value),
+                max_value = MAX(max_value, excluded.max_value),
+                sum_value = sum_value + excluded.sum_value,
+                count = count + excluded.count,
+                last_value = CASE WHEN excluded.last_ts >= last_ts THEN excluded.last_value ELSE last_value END,
+                last_ts = MAX(last_ts, excluded.last_ts)
+        """
+    },
+    # Chat & knowledge
+    "chat.insert": "INSERT INTO chat_history (user_msg, ai_response, timestamp, language, context) VALUES (?, ?, ?, ?, ?)",
+    "chat.recent": "SELECT * FROM chat_history ORDER BY timestamp DESC LIMIT ?",
+    "knowledge.insert": "INSERT INTO ai_knowledge (topic, content, source, timestamp, importance) VALUES (?, ?, ?, ?, ?)",
+    # AI decisions, safety, alerts
+    "decisions.upsert": """
+        {replace} INTO ai_decisions (id, agent_name, decision_type, target, action, reasoning, confidence, timestamp, status, approved_by)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """,
+    "decisions.insert": """
+        INSERT INTO ai_decisions (id, agent_name, decision_type, target, action, reasoning, confidence, timestamp, status)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """,
+    "decisions.recent": "SELECT * FROM ai_decisions ORDER BY timestamp DESC LIMIT ?",
+    "decisions.count_since": "SELECT COUNT(*) FROM ai_decisions WHERE timestamp > ?",
+    "safety.insert": """
+        INSERT INTO safety_watchdog_logs (location_id, risk_level, event_type, description, automated_action, timestamp)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """,
+    "alerts.upsert": """
+        {replace} INTO alerts (alert_id, severity, title, message, location, timestamp, acknowledged, resolved)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """,
+    "alerts.active": "SELECT * FROM alerts WHERE resolved = 0 ORDER BY timestamp DESC",
+    "alerts.by_severity_since": "SELECT severity, COUNT(*) FROM alerts WHERE timestamp > ? GROUP BY severity"
+}
+
+SQL_DIALECT_TOKENS = {
+    "mysql": {"{replace}": "REPLACE"},
+    "sqlite": {"{replace}": "INSERT OR REPLACE"}
+}
+
+
+class QueryLayer:
+    """
+    Biên dịch SQL_STATEMENTS cho 1 dialect lúc khởi động và thực thi theo tên:
+    - Chuỗi SQL đã biên dịch được giữ nguyên → tận dụng statement cache của driver
+    - Row trả về dạng namedtuple (kiểu row tạo 1 lần / câu lệnh), không dựng dict từng dòng
+    - Timestamp: ts() đổi epoch sang kiểu cột của dialect (MySQL TIMESTAMP / SQLite REAL / Supabase timestamptz)
+    - Bảng mà mỗi câu lệnh đọc/ghi được tách sẵn → định tuyến read replica + read-your-writes
+    """
+
+    def __init__(self, manager, dialect: str, statements: Dict[str, Any] = SQL_STATEMENTS):
+        self.manager = manager
+        self.dialect = dialect
+        self.statements = {name: self._compile(sql) for name, sql in statements.items()}
+        self.tables = {name: self._tables(sql) for name, sql in self.statements.items()}
+        self.writes = {name for name, sql in self.statements.items()
+                       if isinstance(sql, str) and not sql.upper().startswith(("SELECT", "WITH"))}
+        self._row_types: Dict[str, Any] = {}
+        self._local = threading.local()
+        self.executions = 0
+
+    @staticmethod
+    def _tables(sql) -> frozenset:
+        if not isinstance(sql, str):
+            return frozenset()
+        return frozenset(a or b for a, b in re.findall(r"\b(?:FROM|JOIN|INTO) (\w+)|^UPDATE (\w+)", sql, re.I))
+
+    def _compile(self, sql) -> str:
+        if callable(sql):
+            return sql  # Supabase: handler REST (xem SUPABASE_STATEMENTS)
+        if isinstance(sql, dict):
+            sql = sql[self.dialect]
+        for token, value in SQL_DIALECT_TOKENS[self.dialect].items():
+            sql = sql.replace(token, value)
+        if self.dialect == "mysql":
+            sql = sql.replace("%", "%%").replace("?", "%s")
+        return " ".join(sql.split())
+
+    def ts(self, epoch: float):
+        if self.dialect == "mysql":
+            return datetime.fromtimestamp(epoch)
+        if self.dialect == "supabase":
+            return datetime.fromtimestamp(epoch, timezone.utc).isoformat()
+        return epoch
+
+    def _row_type(self, name: str, description):
+        fields = tuple(d[0] for d in description)
+        row_type = self._row_types.get(name)
+        if row_type is None or row_type._fields != fields:
+            row_type = namedtuple("Row_" + name.replace(".", "_"), fields, rename=True)
+            self._row_types[name] = row_type
+        return row_type
+
+    def _run(self, cursor, name: str, params, many: bool = False):
+        self.executions += 1
+        if many:
+            cursor.executemany(self.statements[name], params)
+        else:
+            cursor.execute(self.statements[name], params)
+        if name in self.writes and self.manager.replicas:
+            pending = getattr(self._local, "pending_writes", None)
+            if pending is not None:
+                pending.update(self.tables[name])  # trong transaction → đánh dấu lúc COMMIT
+            else:
+                self.manager.replicas.mark_write(self.tables[name])
+        return cursor
+
+    @contextmanager
+    def track_writes(self):
+        """Gom bảng được ghi trong 1 transaction (read-your-writes tính từ lúc COMMIT, không phải lúc execute)"""
+        pending = set()
+        self._local.pending_writes = pending
+        try:
+            yield pending
+        finally:
+            self._local.pending_writes = None
+
+    def read_cursor(self, *names: str):
+        """Cursor (tuple) để đọc các câu lệnh này: replica nếu đủ mới, ngược lại primary"""
+        return self.manager._get_cursor(raw=True, read_tables=frozenset().union(*(self.tables[name] for name in names)))
+
+    def rows(self, name: str, params: Tuple = (), cursor=None) -> List[Tuple]:
+        """SELECT → list namedtuple"""
+        own = cursor is None
+        cursor = cursor or self.read_cursor(name)
+        try:
+            self._run(cursor, name, params)
+            raw = cursor.fetchall()
+            if not raw:
+                return []
+            make = self._row_type(name, cursor.description)._make
+            return [make(row) for row in raw]
+        finally:
+            if own:
+                cursor.close()
+
+    def tuples(self, name: str, params: Tuple = (), cursor=None) -> List[Tuple]:
+        """SELECT → list tuple thuần (đường nóng: chuỗi analytics)"""
+        own = cursor is None
+        cursor = cursor or self.read_cursor(name)
+        try:
+            return list(self._run(cursor, name, params).fetchall())
+        finally:
+            if own:
+                cursor.close()
+
+    def row(self, name: str, params: Tuple = (), cursor=None):
+        rows = self.rows(name, params, cursor)
+        return rows[0] if rows else None
+
+    def scalar(self, name: str, params: Tuple = (), cursor=None):
+        rows = self.tuples(name, params, cursor)
+        return rows[0][0] if rows else None
+
+    def dicts(self, name: str, params: Tuple = (), cursor=None) -> List[Dict]:
+        """SELECT → list dict (chỉ dùng cho dữ liệu trả thẳng ra API)"""
+        own = cursor is None
+        cursor = cursor or self.read_cursor(name)
+        try:
+            raw = self._run(cursor, name, params).fetchall()
+            fields = [d[0] for d in cursor.description or ()]
+            return [dict(zip(fields, row)) for row in raw]
+        finally:
+            if own:
+                cursor.close()
+
+    def execute(self, name: str, params: Tuple = (), cursor=None, many: bool = False) -> int:
+        """INSERT/UPDATE/DELETE; không truyền cursor → tự commit (SQLite)"""
+        own = cursor is None
+        cursor = cursor or self.manager._get_cursor(raw=True)
+        try:
+            rowcount = self._run(cursor, name, params, many).rowcount
+            if own and not self.manager.use_mysql:
+                self.manager.connection.commit()
+            return rowcount
+        finally:
+            if own:
+                cursor.close()
+
+    def execute_many(self, name: str, seq: List[Tuple], cursor=None) -> int:
+        return self.execute(name, seq, cursor, many=True)
+
+    def get_stats(self) -> Dict:
+        return {"dialect": self.dialect, "statements": len(self.statements), "writes": len(self.writes), "executions": self.executions}
+
+# ============================================================================
+# ☁️ SUPABASE BACKEND (PostgREST qua http.client keep-alive)
+# ============================================================================
+
+class SupabaseError(Exception):
+    """Lỗi HTTP trả về từ PostgREST"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f"HTTP {status}: {message}")
+        self.status = status
+
+
+class PostgRESTClient:
+    """
+    Client PostgREST tối giản cho Supabase (không cần supabase-py):
+    - Connection HTTP/1.1 keep-alive tái sử dụng (LIFO), không bắt tay TCP/TLS lại mỗi request
+    - Retry exponential backoff + jitter cho lỗi mạng / 408 / 429 / 5xx (tôn trọng Retry-After)
+    - POST không idempotent chỉ retry khi chắc chắn chưa được xử lý (429/503, keep-alive đã đóng)
+    - Bulk insert/upsert chia lô SUPABASE_BATCH_SIZE, select tự phân trang theo SUPABASE_PAGE_SIZE
+    - defer(): gom dòng ghi lẻ thành lô, flush khi đủ lô / sau SUPABASE_DEFER_MAX_AGE / trước khi đọc bảng đó;
+      lô lỗi tạm thời được xếp lại (tối đa SUPABASE_DEFER_MAX_ROWS dòng), lỗi vĩnh viễn / tràn → đếm deferred_dropped
+    """
+
+    RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+    def __init__(self, url: str, key: str, rest_path: str = SUPABASE_REST_PATH):
+        parts = urlsplit(url)
+        self.secure = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port
+        self.base = parts.path.rstrip("/") + rest_path.rstrip("/")
+        self.headers = {
+            "apikey": key,
+            "Authorization": f"Bearer {key}",
+            "Content-Type": "application/json",
+            "Accept": "application/json"
+        }
+        self._idle = queue.LifoQueue()
+        self._deferred: Dict[Tuple, List[Dict]] = {}
+        self._defer_lock = threading.Lock()
+        self._defer_timer: Optional[threading.Timer] = None
+        self._stats_lock = threading.Lock()
+        self.stats = {"requests": 0, "retries": 0, "errors": 0, "connections": 0, "rows_sent": 0, "rows_received": 0,
+                      "deferred_failures": 0, "deferred_requeued": 0, "deferred_dropped": 0}
+        self.last_deferred_error: Optional[str] = None
+
+    def _count(self, key: str, n: int = 1):
+        with self._stats_lock:
+            self.stats[key] += n
+
+    def _acquire(self) -> Tuple[http.client.HTTPConnection, bool]:
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            self._count("connections")
+            conn_class = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+            return conn_class(self.host, self.port, timeout=SUPABASE_TIMEOUT), False
+
+    def _release(self, conn: http.client.HTTPConnection):
+        if self._idle.qsize() < SUPABASE_POOL_SIZE:
+            self._idle.put(conn)
+        else:
+            conn.close()
+
+    def request(self, method: str, path: str, params: Optional[List[Tuple]] = None, body: Any = None,
+                prefer: Optional[str] = None, idempotent: Optional[bool] = None) -> Tuple[int, Any, Any]:
+        """1 request REST (path: bảng hoặc rpc/<hàm>) → (status, headers, JSON)"""
+        url = f"{self.base}/{path}"
+        if params:
+            url += "?" + urlencode(params)
+        payload = json.dumps(body, default=str).encode() if body is not None else None
+        headers = dict(self.headers, Prefer=prefer) if prefer else self.headers
+        if idempotent is None:
+            idempotent = method != "POST"
+
+        attempt = 0
+        while True:
+            conn, reused = self._acquire()
+            self._count("requests")
+            retry_after = None
+            try:
+                conn.request(method, url, body=payload, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                # Keep-alive bị server đóng trong lúc rảnh → request chưa tới server, thử lại ngay
+                if reused and isinstance(e, (ConnectionResetError, BrokenPipeError)):
+                    continue
+                error, retryable = e, idempotent
+            else:
+                if resp.will_close:
+                    conn.close()
+                else:
+                    self._release(conn)
+                if resp.status < 400:
+                    return resp.status, resp.headers, json.loads(data) if data else None
+                error = SupabaseError(resp.status, data.decode("utf-8", "replace")[:300])
+                retry_after = resp.getheader("Retry-After")
+                # 429/503: bị từ chối trước khi xử lý → POST cũng retry được
+                retryable = resp.status in self.RETRY_STATUS and (idempotent or resp.status in (429, 503))
+
+            if not retryable or attempt >= SUPABASE_RETRIES:
+                self._count("errors")
+                raise error
+            delay = min(SUPABASE_BACKOFF_MAX, SUPABASE_BACKOFF * 2 ** attempt) * random.uniform(0.5, 1.0)
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, min(SUPABASE_BACKOFF_MAX, float(retry_after)))
+            attempt += 1
+            self._count("retries")
+            logger.warning(f"⚠️ Supabase {method} {path}: {error} → retry {attempt}/{SUPABASE_RETRIES} sau {delay:.2f}s")
+            time.sleep(delay)
+
+    @staticmethod
+    def _affected(headers) -> int:
+        total = (headers.get("Content-Range") or "").rsplit("/", 1)[-1]
+        return int(total) if total.isdigit() else -1
+
+    def select(self, table: str, columns: str = "*", filters: List[Tuple[str, str]] = (),
+               order: Optional[str] = None, limit: Optional[int] = None) -> List[Dict]:
+        """GET /<table>; không có limit → đọc hết theo trang SUPABASE_PAGE_SIZE"""
+        self.flush_deferred(table)
+        params = [("select", columns)] + list(filters) + ([("order", order)] if order else [])
+        rows: List[Dict] = []
+        while True:
+            page = SUPABASE_PAGE_SIZE if limit is None else min(limit - len(rows), SUPABASE_PAGE_SIZE)
+            data = self.request("GET", table, params + [("limit", page), ("offset", len(rows))])[2]
+            rows.extend(data)
+            if len(data) < page or (limit is not None and len(rows) >= limit):
+                break
+        self._count("rows_received", len(rows))
+        return rows
+
+    def count(self, table: str, filters: List[Tuple[str, str]] = ()) -> int:
+        """HEAD + Prefer count=exact (không tải dòng nào)"""
+        self.flush_deferred(table)
+        headers = self.request("HEAD", table, [("select", "*")] + list(filters), prefer="count=exact")[1]
+        return max(self._affected(headers), 0)
+
+    def insert(self, table: str, rows: List[Dict], on_conflict: Optional[str] = None) -> int:
+        """POST bulk; on_conflict → upsert (merge-duplicates, idempotent nên được retry)"""
+        prefer = "return=minimal,resolution=merge-duplicates" if on_conflict else "return=minimal"
+        params = [("on_conflict", on_conflict)] if on_conflict else None
+        for i in range(0, len(rows), SUPABASE_BATCH_SIZE):
+            self.request("POST", table, params, rows[i:i + SUPABASE_BATCH_SIZE], prefer, idempotent=bool(on_conflict))
+        self._count("rows_sent", len(rows))
+        return len(rows)
+
+    def update(self, table: str, values: Dict, filters: List[Tuple[str, str]]) -> int:
+        self.flush_deferred(table)
+        return self._affected(self.request("PATCH", table, filters, values, "return=minimal,count=exact")[1])
+
+    def delete(self, table: str, filters: List[Tuple[str, str]]) -> int:
+        self.flush_deferred(table)
+        return self._affected(self.request("DELETE", table, filters, prefer="return=minimal,count=exact")[1])
+
+    def rpc(self, function: str, args: Dict) -> Any:
+        return self.request("POST", f"rpc/{function}", body=args)[2]
+
+    def defer(self, table: str, rows: List[Dict], on_conflict: Optional[str] = None) -> int:
+        """Gom dòng để gửi 1 lô sau (ghi lẻ tẻ như ai_decisions)"""
+        if not rows:
+            return 0
+        with self._defer_lock:
+            buffered = self._deferred.setdefault((table, on_conflict, tuple(rows[0])), [])
+            buffered.extend(rows)
+            full = len(buffered) >= SUPABASE_BATCH_SIZE
+            if not full:
+                self._arm_defer_timer()
+        if full:
+            self.flush_deferred(table)
+        return len(rows)
+
+    def _arm_defer_timer(self):
+        """Gọi khi đang giữ _defer_lock"""
+        if self._defer_timer is None:
+            self._defer_timer = threading.Timer(SUPABASE_DEFER_MAX_AGE, self._flush_timer)
+            self._defer_timer.daemon = True
+            self._defer_timer.start()
+
+    def _flush_timer(self):
+        with self._defer_lock:
+            self._defer_timer = None
+        self.flush_deferred()
+
+    def _requeue(self, key: Tuple, rows: List[Dict], error: Exception):
+        """Lô gửi lỗi: lỗi tạm thời → xếp lại trước các dòng mới (giới hạn SUPABASE_DEFER_MAX_ROWS), còn lại bỏ + đếm"""
+        self._count("deferred_failures")
+        self.last_deferred_error = f"{key[0]}: {error}"
+        permanent = isinstance(error, SupabaseError) and error.status not in self.RETRY_STATUS
+        with self._defer_lock:
+            pending = self._deferred.get(key, [])
+            room = 0 if permanent else max(0, SUPABASE_DEFER_MAX_ROWS - sum(len(r) for r in self._deferred.values()))
+            kept = rows[len(rows) - min(room, len(rows)):]
+            if kept:
+                self._deferred[key] = kept + pending
+                self._arm_defer_timer()
+        dropped = len(rows) - len(kept)
+        self._count("deferred_requeued", len(kept))
+        self._count("deferred_dropped", dropped)
+        logger.error(f"❌ Supabase deferred insert {key[0]} ({len(rows)} rows) failed: {error} "
+                     f"→ requeued {len(kept)}, dropped {dropped}")
+
+    def flush_deferred(self, table: Optional[str] = None) -> int:
+        """Gửi các lô đang gom (table=None → tất cả)"""
+        if not self._deferred:
+            return 0
+        with self._defer_lock:
+            batches = [(key, self._deferred.pop(key)) for key in list(self._deferred) if table is None or key[0] == table]
+            if table is None and self._defer_timer:
+                self._defer_timer.cancel()
+                self._defer_timer = None
+        sent = 0
+        for key, rows in batches:
+            name, on_conflict, _ = key
+            try:
+                sent += self.insert(name, rows, on_conflict)
+            except Exception as e:
+                self._requeue(key, rows, e)
+        return sent
+
+    def close(self):
+        self.flush_deferred()
+        if self._deferred:
+            # Lần gửi cuối vẫn lỗi → không còn timer để thử lại
+            lost = sum(len(rows) for rows in self._deferred.values())
+            logger.error(f"❌ Supabase: {lost} deferred rows not sent before shutdown ({self.last_deferred_error})")
+        with self._defer_lock:
+            if self._defer_timer:
+                self._defer_timer.cancel()
+                self._defer_timer = None
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def get_stats(self) -> Dict:
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats.update({
+            "endpoint": f"{'https' if self.secure else 'http'}://{self.host}{self.base}",
+            "idle_connections": self._idle.qsize(),
+            "deferred_rows": sum(len(rows) for rows in list(self._deferred.values())),
+            "last_deferred_error": self.last_deferred_error
+        })
+        return stats
+
+
+class SupabaseCursor:
+    """
+    Cursor kiểu DB-API cho QueryLayer: execute(handler, params) gọi handler REST trong SUPABASE_STATEMENTS,
+    kết quả đọc lại qua fetchall()/description/rowcount như cursor SQL
+    """
+
+    def __init__(self, client: PostgRESTClient, raw: bool = False):
+        self.client = client
+        self.raw = raw
+        self.description = None
+        self.rowcount = -1
+        self._rows: List[Dict] = []
+
+    def execute(self, handler, params: Tuple = ()):
+        if not callable(handler):
+            raise NotImplementedError("Supabase backend chỉ chạy câu lệnh trong SUPABASE_STATEMENTS")
+        self._set_result(handler(self.client, tuple(params)))
+        return self
+
+    def executemany(self, handler, seq):
+        if not hasattr(handler, "many"):
+            raise NotImplementedError("Câu lệnh không hỗ trợ ghi theo lô trên Supabase")
+        self._set_result(handler.many(self.client, [tuple(params) for params in seq]))
+        return self
+
+    def _set_result(self, result):
+        if isinstance(result, list):
+            self._rows = result
+            self.description = [(name,) for name in result[0]] if result else None
+            self.rowcount = len(result)
+        else:
+            self._rows, self.description, self.rowcount = [], None, result
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return [tuple(row.values()) for row in rows] if self.raw else rows
+
+    def fetchone(self):
+        rows = self.fetchall()
+        return rows[0] if rows else None
+
+    def close(self):
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SupabaseConnectionProxy:
+    """self.connection khi dùng Supabase: mỗi request PostgREST tự commit, begin/commit/rollback là no-op"""
+
+    in_transaction = False
+
+    def __init__(self, client: PostgRESTClient):
+        self.client = client
+
+    def cursor(self, raw: bool = False) -> SupabaseCursor:
+        return SupabaseCursor(self.client, raw)
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.client.close()
+
+
+class RestInsert:
+    """INSERT/UPSERT qua PostgREST: params → object theo columns, executemany → 1 request bulk"""
+
+    def __init__(self, table: str, columns: Tuple[str, ...], defaults: Optional[Dict] = None,
+                 on_conflict: Optional[str] = None, deferred: bool = False):
+        self.table = table
+        self.columns = columns
+        self.defaults = defaults or {}
+        self.on_conflict = on_conflict
+        self.deferred = deferred
+
+    def many(self, client: PostgRESTClient, seq: List[Tuple]) -> int:
+        rows = [{**self.defaults, **dict(zip(self.columns, params))} for params in seq]
+        if self.deferred:
+            return client.defer(self.table, rows, self.on_conflict)
+        return client.insert(self.table, rows, self.on_conflict)
+
+    def __call__(self, client: PostgRESTClient, params: Tuple) -> int:
+        return self.many(client, [params])
+
+
+class RestUpdate:
+    """UPDATE ... WHERE key = ? qua PATCH theo khóa (không upsert → không tạo lại dòng đã bị xóa)"""
+
+    def __init__(self, table: str, columns: Tuple[str, ...], key: str, defaults: Optional[Dict] = None):
+        self.table = table
+        self.columns = columns  # params = (*giá trị columns, khóa)
+        self.key = key
+        self.defaults = defaults or {}
+
+    def many(self, client: PostgRESTClient, seq: List[Tuple]) -> int:
+        # PostgREST không PATCH nhiều dòng với giá trị khác nhau trong 1 request → 1 PATCH / dòng (keep-alive)
+        updated = 0
+        for params in seq:
+            values = {**self.defaults, **dict(zip(self.columns, params[:-1]))}
+            updated += max(client.update(self.table, values, [(self.key, f"eq.{params[-1]}")]), 0)
+        return updated
+
+    def __call__(self, client: PostgRESTClient, params: Tuple) -> int:
+        return self.many(client, [params])
+
+
+class RestRpc:
+    """Gọi hàm Postgres rpc/<function>(rows jsonb) — cho upsert cộng dồn mà PostgREST không diễn đạt được"""
+
+    def __init__(self, function: str, columns: Tuple[str, ...]):
+        self.function = function
+        self.columns = columns
+
+    def many(self, client: PostgRESTClient, seq: List[Tuple]) -> int:
+        rows = [dict(zip(self.columns, params)) for params in seq]
+        for i in range(0, len(rows), SUPABASE_BATCH_SIZE):
+            client.rpc(self.function, {"rows": rows[i:i + SUPABASE_BATCH_SIZE]})
+        return len(rows)
+
+    def __call__(self, client: PostgRESTClient, params: Tuple) -> int:
+        return self.many(client, [params])
+
+
+def _rest_quote(value) -> str:
+    """Giá trị trong or=(...)/in.(...) phải đặt trong ngoặc kép nếu chứa , . ( )"""
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _rest_ilike_any(columns: Tuple[str, ...], pattern: str) -> Tuple[str, str]:
+    """LIKE '%q%' OR ... → or=(col.ilike."*q*",...)"""
+    value = _rest_quote(pattern.replace("%", "*"))
+    return ("or", "(" + ",".join(f"{column}.ilike.{value}" for column in columns) + ")")
+
+
+def _rest_room_name(rows: List[Dict]) -> List[Dict]:
+    """Embed rooms(name) → cột room_name như LEFT JOIN"""
+    for row in rows:
+        room = row.pop("rooms", None)
+        row["room_name"] = room["name"] if room else None
+    return rows
+
+
+def _rest_rooms_search(client: PostgRESTClient, params: Tuple) -> List[Dict]:
+    rooms = client.select("rooms", "*", [_rest_ilike_any(("room_id", "name", "building"), params[0])])
+    if rooms:
+        ids = ",".join(_rest_quote(room["room_id"]) for room in rooms)
+        counts = Counter(row["room_id"] for row in client.select("sensors", "room_id", [("room_id", f"in.({ids})")]))
+        for room in rooms:
+            room["sensor_count"] = counts[room["room_id"]]
+    return rooms
+
+
+def _rest_rollup_series(agg: str, by_room: bool):
+    """rollups.series_*: PostgREST không GROUP BY → đọc bucket rồi gộp SUM/AVG tại chỗ"""
+    def handler(client: PostgRESTClient, params: Tuple) -> List[Dict]:
+        filters = [("resolution", f"eq.{params[0]}"), ("sensor_type", f"eq.{params[1]}"), ("bucket_start", f"gte.{params[2]}")]
+        if by_room:
+            filters.append(("room_id", f"eq.{params[3]}"))
+        buckets: Dict[int, List[float]] = defaultdict(list)
+        for row in client.select("sensor_rollups", "bucket_start,sum_value,count", filters, "bucket_start"):
+            buckets[row["bucket_start"]].append(row["sum_value"] / row["count"])
+        return [{"bucket_start": bucket, "value": sum(values) if agg == "sum" else sum(values) / len(values)}
+                for bucket, values in buckets.items()]
+    return handler
+
+
+def _rest_rollup_buckets(client: PostgRESTClient, params: Tuple) -> List[Dict]:
+    """rollups.buckets: gộp sum/min/max/count theo bucket_start tại chỗ"""
+    filters = [("resolution", f"eq.{params[0]}"), ("sensor_type", f"eq.{params[1]}"), ("bucket_start", f"gte.{params[2]}")]
+    groups: Dict[int, List[float]] = {}
+    for row in client.select("sensor_rollups", "bucket_start,sum_value,min_value,max_value,count", filters):
+        a = groups.get(row["bucket_start"])
+        if a is None:
+            groups[row["bucket_start"]] = [row["sum_value"], row["min_value"], row["max_value"], row["count"]]
+        else:
+            a[0] += row["sum_value"]
+            a[1] = min(a[1], row["min_value"])
+            a[2] = max(a[2], row["max_value"])
+            a[3] += row["count"]
+    return [{"bucket_start": bucket, "sum": a[0], "min": a[1], "max": a[2], "count": a[3]} for bucket, a in groups.items()]
+
 
-log_handlers = [logging.StreamHandler(sys.stdout)]
-if not IS_VERCEL:
-    try:
-        log_handlers.append(logging.FileHandler('ecoschool_ultimate.log', encoding='utf-8'))
-    except:
-        pass
+def _rest_rollup_energy(client: PostgRESTClient, params: Tuple) -> List[Dict]:
+    """rollups.energy[_room]: gộp (room_id, bucket_start) tại chỗ"""
+    filters = [("resolution", f"eq.{params[0]}"), ("sensor_type", "eq.power"), ("bucket_start", f"gte.{params[1]}")]
+    if len(params) > 2:
+        filters.append(("room_id", f"eq.{params[2]}"))
+    groups: Dict[Tuple, float] = defaultdict(float)
+    for row in client.select("sensor_rollups", "room_id,bucket_start,sum_value,count", filters):
+        groups[(row["room_id"], row["bucket_start"])] += row["sum_value"] / row["count"]
+    return [{"room_id": room_id, "bucket_start": bucket, "value": watts} for (room_id, bucket), watts in groups.items()]
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(name)s: %(message)s',
-    handlers=log_handlers
-)
-# Ensure stdout is utf-8
-if sys.platform.startswith('win'):
-    sys.stdout.reconfigure(encoding='utf-8')
-logger = logging.getLogger("EcoSchool")
 
-app = FastAPI(title="EcoSchool AI Ultimate", version="12.0")
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+def _rest_rollup_energy_sensors(client: PostgRESTClient, params: Tuple) -> List[Dict]:
+    """rollups.energy_sensors: PostgREST không tính biểu thức → chia sum_value / count tại chỗ"""
+    filters = [("resolution", f"eq.{params[0]}"), ("sensor_type", "eq.power"),
+               ("bucket_start", f"gte.{params[1]}"), ("bucket_start", f"lt.{params[2]}")]
+    return [{"sensor_id": row["sensor_id"], "room_id": row["room_id"], "bucket_start": row["bucket_start"],
+             "value": row["sum_value"] / row["count"]}
+            for row in client.select("sensor_rollups", "sensor_id,room_id,bucket_start,sum_value,count", filters)]
 
-# Load HTML files with absolute paths
-BASE_DIR = Path(__file__).parent
 
-def load_html(filename: str) -> str:
-    path = BASE_DIR / filename
-    if path.exists():
-        return path.read_text(encoding='utf-8')
-    logger.error(f"❌ HTML file not found: {path}")
-    return ""
+def _rest_rollup_rooms(client: PostgRESTClient, params: Tuple) -> List[Dict]:
+    """rollups.rooms: gộp sum / min / max / count theo (room_id, sensor_type) tại chỗ"""
+    filters = [("resolution", f"eq.{params[0]}"), ("bucket_start", f"gte.{params[1]}"),
+               ("sensor_type", "in.(power,occupancy,temperature)")]
+    groups: Dict[Tuple, List[float]] = {}
+    for row in client.select("sensor_rollups", "room_id,sensor_type,sum_value,min_value,max_value,count", filters):
+        acc = groups.get((row["room_id"], row["sensor_type"]))
+        if acc is None:
+            groups[(row["room_id"], row["sensor_type"])] = [row["sum_value"], row["min_value"], row["max_value"], row["count"]]
+        else:
+            acc[0] += row["sum_value"]
+            acc[1] = min(acc[1], row["min_value"])
+            acc[2] = max(acc[2], row["max_value"])
+            acc[3] += row["count"]
+    return [{"room_id": room_id, "sensor_type": sensor_type, "sum": a[0], "min": a[1], "max": a[2], "count": a[3]}
+            for (room_id, sensor_type), a in groups.items()]
 
-LOGIN_HTML = load_html("login.html")
-DASHBOARD_HTML = load_html("dashboard_ultimate.html")
 
-# Mount static files
-try:
-    app.mount("/assets", StaticFiles(directory=str(Path(__file__).parent / "assets")), name="assets")
-except:
-    pass
+def _rest_occupancy(rollup: bool, by_room: bool):
+    """rollups.occupancy[_room] / readings.occupancy[_room]: gộp sum / count theo (room_id, sensor_id) tại chỗ"""
+    def handler(client: PostgRESTClient, params: Tuple) -> List[Dict]:
+        if rollup:
+            table, columns = "sensor_rollups", "room_id,sensor_id,sum_value,count"
+            filters = [("resolution", f"eq.{params[0]}"), ("sensor_type", "eq.occupancy"), ("bucket_start", f"gte.{params[1]}")]
+        else:
+            table, columns = "sensor_readings", "room_id,sensor_id,value"
+            filters = [("sensor_type", "eq.occupancy"), ("timestamp", f"gt.{params[0]}")]
+        if by_room:
+            filters.append(("room_id", f"eq.{params[-1]}"))
+        groups: Dict[Tuple, List[float]] = defaultdict(lambda: [0.0, 0])
+        for row in client.select(table, columns, filters):
+            acc = groups[(row["room_id"], row["sensor_id"])]
+            if rollup:
+                acc[0] += row["sum_value"]
+                acc[1] += row["count"]
+            elif row["value"] is not None:
+                acc[0] += row["value"]
+                acc[1] += 1
+        return [{"room_id": room_id, "sensor_id": sensor_id, "sum": a[0], "count": a[1]}
+                for (room_id, sensor_id), a in groups.items()]
+    return handler
+
+
+# Cùng tên với SQL_STATEMENTS (chạy qua QueryLayer dialect "supabase"); timestamp dạng ISO (timestamptz)
+SUPABASE_STATEMENTS: Dict[str, Any] = {
+    # Users
+    "users.verify": lambda c, p: c.select("users", "role,language", [("username", f"eq.{p[0]}"), ("password_hash", f"eq.{p[1]}")]),
+    "users.verify_full": lambda c, p: c.select("users", "*", [("username", f"eq.{p[0]}"), ("password_hash", f"eq.{p[1]}")]),
+    # Rooms
+    "rooms.get": lambda c, p: c.select("rooms", "*", [("room_id", f"eq.{p[0]}")]),
+    "rooms.name": lambda c, p: c.select("rooms", "room_id,name", [("room_id", f"eq.{p[0]}")]),
+    "rooms.active": lambda c, p: c.select("rooms", "*", [("is_active", "eq.true")], "created_at.desc"),
+    "rooms.insert": RestInsert("rooms", ("room_id", "name", "area", "floor", "building", "created_at"), {"is_active": True}),
+    "rooms.delete": lambda c, p: c.delete("rooms", [("room_id", f"eq.{p[0]}")]),
+    "rooms.search": _rest_rooms_search,
+    # Enterprise
+    "buildings.insert": RestInsert("buildings", ("building_id", "name", "address", "total_floors", "manager_name", "created_at"), {"is_active": True}),
+    "floors.insert": RestInsert("floors", ("floor_id", "building_id", "floor_number", "name", "energy_target"), {"safety_status": "SAFE"}),
+    "floors.all": lambda c, p: c.select("floors", "floor_id,building_id,floor_number,name,energy_target"),
+    "schedules.insert": RestInsert("enterprise_schedules", ("room_id", "event_name", "start_time", "end_time", "min_temp", "max_temp", "priority"), {"is_completed": False}),
+    "schedules.upcoming": lambda c, p: c.select("enterprise_schedules", "*", [("is_completed", "eq.false")], "start_time.asc", p[0]),
+    # Sensors
+    "sensors.with_room": lambda c, p: _rest_room_name(c.select("sensors", "sensor_id,room_id,sensor_type,unit,last_value,last_update,status,rooms(name)", order="sensor_id")),
+    "sensors.by_room": lambda c, p: c.select("sensors", "*", [("room_id", f"eq.{p[0]}")]),
+    "sensors.insert": RestInsert("sensors", ("sensor_id", "room_id", "sensor_type", "unit", "last_update"), {"last_value": 0, "status": "WAITING"}),
+    "sensors.delete": lambda c, p: c.delete("sensors", [("sensor_id", f"eq.{p[0]}")]),
+    "sensors.delete_by_room": lambda c, p: c.delete("sensors", [("room_id", f"eq.{p[0]}")]),
+    "sensors.update_last": RestUpdate("sensors", ("last_value", "last_update"), "sensor_id", {"status": "ONLINE"}),
+    "sensors.search": lambda c, p: _rest_room_name(c.select("sensors", "*,rooms(name)", [_rest_ilike_any(("sensor_id", "sensor_type"), p[0])])),
+    # IoT devices
+    "devices.insert": RestInsert("iot_devices", ("device_id", "room_id", "device_type", "device_name", "last_update"), {"status": "OFF", "last_command": ""}),
+    "devices.control": lambda c, p: c.update("iot_devices", {"status": p[0], "last_command": p[1], "last_update": p[2]}, [("device_id", f"eq.{p[3]}")]),
+    "devices.by_room": lambda c, p: c.select("iot_devices", "*", [("room_id", f"eq.{p[0]}")]),
+    "devices.delete_by_room": lambda c, p: c.delete("iot_devices", [("room_id", f"eq.{p[0]}")]),
+    "devices.with_room": lambda c, p: _rest_room_name(c.select("iot_devices", "*,rooms(name)", order="last_update.desc")),
+    "devices.search": lambda c, p: _rest_room_name(c.select("iot_devices", "*,rooms(name)", [_rest_ilike_any(("device_id", "device_name", "device_type"), p[0])])),
+    # Readings & rollups
+    "readings.insert": RestInsert("sensor_readings", ("sensor_id", "value", "timestamp", "quality", "room_id", "sensor_type")),
+    "readings.series": lambda c, p: c.select("sensor_readings", "timestamp,value", [("sensor_type", f"eq.{p[0]}"), ("timestamp", f"gt.{p[1]}")], "timestamp"),
+    "readings.series_room": lambda c, p: c.select("sensor_readings", "timestamp,value", [("sensor_type", f"eq.{p[0]}"), ("timestamp", f"gt.{p[1]}"), ("room_id", f"eq.{p[2]}")], "timestamp"),
+    "readings.power_since": lambda c, p: c.select("sensor_readings", "sensor_id,value,timestamp", [("sensor_type", "eq.power"), ("timestamp", f"gte.{p[0]}")]),
+    "readings.expired": lambda c, p: c.select("sensor_readings", "id,sensor_id,timestamp,value", [("timestamp", f"lt.{p[0]}")], "id", p[1]),
+    "readings.delete_expired": lambda c, p: c.delete("sensor_readings", [("id", f"lte.{p[0]}"), ("timestamp", f"lt.{p[1]}")]),
+    "rollups.series_sum": _rest_rollup_series("sum", False),
+    "rollups.series_avg": _rest_rollup_series("avg", False),
+    "rollups.series_room_sum": _rest_rollup_series("sum", True),
+    "rollups.series_room_avg": _rest_rollup_series("avg", True),
+    "rollups.rooms": _rest_rollup_rooms,
+    "rollups.energy": _rest_rollup_energy,
+    "rollups.buckets": _rest_rollup_buckets,
+    "rollups.energy_sensors": _rest_rollup_energy_sensors,
+    "rollups.energy_room": _rest_rollup_energy,
+    "readings.rooms": lambda c, p: c.select("sensor_readings", "room_id,sensor_type,value", [("timestamp", f"gt.{p[0]}"), ("sensor_type", "in.(power,occupancy,temperature)")]),
+    "rollups.occupancy": _rest_occupancy(True, False),
+    "rollups.occupancy_room": _rest_occupancy(True, True),
+    "readings.occupancy": _rest_occupancy(False, False),
+    "readings.occupancy_room": _rest_occupancy(False, True),
+    "rollups.upsert": RestRpc("ecoschool_upsert_rollups", ("resolution", "bucket_start", "sensor_id", "room_id", "sensor_type",
+                                                          "min_value", "max_value", "sum_value", "count", "last_value", "last_ts")),
+    # Chat & knowledge
+    "chat.insert": RestInsert("chat_history", ("user_msg", "ai_response", "timestamp", "language", "context")),
+    "chat.recent": lambda c, p: c.select("chat_history", "*", order="timestamp.desc", limit=p[0]),
+    "knowledge.insert": RestInsert("ai_knowledge", ("topic", "content", "source", "timestamp", "importance")),
+    # AI decisions (gom lô), safety, alerts
+    "decisions.upsert": RestInsert("ai_decisions", ("id", "agent_name", "decision_type", "target", "action", "reasoning",
+                                                    "confidence", "timestamp", "status", "approved_by"), on_conflict="id", deferred=True),
+    "decisions.insert": RestInsert("ai_decisions", ("id", "agent_name", "decision_type", "target", "action", "reasoning",
+                                                    "confidence", "timestamp", "status"), deferred=True),
+    "decisions.recent": lambda c, p: c.select("ai_decisions", "*", order="timestamp.desc", limit=p[0]),
+    "decisions.count_since": lambda c, p: [{"count": c.count("ai_decisions", [("timestamp", f"gt.{p[0]}")])}],
+    "safety.insert": RestInsert("safety_watchdog_logs", ("location_id", "risk_level", "event_type", "description", "automated_action", "timestamp")),
+    "alerts.upsert": RestInsert("alerts", ("alert_id", "severity", "title", "message", "location", "timestamp", "acknowledged", "resolved"), on_conflict="alert_id"),
+    "alerts.active": lambda c, p: c.select("alerts", "*", [("resolved", "eq.0")], "timestamp.desc"),
+    "alerts.by_severity_since": lambda c, p: [{"severity": severity, "count": count} for severity, count in
+                                              Counter(row["severity"] for row in c.select("alerts", "severity", [("timestamp", f"gt.{p[0]}")])).items()]
+}
+
+# ============================================================================
+# ⚡ ENERGY LEDGER (kWh: room → floor → building → campus)
+# ============================================================================
+
+def trapezoid_energy(ts: List[float], watts: List[float], max_gap: float = ENERGY_MAX_GAP) -> Tuple[Dict[int, float], int]:
+    """
+    Tích phân hình thang chuỗi power (W, timestamp tăng dần) → kWh gộp theo ngày địa phương của điểm cuối mỗi khoảng
+    Khoảng dài hơn max_gap bị bỏ (mất dữ liệu ≠ tiêu thụ). Trả về ({ngày (số ngày từ epoch): kWh}, số khoảng bị bỏ)
+    """
+    if len(ts) < 2:
+        return {}, 0
+    offset = time.localtime(ts[-1]).tm_gmtoff
+    if HAS_NUMPY:
+        t = np.asarray(ts, dtype=float)
+        w = np.asarray(watts, dtype=float)
+        dt = np.diff(t)
+        ok = dt <= max_gap
+        kwh = np.where(ok, (w[1:] + w[:-1]) * 0.5 * dt, 0.0) / 3.6e6
+        days, inverse = np.unique(((t[1:] + offset) // 86400).astype(np.int64), return_inverse=True)
+        return dict(zip(days.tolist(), np.bincount(inverse, weights=kwh).tolist())), int((~ok).sum())
+    per_day: Dict[int, float] = {}
+    gaps = 0
+    for i in range(1, len(ts)):
+        dt = ts[i] - ts[i - 1]
+        if dt > max_gap:
+            gaps += 1
+            continue
+        day = int((ts[i] + offset) // 86400)
+        per_day[day] = per_day.get(day, 0.0) + (watts[i] + watts[i - 1]) * 0.5 * dt / 3.6e6
+    return per_day, gaps
+
+class EnergyLedger:
+    """
+    Điện năng tiêu thụ theo ngày, cập nhật tăng dần khi ingest:
+    - Mỗi sensor power giữ các điểm trong ENERGY_LATE_WINDOW cuối → lô mới chỉ tích phân phần mới (hình thang);
+      reading đến muộn được chèn giữa 2 điểm kề: trừ khoảng cũ, cộng 2 khoảng mới
+    - kWh được cộng ngay vào sensor / room / floor / building / campus → báo cáo không đọc lại reading
+    - Các ngày trước được nạp lại từ sensor_rollups lúc khởi động (load_rollups)
+    - floor khớp theo (rooms.building, rooms.floor) = (floors.building_id, floors.floor_number)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.recent: Dict[str, List[Tuple[float, float]]] = {}  # sensor → [(timestamp, W)] tăng dần, điểm cuối = mới nhất
+        self.trimmed = set()  # sensor đã bỏ điểm cũ khỏi recent (không biết điểm trước recent[0])
+        self.rooms: Dict[str, Tuple[str, str]] = {}  # room_id → (building, floor)
+        self.floors: Dict[Tuple[str, str], Dict] = {}  # (building, floor) → floor_id, name, energy_target
+        self.totals: Dict[str, Dict[Tuple, float]] = {}  # 'YYYY-MM-DD' → {("room", id) / ("floor", b, f) / ...: kWh}
+        self.stats = {"points": 0, "intervals": 0, "gaps": 0, "out_of_order": 0, "late_credited": 0,
+                      "late_dropped": 0, "duplicates": 0}
+
+    def set_room(self, room_id: str, building, floor):
+        with self._lock:
+            self.rooms[room_id] = (str(building), str(floor))
+
+    def remove_room(self, room_id: str):
+        with self._lock:
+            self.rooms.pop(room_id, None)
+
+    def set_floor(self, floor_id: str, building_id, floor_number, name: str, energy_target: Optional[float]):
+        with self._lock:
+            self.floors[(str(building_id), str(floor_number))] = {
+                "floor_id": floor_id, "name": name, "energy_target": energy_target}
+
+    def add(self, rows: List[Tuple], sensors: Dict[str, Dict]) -> float:
+        """Tích phân các reading (sensor_id, value, timestamp, ...) của sensor power → kWh đã cộng thêm"""
+        points: Dict[str, List[Tuple[float, float]]] = defaultdict(list)
+        for row in rows:
+            entry = sensors.get(row[0])
+            if entry and entry['sensor_type'] == 'power':
+                points[row[0]].append((float(row[2]), float(row[1])))
+        added = 0.0
+        with self._lock:
+            for sensor_id, series in points.items():
+                series.sort()
+                self.stats["points"] += len(series)
+                room_id = sensors[sensor_id]['room_id']
+                recent = self.recent.setdefault(sensor_id, [])
+                edge, late = recent[-1:], []
+                if recent:
+                    late = [p for p in series if p[0] <= edge[0][0]]
+                    series = [p for p in series if p[0] > edge[0][0]]
+                    self.stats["out_of_order"] += len(late)
+                segment = edge + series
+                per_day, gaps = trapezoid_energy([p[0] for p in segment], [p[1] for p in segment])
+                self.stats["intervals"] += max(len(segment) - 1, 0)
+                self.stats["gaps"] += gaps
+                for day, kwh in per_day.items():
+                    self._credit(datetime.fromtimestamp(day * 86400, timezone.utc).strftime('%Y-%m-%d'),
+                                 sensor_id, room_id, kwh)
+                    added += kwh
+                recent.extend(series)
+                for point in late:
+                    added += self._insert_late(sensor_id, room_id, recent, point)
+                # Chỉ giữ điểm trong cửa sổ muộn (+ 1 điểm ngay trước cửa sổ làm điểm kề)
+                cut = bisect.bisect_left(recent, (recent[-1][0] - ENERGY_LATE_WINDOW,)) - 1
+                if cut > 0:
+                    del recent[:cut]
+                    self.trimmed.add(sensor_id)
+        return added
+
+    def _interval(self, a: Tuple[float, float], b: Tuple[float, float]) -> Optional[Tuple[str, float]]:
+        """(ngày địa phương của điểm cuối, kWh) của 1 khoảng hình thang; None nếu dài hơn ENERGY_MAX_GAP"""
+        dt = b[0] - a[0]
+        if dt > ENERGY_MAX_GAP:
+            return None
+        return datetime.fromtimestamp(b[0]).strftime('%Y-%m-%d'), (a[1] + b[1]) * 0.5 * dt / 3.6e6
+
+    def _insert_late(self, sensor_id: str, room_id: str, recent: List[Tuple[float, float]],
+                     point: Tuple[float, float]) -> float:
+        """Chèn 1 reading muộn vào recent: trừ khoảng (trước, sau) đã tính, cộng (trước, điểm) + (điểm, sau)"""
+        i = bisect.bisect_left(recent, (point[0],))
+        if recent[i][0] == point[0]:
+            self.stats["duplicates"] += 1
+            return 0.0
+        if i == 0 and sensor_id in self.trimmed:
+            # Cũ hơn cửa sổ: không biết điểm kề phía trước
+            self.stats["late_dropped"] += 1
+            return 0.0
+        before = recent[i - 1] if i > 0 else None
+        after = recent[i]
+        added = 0.0
+        changes = []
+        if before:
+            old = self._interval(before, after)
+            if old:
+                changes.append((old[0], -old[1]))
+            changes.append(self._interval(before, point))
+        changes.append(self._interval(point, after))
+        for change in changes:
+            if change:
+                self._credit(change[0], sensor_id, room_id, change[1])
+                added += change[1]
+        recent.insert(i, point)
+        self.stats["late_credited"] += 1
+        return added
+
+    def load_rollups(self, rows: List[Tuple]):
+        """
+        Nạp kWh các ngày trước từ rollup ENERGY_ROLLUP: (sensor_id, room_id, bucket_start, W trung bình)
+        → hình thang qua điểm giữa các bucket (bucket lẻ / đầu cuối không bị tính nguyên bucket)
+        """
+        series: Dict[str, List[Tuple[float, float]]] = defaultdict(list)
+        rooms: Dict[str, str] = {}
+        for sensor_id, room_id, bucket_start, watts in rows:
+            if watts is not None:
+                series[sensor_id].append((bucket_start + ENERGY_ROLLUP / 2, watts))
+                rooms[sensor_id] = room_id
+        with self._lock:
+            for sensor_id, points in series.items():
+                points.sort()
+                per_day, _ = trapezoid_energy([p[0] for p in points], [p[1] for p in points],
+                                              max(ENERGY_MAX_GAP, ENERGY_ROLLUP))
+                for day, kwh in per_day.items():
+                    self._credit(datetime.fromtimestamp(day * 86400, timezone.utc).strftime('%Y-%m-%d'),
+                                 sensor_id, rooms[sensor_id], kwh)
+
+    def _credit(self, day: str, sensor_id: str, room_id: str, kwh: float):
+        totals = self.totals.get(day)
+        if totals is None:
+            totals = self.totals[day] = defaultdict(float)
+            for old in sorted(self.totals)[:-ENERGY_KEEP_DAYS]:
+                del self.totals[old]
+        building, floor = self.rooms.get(room_id, ("None", "None"))
+        for key in (("sensor", sensor_id), ("room", room_id), ("floor", building, floor), ("building", building), ("campus",)):
+            totals[key] += kwh
+
+    def total(self, day: Optional[str] = None, room_ids=None) -> float:
+        """kWh của cả trường (hoặc các phòng room_ids) trong ngày"""
+        totals = self.totals.get(day or datetime.now().strftime('%Y-%m-%d'), {})
+        if room_ids is None:
+            return totals.get(("campus",), 0.0)
+        return sum(totals.get(("room", room_id), 0.0) for room_id in room_ids)
+
+    def report(self, day: Optional[str] = None) -> Dict:
+        """Cây campus → building → floor → room (kWh, energy_target, tỉ lệ) của 1 ngày"""
+        day = day or datetime.now().strftime('%Y-%m-%d')
+        with self._lock:
+            totals = dict(self.totals.get(day, {}))
+            rooms = dict(self.rooms)
+            floors = dict(self.floors)
+
+        def node(kwh: float, target: Optional[float]) -> Dict:
+            kwh = round(kwh, 3)
+            return {
+                "kwh": kwh,
+                "target": target,
+                "ratio": round(kwh / target, 3) if target else None,
+                "status": None if not target else ("OVER_TARGET" if kwh > target else "ON_TARGET")
+            }
+
+        tree: Dict[str, Dict] = {}
+        for building, floor in floors:
+            tree.setdefault(building, {}).setdefault(floor, [])
+        for room_id, (building, floor) in rooms.items():
+            tree.setdefault(building, {}).setdefault(floor, []).append(room_id)
+        for key in totals:
+            if key[0] == "floor":
+                tree.setdefault(key[1], {}).setdefault(key[2], [])
+
+        buildings = []
+        campus_target = 0.0
+        for building in sorted(tree):
+            floor_nodes = []
+            building_target = 0.0
+            for floor in sorted(tree[building]):
+                info = floors.get((building, floor), {})
+                target = info.get("energy_target")
+                building_target += target or 0
+                floor_nodes.append({
+                    "floor": floor, "floor_id": info.get("floor_id"), "name": info.get("name"),
+                    **node(totals.get(("floor", building, floor), 0.0), target),
+                    "rooms": [{"room_id": room_id, "kwh": round(totals.get(("room", room_id), 0.0), 3)}
+                              for room_id in sorted(tree[building][floor])]
+                })
+            campus_target += building_target
+            buildings.append({"building": building, **node(totals.get(("building", building), 0.0), building_target or None),
+                              "floors": floor_nodes})
+        return {
+            "day": day,
+            "campus": node(totals.get(("campus",), 0.0), campus_target or None),
+            "buildings": buildings,
+            "sensors": {key[1]: round(kwh, 3) for key, kwh in totals.items() if key[0] == "sensor"}
+        }
+
+    def get_stats(self) -> Dict:
+        return {**self.stats, "sensors": len(self.recent), "days": sorted(self.totals), "max_gap": ENERGY_MAX_GAP,
+                "late_window": ENERGY_LATE_WINDOW}
+
+# ============================================================================
+# 📣 EVENT BUS (push-on-write trong process)
+# ============================================================================
+
+BusEvent = namedtuple("BusEvent", "topic data timestamp")
+
+class EventSubscription:
+    """Hàng đợi sự kiện của 1 subscriber (lọc theo prefix topic, đầy thì bỏ sự kiện cũ nhất)"""
+
+    def __init__(self, topics: Tuple[str, ...], maxsize: int, name: str):
+        self.topics = tuple(topics)
+        self.name = name
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def matches(self, topic: str) -> bool:
+        return not self.topics or topic.startswith(self.topics)
+
+    def put(self, event: BusEvent):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[BusEvent]:
+        """Chờ sự kiện kế tiếp; None nếu hết timeout"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def drain(self) -> List[BusEvent]:
+        """Lấy hết sự kiện đang chờ (không chặn)"""
+        events = []
+        while not self.queue.empty():
+            events.append(self.queue.get_nowait())
+        return events
+
+class EventBus:
+    """
+    Bus sự kiện trong process:
+    - Manager publish sau mỗi thao tác ghi (reading, device, alert, decision, room/sensor CRUD)
+    - publish() gọi được từ thread bất kỳ, chuyển về event loop bằng call_soon_threadsafe
+    - Subscriber (/ws hub, agents) nhận qua asyncio.Queue riêng, không chặn publisher
+    - Không có subscriber thì publish gần như không tốn gì
+    """
+
+    def __init__(self, queue_size: int = EVENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.subscribers: List[EventSubscription] = []
+        self.listeners: List[Callable[[str, Dict], None]] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.stats = {"published": 0, "delivered": 0, "by_topic": Counter()}
+
+    def subscribe(self, topics: Tuple[str, ...] = (), name: str = "") -> EventSubscription:
+        """Đăng ký nhận sự kiện có topic bắt đầu bằng 1 trong các prefix (rỗng = tất cả); gọi trong event loop"""
+        self._loop = asyncio.get_running_loop()
+        sub = EventSubscription(topics, self.queue_size, name)
+        self.subscribers = self.subscribers + [sub]
+        return sub
+
+    def unsubscribe(self, sub: EventSubscription):
+        self.subscribers = [s for s in self.subscribers if s is not sub]
+
+    def listen(self, callback: Callable[[str, Dict], None]):
+        """Callback đồng bộ (topic, data) chạy ngay trong thread publish → xong trước khi request ghi trả về"""
+        self.listeners = self.listeners + [callback]
+
+    def publish(self, topic: str, **data):
+        """Phát sự kiện (vd. "device.control", device_id=..., status=...)"""
+        self.stats["published"] += 1
+        self.stats["by_topic"][topic] += 1
+        for callback in self.listeners:
+            callback(topic, data)
+        loop = self._loop
+        if not self.subscribers or loop is None or loop.is_closed():
+            return
+        event = BusEvent(topic, data, time.time())
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._dispatch(event)
+        else:
+            try:
+                loop.call_soon_threadsafe(self._dispatch, event)
+            except RuntimeError:
+                pass  # loop đã đóng (shutdown)
+
+    def _dispatch(self, event: BusEvent):
+        for sub in self.subscribers:
+            if sub.matches(event.topic):
+                sub.put(event)
+                self.stats["delivered"] += 1
+
+    def get_stats(self) -> Dict:
+        return {
+            "published": self.stats["published"],
+            "delivered": self.stats["delivered"],
+            "by_topic": dict(self.stats["by_topic"]),
+            "subscribers": [{"name": s.name, "topics": list(s.topics), "pending": s.queue.qsize(), "dropped": s.dropped}
+                            for s in self.subscribers]
+        }
+
+event_bus = EventBus()
+
+# ============================================================================
+# 🗂️ RESPONSE CACHE (TTL + LRU, invalidate theo tag)
+# ============================================================================
+
+class ResponseCache:
+    """
+    Cache response GET trong RAM:
+    - Khóa = endpoint + query params; TTL riêng từng endpoint; tổng số entry giới hạn (LRU)
+    - Entry nhớ version các tag lúc tạo; thao tác ghi bump tag (qua event bus) → entry cũ hết hiệu lực ngay
+    - Nhiều request cùng khóa lúc miss chỉ chạy handler 1 lần
+    - Lưu body JSON đã encode → hit không query, không serialize lại
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttls: Dict[str, float] = CACHE_TTLS,
+                 event_tags: Dict[str, Tuple[str, ...]] = CACHE_EVENT_TAGS):
+        self.max_entries = max_entries
+        self.ttls = ttls
+        self.event_tags = event_tags
+        self._lock = threading.Lock()
+        self.entries: OrderedDict = OrderedDict()  # key → (hết hạn (monotonic), version các tag, status, body)
+        self.versions: Dict[str, int] = defaultdict(int)
+        self._inflight: Dict[Tuple, asyncio.Future] = {}
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "invalidated": 0, "evictions": 0, "coalesced": 0}
+        self.bumps: Counter = Counter()
+        self.endpoints: Dict[str, Counter] = defaultdict(Counter)
+
+    def on_event(self, topic: str, data: Dict):
+        for prefix, tags in self.event_tags.items():
+            if topic.startswith(prefix):
+                self.bump(*tags)
+
+    def bump(self, *tags: str):
+        """Tăng version các tag → mọi entry gắn tag đó hết hiệu lực (O(1), không duyệt entry)"""
+        with self._lock:
+            for tag in tags:
+                self.versions[tag] += 1
+                self.bumps[tag] += 1
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def _lookup(self, key: Tuple) -> Optional[Tuple[int, bytes]]:
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, versions, status, body = entry
+            if time.monotonic() >= expires:
+                self.stats["expired"] += 1
+            elif any(self.versions[tag] != version for tag, version in versions):
+                self.stats["invalidated"] += 1
+            else:
+                self.entries.move_to_end(key)
+                return status, body
+            del self.entries[key]
+            return None
+
+    def _store(self, key: Tuple, versions: Tuple, ttl: float, status: int, body: bytes):
+        with self._lock:
+            if any(self.versions[tag] != version for tag, version in versions):
+                return  # có ghi trong lúc tính → không lưu kết quả có thể đã cũ
+            self.entries[key] = (time.monotonic() + ttl, versions, status, body)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def cached(self, endpoint: str, tags: Tuple[str, ...] = ()):
+        """Decorator cho endpoint GET (đặt dưới @app.get); khóa lấy từ tham số của endpoint"""
+        ttl = float(self.ttls.get(endpoint, 0))
+
+        def decorator(func):
+            @wraps(func)
+            async def wrapper(**kwargs):
+                if ttl <= 0 or self.max_entries <= 0:
+                    return await func(**kwargs)
+                key = (endpoint, tuple(sorted(kwargs.items())))
+                hit = self._lookup(key)
+                if hit is None and key in self._inflight:
+                    # Request khác đang tính cùng khóa → chờ kết quả đó
+                    self.stats["coalesced"] += 1
+                    hit = await asyncio.shield(self._inflight[key])
+                if hit is not None:
+                    self.stats["hits"] += 1
+                    self.endpoints[endpoint]["hits"] += 1
+                    return Response(hit[1], status_code=hit[0], media_type="application/json", headers={"X-Cache": "HIT"})
+
+                self.stats["misses"] += 1
+                self.endpoints[endpoint]["misses"] += 1
+                with self._lock:
+                    versions = tuple((tag, self.versions[tag]) for tag in tags)
+                future = asyncio.get_running_loop().create_future()
+                self._inflight[key] = future
+                result = None
+                try:
+                    response = await func(**kwargs)
+                    if not isinstance(response, Response):
+                        response = JSONResponse(content=jsonable_encoder(response))
+                    if response.status_code == 200:
+                        result = (response.status_code, bytes(response.body))
+                        self._store(key, versions, ttl, *result)
+                    response.headers["X-Cache"] = "MISS"
+                    return response
+                finally:
+                    # Lỗi / status khác 200 → request đang chờ tự gọi handler (result None)
+                    self._inflight.pop(key, None)
+                    future.set_result(result)
+            return wrapper
+        return decorator
+
+    def get_stats(self) -> Dict:
+        total = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": round(self.stats["hits"] / total, 3) if total else None,
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttls": self.ttls,
+            "tag_versions": dict(self.versions),
+            "bumps": dict(self.bumps),
+            "endpoints": {name: dict(counts) for name, counts in self.endpoints.items()}
+        }
+
+response_cache = ResponseCache()
+event_bus.listen(response_cache.on_event)
 
 # ============================================================================
 # 🗄️ ULTIMATE DATABASE MANAGER (MySQL + SQLite Fallback)
@@ -157,29 +3043,52 @@ class UltimateDatabaseManager:
     def __init__(self):
         self.use_supabase = False
         self.use_mysql = False
-        self.supabase_client: Optional[Client] = None
+        self.rest: Optional[PostgRESTClient] = None
         self.connection = None
         self.db_type = "SQLite"
+        self.sensor_state = SensorStateCache()
+        self.energy = EnergyLedger()
+        # Vercel không chạy task nền → ghi thẳng bảng sensors
+        self.sensor_state_write_through = IS_VERCEL
+        self.compressor = ReadingCompressor(COMPRESSION_PROFILES) if INGEST_COMPRESSION else None
+        self.archive = ReadingArchive(os.getenv('ARCHIVE_DIR') or ("/tmp/ecoschool_archive" if IS_VERCEL else "ecoschool_archive"))
+        self.partitions: Optional[SQLitePartitionManager] = None
+        self.engine: Optional[SQLiteEngine] = None
+        self.mysql_pool: Optional[MySQLPool] = None
+        self.replicas: Optional[MySQLReplicaRouter] = None
         self._init_connection()
+        if self.use_supabase:
+            self.sql = QueryLayer(self, "supabase", SUPABASE_STATEMENTS)
+        else:
+            self.sql = QueryLayer(self, "mysql" if self.use_mysql else "sqlite")
         self._init_schema()
+        self._load_sensor_state()
+        if self.use_mysql and MYSQL_REPLICAS:
+            # Sau khi nạp sensor state từ primary → các lần đọc sau mới chia sang replica
+            self.replicas = MySQLReplicaRouter(MYSQL_REPLICAS, MYSQL_CONFIG)
+            logger.info(f"🔀 MySQL read replicas: {len(self.replicas.replicas)}/{len(MYSQL_REPLICAS)} online")
+        if self.engine and SQLITE_PARTITIONING in ("day", "week"):
+            partition_dir = os.getenv('PARTITION_DIR') or ("/tmp/ecoschool_partitions" if IS_VERCEL else "ecoschool_partitions")
+            self.partitions = SQLitePartitionManager(partition_dir, SQLITE_PARTITIONING)
+            self.engine.autocommit(self.partitions.upgrade_all)
+            logger.info(f"🧩 SQLite partitioning enabled ({SQLITE_PARTITIONING}, {len(self.partitions.keys())} partitions)")
+        self._load_energy()
     
     def _init_connection(self):
         """Khởi tạo kết nối database"""
-        # [ROBUST] Always initialize connection immediately to prevent NoneType error
         sqlite_path = "/tmp/ecoschool_ultimate.db" if IS_VERCEL else "ecoschool_ultimate.db"
-        self.connection = sqlite3.connect(sqlite_path, check_same_thread=False)
         # --- ƯU TIÊN 1: SUPABASE (CLOUD) ---
-        if HAS_SUPABASE and SUPABASE_URL and SUPABASE_KEY:
+        if SUPABASE_URL and SUPABASE_KEY:
             try:
-                self.supabase_client = create_client(SUPABASE_URL, SUPABASE_KEY)
+                self.rest = PostgRESTClient(SUPABASE_URL, SUPABASE_KEY)
+                self.rest.count("rooms")  # kiểm tra URL/key/schema trước khi chọn backend
+                self.connection = SupabaseConnectionProxy(self.rest)
                 self.use_supabase = True
                 self.db_type = "Supabase"
-                logger.info("✅ Connected to Supabase (Cloud Database)")
-                # Init local SQLite anyway as a safe scratchpad/fallback
-                sqlite_path = "/tmp/ecoschool_ultimate.db" if IS_VERCEL else "ecoschool_ultimate.db"
-                self.connection = sqlite3.connect(sqlite_path, check_same_thread=False)
+                logger.info(f"✅ Connected to Supabase (PostgREST {self.rest.host}, keep-alive pool {SUPABASE_POOL_SIZE})")
                 return
             except Exception as e:
+                self.rest = None
                 logger.warning(f"⚠️  Supabase connection failed: {e}")
         
         # --- ƯU TIÊN 2: MYSQL (LOCAL) ---
@@ -197,19 +3106,12 @@ class UltimateDatabaseManager:
                 cursor.close()
                 temp_conn.close()
                 
-                # Now connect to the database
-                self.connection = pymysql.connect(
-                    host=MYSQL_CONFIG["host"],
-                    user=MYSQL_CONFIG["user"],
-                    password=MYSQL_CONFIG["password"],
-                    database=MYSQL_CONFIG["database"],
-                    port=MYSQL_CONFIG.get("port", 3306),
-                    autocommit=True,
-                    cursorclass=pymysql.cursors.DictCursor
-                )
+                # Now connect to the database (pool)
+                self.mysql_pool = MySQLPool(MYSQL_CONFIG)
+                self.connection = MySQLConnectionProxy(self.mysql_pool)
                 self.use_mysql = True
                 self.db_type = "MySQL"
-                logger.info("✅ Connected to MySQL (HeidiSQL compatible via PyMySQL)")
+                logger.info(f"✅ Connected to MySQL (HeidiSQL compatible via PyMySQL, pool {MYSQL_POOL_MIN}-{MYSQL_POOL_MAX})")
             except Exception as e:
                 logger.warning(f"⚠️  MySQL connection failed: {e}")
                 logger.info("📁 Falling back to SQLite...")
@@ -217,38 +3119,124 @@ class UltimateDatabaseManager:
                 self.db_type = "SQLite"
         
         if not self.use_mysql:
-            sqlite_path = "/tmp/ecoschool_ultimate.db" if IS_VERCEL else "ecoschool_ultimate.db"
-            self.connection = sqlite3.connect(sqlite_path, check_same_thread=False)
-            logger.info(f"✅ Connected to SQLite ({sqlite_path})")
+            self._open_sqlite(sqlite_path)
+            logger.info(f"✅ Connected to SQLite ({sqlite_path}, {self.engine.journal_mode}, {self.engine.max_readers} readers)")
     
-    def _get_cursor(self):
-        """Get database cursor"""
-        if self.use_mysql:
+    def _open_sqlite(self, sqlite_path: str):
+        """SQLite qua SQLiteEngine: self.connection là proxy (SELECT → reader pool, ghi → luồng ghi)"""
+        self.engine = SQLiteEngine(sqlite_path)
+        self.connection = SQLiteConnectionProxy(self.engine)
+    
+    def _get_cursor(self, raw: bool = False, read_tables=None):
+        """
+        Get database cursor (MySQL: mượn từ pool, SQLite: proxy của SQLiteEngine, Supabase: cursor REST; raw=True → row dạng tuple).
+        read_tables: cursor chỉ để đọc các bảng này → có thể lấy từ read replica
+        """
+        if read_tables is not None and self.replicas:
+            pool = self.replicas.route(read_tables)
+            if pool is not None:
+                return PooledCursor(pool, raw)
+        return self.connection.cursor(raw)
+
+    def _transaction(self, fn, partition_keys: Optional[List[str]] = None, raw: bool = False):
+        """
+        Chạy fn(cursor) nguyên tử và trả kết quả của fn:
+        SQLite → 1 job trên luồng ghi (lỗi → rollback đúng các lệnh của fn), MySQL → begin/commit trên
+        1 connection mượn từ pool, Supabase → tuần tự (PostgREST không có transaction nhiều request)
+        partition_keys: phân vùng SQLite fn sẽ ghi → ATTACH trước khi transaction bắt đầu
+        raw: MySQL cursor trả row dạng tuple (fn đọc bằng self.sql.tuples)
+        """
+        if self.engine:
+            prepare = None
+            if partition_keys:
+                prepare = lambda conn: self.partitions.attach(conn, partition_keys, create=True)
+            return self.engine.write(lambda conn: fn(conn.cursor()), prepare)
+        with self._get_cursor(raw) as cursor, self.sql.track_writes() as written:
             try:
-                self.connection.ping(reconnect=True)
-            except:
-                self.connection = pymysql.connect(
-                    host=MYSQL_CONFIG["host"],
-                    user=MYSQL_CONFIG["user"],
-                    password=MYSQL_CONFIG["password"],
-                    database=MYSQL_CONFIG["database"],
-                    port=MYSQL_CONFIG.get("port", 3306),
-                    autocommit=True,
-                    cursorclass=pymysql.cursors.DictCursor
-                )
-            return self.connection.cursor()
-        else:
-            self.connection.row_factory = sqlite3.Row
-            return self.connection.cursor()
+                if self.use_mysql:
+                    self.connection.begin()
+                result = fn(cursor)
+                self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                raise
+        if written and self.replicas:
+            self.replicas.mark_write(written)
+        return result
     
+    # ========================================================================
+    # 🧱 VERSIONED SCHEMA MIGRATIONS
+    # ========================================================================
+
+    def _migrations(self) -> List[Tuple[int, str, Any, bool]]:
+        """Danh sách migration theo thứ tự (version, tên, hàm, tự chia transaction theo khối)"""
+        return [
+            (1, "baseline", self._migration_001_baseline, False),
+            (2, "sensor_rollups", self._migration_002_sensor_rollups, False),
+            (3, "readings_room_type_columns", self._migration_003_readings_room_type_columns, False),
+            (4, "readings_room_type_backfill", self._migration_004_readings_room_type_backfill, True),
+            (5, "readings_covering_indexes", self._migration_005_readings_covering_indexes, False),
+        ]
+
     def _init_schema(self):
-        """Khởi tạo schema database (Chỉ chạy cho MySQL/SQLite)"""
+        """
+        Chạy các migration chưa áp dụng (Chỉ chạy cho MySQL/SQLite)
+        SQLite: bước + dòng schema_migrations trong 1 transaction. MySQL: DDL tự commit →
+        mỗi bước tự kiểm tra schema hiện tại (chạy lại sau crash giữa chừng vẫn an toàn)
+        Bước backfill dữ liệu lớn tự commit từng khối (không giữ luồng ghi SQLite suốt migration)
+        """
         if self.use_supabase:
             logger.info("ℹ️  Supabase selected: Skipping local schema initialization.")
             return
             
         cursor = self._get_cursor()
         
+        if self.use_mysql:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INT PRIMARY KEY,
+                    name VARCHAR(100),
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+        else:
+            cursor.execute("""CREATE TABLE IF NOT EXISTS schema_migrations
+                            (version INTEGER PRIMARY KEY, name TEXT, applied_at REAL)""")
+        
+        # Tiến độ các job dài (backfill) → chạy lại thì tiếp tục, không làm lại từ đầu
+        if self.use_mysql:
+            cursor.execute("CREATE TABLE IF NOT EXISTS app_meta (name VARCHAR(100) PRIMARY KEY, value VARCHAR(255))")
+        else:
+            cursor.execute("CREATE TABLE IF NOT EXISTS app_meta (name TEXT PRIMARY KEY, value TEXT)")
+
+        cursor.execute("SELECT version FROM schema_migrations")
+        applied = {row['version'] for row in cursor.fetchall()}
+        
+        for version, name, step, chunked in self._migrations():
+            if version in applied:
+                continue
+            started = time.time()
+            if chunked and not self.use_mysql:
+                step(cursor)
+                self._transaction(lambda tx, version=version, name=name: tx.execute(
+                    "INSERT INTO schema_migrations VALUES (?, ?, ?)", (version, name, time.time())))
+            elif self.use_mysql:
+                step(cursor)
+                cursor.execute("INSERT IGNORE INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+            else:
+                def apply(tx, step=step, version=version, name=name):
+                    step(tx)
+                    tx.execute("INSERT INTO schema_migrations VALUES (?, ?, ?)", (version, name, time.time()))
+                self._transaction(apply)
+            applied.add(version)
+            logger.info(f"🧱 Migration {version:03d} {name} applied ({time.time() - started:.2f}s)")
+        
+        cursor.close()
+        self.schema_version = max(applied)
+        logger.info(f"✅ Database schema initialized ({self.db_type}, version {self.schema_version})")
+
+    def _migration_001_baseline(self, cursor):
+        """Schema gốc v12.0"""
         if self.use_mysql:
             # MySQL Schema
             cursor.execute("""
@@ -509,12 +3497,163 @@ class UltimateDatabaseManager:
             else:
                 cursor.execute("INSERT INTO users VALUES (?, ?, ?, ?, ?)",
                              ("funnylion1412", def_pass, "ADMIN", "vi", time.time()))
-                self.connection.commit()
         except:
             pass
-        
-        cursor.close()
-        logger.info(f"✅ Database schema initialized ({self.db_type})")
+
+    def _migration_002_sensor_rollups(self, cursor):
+        """Bảng rollup 1m/15m/1h/1d"""
+        if self.use_mysql:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS sensor_rollups (
+                    `resolution` INT,
+                    `bucket_start` BIGINT,
+                    `sensor_id` VARCHAR(50),
+                    `room_id` VARCHAR(50),
+                    `sensor_type` VARCHAR(50),
+                    `min_value` DOUBLE,
+                    `max_value` DOUBLE,
+                    `sum_value` DOUBLE,
+                    `count` INT,
+                    `last_value` DOUBLE,
+                    `last_ts` DOUBLE,
+                    PRIMARY KEY (`resolution`, `sensor_id`, `bucket_start`),
+                    INDEX `idx_rollup_type` (`resolution`, `sensor_type`, `bucket_start`),
+                    INDEX `idx_rollup_room` (`resolution`, `room_id`, `sensor_type`, `bucket_start`)
+                )
+            """)
+        else:
+            cursor.execute("""CREATE TABLE IF NOT EXISTS sensor_rollups
+                            (resolution INTEGER, bucket_start INTEGER, sensor_id TEXT, room_id TEXT,
+                             sensor_type TEXT, min_value REAL, max_value REAL, sum_value REAL,
+                             count INTEGER, last_value REAL, last_ts REAL,
+                             PRIMARY KEY (resolution, sensor_id, bucket_start))""")
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_rollup_type ON sensor_rollups(resolution, sensor_type, bucket_start)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_rollup_room ON sensor_rollups(resolution, room_id, sensor_type, bucket_start)')
+
+    def _schema_columns(self, cursor, table: str) -> set:
+        """Tên cột hiện có của bảng (migration kiểm tra trước khi ALTER)"""
+        if self.use_mysql:
+            cursor.execute("""SELECT COLUMN_NAME AS name FROM information_schema.COLUMNS
+                            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s""", (table,))
+        else:
+            cursor.execute(f"PRAGMA table_info({table})")
+        return {row['name'] for row in cursor.fetchall()}
+
+    def _schema_indexes(self, cursor, table: str) -> set:
+        """Tên index hiện có của bảng"""
+        if self.use_mysql:
+            cursor.execute("""SELECT DISTINCT INDEX_NAME AS name FROM information_schema.STATISTICS
+                            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s""", (table,))
+        else:
+            cursor.execute(f"PRAGMA index_list({table})")
+        return {row['name'] for row in cursor.fetchall()}
+
+    def _migration_003_readings_room_type_columns(self, cursor):
+        """Thêm room_id, sensor_type vào sensor_readings (bỏ JOIN sensors khi analytics)"""
+        columns = self._schema_columns(cursor, "sensor_readings")
+        if self.use_mysql:
+            missing = [f"ADD COLUMN `{name}` VARCHAR(50)" for name in ("room_id", "sensor_type") if name not in columns]
+            if missing:
+                cursor.execute(f"ALTER TABLE sensor_readings {', '.join(missing)}")
+        else:
+            for name in ("room_id", "sensor_type"):
+                if name not in columns:
+                    cursor.execute(f"ALTER TABLE sensor_readings ADD COLUMN {name} TEXT")
+
+    def _migration_004_readings_room_type_backfill(self, cursor):
+        """
+        Backfill room_id, sensor_type theo từng khối id, mỗi khối 1 transaction
+        → id cuối đã xong lưu ở app_meta cùng transaction, chạy lại sau crash thì tiếp tục từ đó
+        """
+        cursor.execute("SELECT MIN(id) as lo, MAX(id) as hi FROM sensor_readings")
+        row = cursor.fetchone()
+        if row['lo'] is None:
+            return
+        done = self.sql.scalar("meta.get", ("migration_004.backfilled_id",))
+        lo, hi = max(row['lo'] - 1, int(done or 0)), row['hi']
+        while lo < hi:
+            def backfill(tx, lo=lo):
+                if self.use_mysql:
+                    tx.execute("""
+                        UPDATE sensor_readings sr
+                        JOIN sensors s ON sr.sensor_id = s.sensor_id
+                        SET sr.room_id = s.room_id, sr.sensor_type = s.sensor_type
+                        WHERE sr.id > %s AND sr.id <= %s
+                    """, (lo, lo + MIGRATION_CHUNK))
+                else:
+                    tx.execute("""
+                        UPDATE sensor_readings SET
+                            room_id = (SELECT room_id FROM sensors WHERE sensors.sensor_id = sensor_readings.sensor_id),
+                            sensor_type = (SELECT sensor_type FROM sensors WHERE sensors.sensor_id = sensor_readings.sensor_id)
+                        WHERE id > ? AND id <= ?
+                    """, (lo, lo + MIGRATION_CHUNK))
+                self.sql.execute("meta.set", ("migration_004.backfilled_id", str(lo + MIGRATION_CHUNK)), tx)
+            self._transaction(backfill)
+            lo += MIGRATION_CHUNK
+
+    def _migration_005_readings_covering_indexes(self, cursor):
+        """Index phủ cho analytics theo loại / theo phòng và (sensor_id, timestamp)"""
+        if self.use_mysql:
+            indexes = self._schema_indexes(cursor, "sensor_readings")
+            missing = [f"ADD INDEX `{name}` ({columns})" for name, columns in (
+                ("idx_readings_type_time", "`sensor_type`, `timestamp`, `value`"),
+                ("idx_readings_room_type_time", "`room_id`, `sensor_type`, `timestamp`, `value`"),
+                ("idx_readings_sensor_time", "`sensor_id`, `timestamp`"),
+            ) if name not in indexes]
+            if missing:
+                cursor.execute(f"ALTER TABLE sensor_readings {', '.join(missing)}")
+        else:
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_readings_type_time ON sensor_readings(sensor_type, timestamp, value)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_readings_room_type_time ON sensor_readings(room_id, sensor_type, timestamp, value)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_readings_sensor_time ON sensor_readings(sensor_id, timestamp)')
+
+    def _load_sensor_state(self):
+        """Nạp bảng sensors vào SensorStateCache"""
+        try:
+            self.sensor_state.load(self.sql.rows("sensors.with_room"))
+            logger.info(f"🧮 Sensor state loaded: {len(self.sensor_state.sensors)} sensors")
+        except Exception as e:
+            logger.error(f"❌ Load sensor state error: {e}")
+
+    def _load_energy(self):
+        """Nạp phòng / tầng vào EnergyLedger, kWh các ngày trước từ rollup và tích phân lại reading power từ 0h hôm nay"""
+        try:
+            for room in self.sql.dicts("rooms.active"):
+                self.energy.set_room(room['room_id'], room.get('building'), room.get('floor'))
+            for floor in self.sql.dicts("floors.all"):
+                self.energy.set_floor(floor['floor_id'], floor['building_id'], floor['floor_number'],
+                                      floor['name'], floor['energy_target'])
+            midnight = datetime.combine(datetime.now().date(), datetime.min.time()).timestamp()
+            first_day = datetime.combine(datetime.now().date() - timedelta(days=ENERGY_KEEP_DAYS - 1), datetime.min.time()).timestamp()
+            self.energy.load_rollups(self.sql.tuples("rollups.energy_sensors", (ENERGY_ROLLUP, int(first_day), int(midnight))))
+            if self.partitions:
+                rows = []
+                with self.engine.reader() as conn:
+                    for tables in chain([["sensor_readings"]], self.partitions.source_groups(conn, midnight, time.time() + 1)):
+                        union = " UNION ALL ".join(
+                            f"SELECT sensor_id, value, timestamp FROM {t} WHERE sensor_type = 'power' AND timestamp >= ?" for t in tables
+                        )
+                        rows.extend(conn.execute(union, (midnight,) * len(tables)))
+            else:
+                rows = [(sid, value, to_epoch(ts)) for sid, value, ts in self.sql.tuples("readings.power_since", (self.sql.ts(midnight),))]
+            kwh = self.energy.add(rows, self.sensor_state.sensors)
+            logger.info(f"⚡ Energy ledger loaded: {kwh:.3f} kWh today from {len(rows)} readings")
+        except Exception as e:
+            logger.error(f"❌ Load energy ledger error: {e}")
+
+    def flush_sensor_state(self) -> int:
+        """Flush last value của các sensor thay đổi xuống bảng sensors (1 transaction)"""
+        rows = self.sensor_state.take_dirty()
+        if not rows:
+            return 0
+        try:
+            params = [(val, self.sql.ts(ts), sid) for sid, val, ts in rows]
+            self._transaction(lambda cursor: self.sql.execute_many("sensors.update_last", params, cursor))
+            return len(rows)
+        except Exception as e:
+            logger.error(f"❌ Flush sensor state error: {e}")
+            self.sensor_state.mark_dirty([sid for sid, _, _ in rows])
+            return 0
     
     # ========================================================================
     # 🔐 USER AUTHENTICATION
@@ -525,30 +3664,12 @@ class UltimateDatabaseManager:
         try:
             # Hash password để so sánh
             password_hash = hashlib.sha256(password.encode()).hexdigest()
-            
-            if self.use_supabase:
-                response = self.supabase_client.table("users").select("*").eq("username", username).eq("password_hash", password_hash).execute()
-                if response.data:
-                    logger.info(f"✅ User authenticated: {username}")
-                    return response.data[0]
-                return None
-            
-            cursor = self._get_cursor()
-            
-            if self.use_mysql:
-                cursor.execute("SELECT * FROM users WHERE username = %s AND password_hash = %s", (username, password_hash))
-                result = cursor.fetchone()
-            else:
-                cursor.execute("SELECT * FROM users WHERE username = ? AND password_hash = ?", (username, password_hash))
-                row = cursor.fetchone()
-                result = dict(row) if row else None
-            
-            cursor.close()
-            
-            if result:
+
+            rows = self.sql.dicts("users.verify_full", (username, password_hash))
+            if rows:
                 logger.info(f"✅ User authenticated: {username}")
-                return result
-            
+                return rows[0]
+
             logger.warning(f"⚠️ Login failed for username: {username}")
             return None
         except Exception as e:
@@ -562,22 +3683,10 @@ class UltimateDatabaseManager:
     def add_room(self, room_id: str, name: str, area: float, floor: int, building: str) -> Dict:
         """Thêm phòng mới"""
         try:
-            cursor = self._get_cursor()
-            
-            if self.use_mysql:
-                cursor.execute(
-                    "INSERT INTO rooms (room_id, name, area, floor, building) VALUES (%s, %s, %s, %s, %s)",
-                    (room_id, name, area, floor, building)
-                )
-            else:
-                cursor.execute(
-                    "INSERT INTO rooms VALUES (?, ?, ?, ?, ?, ?, ?)",
-                    (room_id, name, area, floor, building, time.time(), 1)
-                )
-                self.connection.commit()
-            
-            cursor.close()
+            self.sql.execute("rooms.insert", (room_id, name, area, floor, building, self.sql.ts(time.time())))
+            self.energy.set_room(room_id, building, floor)
             logger.info(f"✅ Room added: {room_id} - {name}")
+            event_bus.publish("room.added", room_id=room_id, name=name, floor=floor, building=building)
             return {"success": True, "room_id": room_id, "message": f"Đã thêm phòng {name}"}
         except Exception as e:
             logger.error(f"❌ Add room error: {e}")
@@ -586,124 +3695,57 @@ class UltimateDatabaseManager:
     def delete_room(self, room_id: str) -> Dict:
         """❌ XÓA PHÒNG (và tất cả sensors, devices liên quan)"""
         try:
-            cursor = self._get_cursor()
-            
             # Check if room exists
-            if self.use_mysql:
-                cursor.execute("SELECT name FROM rooms WHERE room_id = %s", (room_id,))
-            else:
-                cursor.execute("SELECT name FROM rooms WHERE room_id = ?", (room_id,))
-            
-            result = cursor.fetchone()
-            if not result:
-                cursor.close()
+            room = self.sql.row("rooms.name", (room_id,))
+            if not room:
                 return {"success": False, "error": "Room not found"}
-            
-            room_name = result['name'] if isinstance(result, dict) else result[1]
-            
-            # Delete cascade
-            if self.use_mysql:
-                cursor.execute("DELETE FROM rooms WHERE room_id = %s", (room_id,))
-            else:
-                cursor.execute("DELETE FROM sensors WHERE room_id = ?", (room_id,))
-                cursor.execute("DELETE FROM iot_devices WHERE room_id = ?", (room_id,))
-                cursor.execute("DELETE FROM rooms WHERE room_id = ?", (room_id,))
-                self.connection.commit()
-            
-            cursor.close()
-            logger.info(f"🗑️  Room deleted: {room_id} - {room_name}")
-            return {"success": True, "message": f"Đã xóa phòng {room_name} và tất cả thiết bị liên quan"}
+
+            # Delete cascade (xóa tường minh → giống nhau trên MySQL và SQLite)
+            def delete(cursor):
+                for name in ("sensors.delete_by_room", "devices.delete_by_room", "rooms.delete"):
+                    self.sql.execute(name, (room_id,), cursor)
+            self._transaction(delete)
+
+            self.sensor_state.remove_room(room_id)
+            self.energy.remove_room(room_id)
+            logger.info(f"🗑️  Room deleted: {room_id} - {room.name}")
+            event_bus.publish("room.deleted", room_id=room_id, name=room.name)
+            return {"success": True, "message": f"Đã xóa phòng {room.name} và tất cả thiết bị liên quan"}
         except Exception as e:
             logger.error(f"❌ Delete room error: {e}")
             return {"success": False, "error": str(e)}
-    
-    def get_all_rooms(self) -> List[Dict]:
-        """Lấy danh sách phòng"""
-        if self.use_supabase:
-            response = self.supabase_client.table("rooms").select("*").eq("is_active", True).order("created_at", desc=True).execute()
-            return response.data
-            
-        cursor = self._get_cursor()
-        
-        if self.use_mysql:
-            cursor.execute("SELECT * FROM rooms WHERE is_active = TRUE ORDER BY created_at DESC")
-            rooms = cursor.fetchall()
-        else:
-            cursor.execute("SELECT * FROM rooms WHERE is_active = 1 ORDER BY created_at DESC")
-            rooms = [dict(row) for row in cursor.fetchall()]
-        
-        cursor.close()
-        return rooms
+    
+    def get_all_rooms(self) -> List[Dict]:
+        """Lấy danh sách phòng"""
+        return self.sql.dicts("rooms.active")
 
     # --- ENTERPRISE CRUD ---
     def add_building(self, building_id: str, name: str, address: str, total_floors: int, manager: str):
         try:
-            cursor = self._get_cursor()
-            if self.use_mysql:
-                cursor.execute(
-                    "INSERT INTO buildings (building_id, name, address, total_floors, manager_name) VALUES (%s, %s, %s, %s, %s)",
-                    (building_id, name, address, total_floors, manager)
-                )
-            else:
-                cursor.execute(
-                    "INSERT INTO buildings VALUES (?, ?, ?, ?, ?, ?, ?)",
-                    (building_id, name, address, total_floors, manager, 1, time.time())
-                )
-                self.connection.commit()
-            cursor.close()
+            self.sql.execute("buildings.insert", (building_id, name, address, total_floors, manager, self.sql.ts(time.time())))
             return {"success": True, "message": f"Building {name} created."}
         except Exception as e:
             return {"success": False, "error": str(e)}
 
     def add_floor(self, floor_id: str, building_id: str, floor_num: int, name: str, energy_target: float):
         try:
-            cursor = self._get_cursor()
-            if self.use_mysql:
-                cursor.execute(
-                    "INSERT INTO floors (floor_id, building_id, floor_number, name, energy_target) VALUES (%s, %s, %s, %s, %s)",
-                    (floor_id, building_id, floor_num, name, energy_target)
-                )
-            else:
-                cursor.execute(
-                    "INSERT INTO floors VALUES (?, ?, ?, ?, ?, ?)",
-                    (floor_id, building_id, floor_num, name, 'SAFE', energy_target)
-                )
-                self.connection.commit()
-            cursor.close()
+            self.sql.execute("floors.insert", (floor_id, building_id, floor_num, name, energy_target))
+            self.energy.set_floor(floor_id, building_id, floor_num, name, energy_target)
             return {"success": True, "message": f"Floor {name} added to Building {building_id}."}
         except Exception as e:
             return {"success": False, "error": str(e)}
 
     def add_schedule(self, room_id: str, event: str, start: str, end: str, min_t: float, max_t: float, priority: int):
         try:
-            cursor = self._get_cursor()
-            if self.use_mysql:
-                cursor.execute(
-                    "INSERT INTO enterprise_schedules (room_id, event_name, start_time, end_time, min_temp, max_temp, priority) VALUES (%s, %s, %s, %s, %s, %s, %s)",
-                    (room_id, event, start, end, min_t, max_t, priority)
-                )
-            else:
-                cursor.execute(
-                    "INSERT INTO enterprise_schedules (room_id, event_name, start_time, end_time, min_temp, max_temp, priority, is_completed) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                    (room_id, event, start, end, min_t, max_t, priority, 0)
-                )
-                self.connection.commit()
-            cursor.close()
+            self.sql.execute("schedules.insert", (room_id, event, start, end, min_t, max_t, priority))
+            event_bus.publish("schedule.added", room_id=room_id, event_name=event, start_time=start, end_time=end)
             return {"success": True, "message": f"Event '{event}' scheduled for room {room_id}."}
         except Exception as e:
             return {"success": False, "error": str(e)}
     
     def get_upcoming_schedules(self, limit=50):
         try:
-            cursor = self._get_cursor()
-            if self.use_mysql:
-                cursor.execute("SELECT * FROM enterprise_schedules WHERE is_completed = FALSE ORDER BY start_time ASC LIMIT %s", (limit,))
-                results = cursor.fetchall()
-            else:
-                cursor.execute("SELECT * FROM enterprise_schedules WHERE is_completed = 0 ORDER BY start_time ASC LIMIT ?", (limit,))
-                results = [dict(row) for row in cursor.fetchall()]
-            cursor.close()
-            return results
+            return self.sql.dicts("schedules.upcoming", (limit,))
         except:
             return []
     
@@ -720,72 +3762,36 @@ class UltimateDatabaseManager:
             "query": query,
             "total_found": 0
         }
-        
-        cursor = self._get_cursor()
+
         query_pattern = f"%{query}%"
-        
+
         try:
-            # Search rooms
-            if self.use_mysql:
-                cursor.execute("""
-                    SELECT r.*, COUNT(s.sensor_id) as sensor_count 
-                    FROM rooms r
-                    LEFT JOIN sensors s ON r.room_id = s.room_id
-                    WHERE r.room_id LIKE %s OR r.name LIKE %s OR r.building LIKE %s
-                    GROUP BY r.room_id
-                """, (query_pattern, query_pattern, query_pattern))
-                results["rooms"] = cursor.fetchall()
-                
+            with self.sql.read_cursor("rooms.search", "sensors.search", "devices.search") as cursor:
+                # Search rooms
+                results["rooms"] = self.sql.dicts("rooms.search", (query_pattern,) * 3, cursor)
                 # Search sensors
-                cursor.execute("""
-                    SELECT s.*, r.name as room_name 
-                    FROM sensors s
-                    LEFT JOIN rooms r ON s.room_id = r.room_id
-                    WHERE s.sensor_id LIKE %s OR s.sensor_type LIKE %s
-                """, (query_pattern, query_pattern))
-                results["sensors"] = cursor.fetchall()
-                
+                results["sensors"] = self.sql.dicts("sensors.search", (query_pattern,) * 2, cursor)
                 # Search devices
-                cursor.execute("""
-                    SELECT d.*, r.name as room_name 
-                    FROM iot_devices d
-                    LEFT JOIN rooms r ON d.room_id = r.room_id
-                    WHERE d.device_id LIKE %s OR d.device_name LIKE %s OR d.device_type LIKE %s
-                """, (query_pattern, query_pattern, query_pattern))
-                results["devices"] = cursor.fetchall()
-            else:
-                cursor.execute("""
-                    SELECT r.*, COUNT(s.sensor_id) as sensor_count 
-                    FROM rooms r
-                    LEFT JOIN sensors s ON r.room_id = s.room_id
-                    WHERE r.room_id LIKE ? OR r.name LIKE ? OR r.building LIKE ?
-                    GROUP BY r.room_id
-                """, (query_pattern, query_pattern, query_pattern))
-                results["rooms"] = [dict(row) for row in cursor.fetchall()]
-                
-                cursor.execute("""
-                    SELECT s.*, r.name as room_name 
-                    FROM sensors s
-                    LEFT JOIN rooms r ON s.room_id = r.room_id
-                    WHERE s.sensor_id LIKE ? OR s.sensor_type LIKE ?
-                """, (query_pattern, query_pattern))
-                results["sensors"] = [dict(row) for row in cursor.fetchall()]
-            
+                results["devices"] = self.sql.dicts("devices.search", (query_pattern,) * 3, cursor)
+
             results["total_found"] = len(results["rooms"]) + len(results["sensors"]) + len(results["devices"])
-            
+
         except Exception as e:
             logger.error(f"❌ Search error: {e}")
-        
-        cursor.close()
+
         return results
     
     # ========================================================================
     # 📊 PER-ROOM ANALYTICS
     # ========================================================================
     
-    def get_room_analytics(self, room_id: str, hours: int = 24) -> Dict:
-        """Phân tích CHI TIẾT TỪNG PHÒNG"""
-        cursor = self._get_cursor()
+    def get_room_analytics(self, room_id: str, hours: int = 24, resolution: Optional[int] = None,
+                           max_points: Optional[int] = None) -> Dict:
+        """Phân tích CHI TIẾT TỪNG PHÒNG (max_points: LTTB cho các chuỗi biểu đồ)"""
+        cursor = self.sql.read_cursor("rooms.get", "sensors.by_room", "devices.by_room", "rollups.series_room_sum",
+                                      "readings.series_room", "rollups.energy_room", "rollups.occupancy_room",
+                                      "readings.occupancy_room")
+        rollup = self._pick_rollup(hours, resolution)
         
         analytics = {
             "room_id": room_id,
@@ -796,97 +3802,187 @@ class UltimateDatabaseManager:
             "occupancy_history": [],
             "temperature_history": [],
             "alerts": [],
+            "total_energy_kwh": 0.0,
             "efficiency_score": 0,
-            "recommendations": []
+            "recommendations": [],
+            "resolution": rollup
         }
         
         try:
             # Get room info
-            if self.use_mysql:
-                cursor.execute("SELECT * FROM rooms WHERE room_id = %s", (room_id,))
-                analytics["room_info"] = cursor.fetchone()
-                
-                # Get sensors
-                cursor.execute("SELECT * FROM sensors WHERE room_id = %s", (room_id,))
-                analytics["sensors"] = cursor.fetchall()
-                
-                # Get devices
-                cursor.execute("SELECT * FROM iot_devices WHERE room_id = %s", (room_id,))
-                analytics["devices"] = cursor.fetchall()
-                
-                # Get power history
-                cursor.execute("""
-                    SELECT sr.timestamp, sr.value 
-                    FROM sensor_readings sr
-                    JOIN sensors s ON sr.sensor_id = s.sensor_id
-                    WHERE s.room_id = %s AND s.sensor_type = 'power'
-                    AND sr.timestamp >= NOW() - INTERVAL %s HOUR
-                    ORDER BY sr.timestamp
-                """, (room_id, hours))
-                analytics["energy_consumption"] = cursor.fetchall()
-                
-                # Occupancy
-                cursor.execute("""
-                    SELECT sr.timestamp, sr.value 
-                    FROM sensor_readings sr
-                    JOIN sensors s ON sr.sensor_id = s.sensor_id
-                    WHERE s.room_id = %s AND s.sensor_type = 'occupancy'
-                    AND sr.timestamp >= NOW() - INTERVAL %s HOUR
-                    ORDER BY sr.timestamp
-                """, (room_id, hours))
-                analytics["occupancy_history"] = cursor.fetchall()
-                
-                # Temperature
-                cursor.execute("""
-                    SELECT sr.timestamp, sr.value 
-                    FROM sensor_readings sr
-                    JOIN sensors s ON sr.sensor_id = s.sensor_id
-                    WHERE s.room_id = %s AND s.sensor_type = 'temperature'
-                    AND sr.timestamp >= NOW() - INTERVAL %s HOUR
-                    ORDER BY sr.timestamp
-                """, (room_id, hours))
-                analytics["temperature_history"] = cursor.fetchall()
-            else:
-                cutoff = time.time() - (hours * 3600)
-                
-                cursor.execute("SELECT * FROM rooms WHERE room_id = ?", (room_id,))
-                row = cursor.fetchone()
-                analytics["room_info"] = dict(row) if row else None
-                
-                cursor.execute("SELECT * FROM sensors WHERE room_id = ?", (room_id,))
-                analytics["sensors"] = [dict(row) for row in cursor.fetchall()]
-                
-                cursor.execute("""
-                    SELECT sr.timestamp, sr.value 
-                    FROM sensor_readings sr
-                    JOIN sensors s ON sr.sensor_id = s.sensor_id
-                    WHERE s.room_id = ? AND s.sensor_type = 'power'
-                    AND sr.timestamp > ?
-                    ORDER BY sr.timestamp
-                """, (room_id, cutoff))
-                analytics["energy_consumption"] = [dict(row) for row in cursor.fetchall()]
+            room = self.sql.dicts("rooms.get", (room_id,), cursor)
+            analytics["room_info"] = room[0] if room else None
+            # Get sensors & devices
+            analytics["sensors"] = self.sql.dicts("sensors.by_room", (room_id,), cursor)
+            analytics["devices"] = self.sql.dicts("devices.by_room", (room_id,), cursor)
+
+            analytics["energy_consumption"] = self._history(cursor, 'power', hours, rollup, room_id)
+            analytics["occupancy_history"] = self._history(cursor, 'occupancy', hours, rollup, room_id)
+            analytics["temperature_history"] = self._history(cursor, 'temperature', hours, rollup, room_id)
             
+            # kWh tích phân theo thời gian (không cộng các điểm W của chuỗi hiển thị)
+            total_energy = self._energy_kwh(cursor, hours, room_id).get(room_id, 0.0)
+            analytics["total_energy_kwh"] = round(total_energy, 3)
+
             # Calculate efficiency
             if analytics["energy_consumption"] and analytics["occupancy_history"]:
-                total_energy = sum(item['value'] if isinstance(item, dict) else item[1] 
-                                 for item in analytics["energy_consumption"])
-                avg_occupancy = sum(item['value'] if isinstance(item, dict) else item[1] 
-                                  for item in analytics["occupancy_history"]) / len(analytics["occupancy_history"])
-                
-                if avg_occupancy > 0:
-                    analytics["efficiency_score"] = round((1 - (total_energy / (avg_occupancy * 10))) * 100, 1)
-                
-                # Recommendations
-                if analytics["efficiency_score"] < 60:
-                    analytics["recommendations"].append("Tiêu thụ điện cao, cần tối ưu hóa")
-                if avg_occupancy == 0 and total_energy > 0:
-                    analytics["recommendations"].append("Tắt thiết bị khi không có người")
+                avg_occupancy = self._avg_occupancy(cursor, hours, rollup, room_id).get(room_id, 0.0)
+                analytics["efficiency_score"], analytics["recommendations"] = room_efficiency(total_energy, avg_occupancy)
+
+            # Giảm điểm sau khi đã tính chỉ số trên chuỗi đầy đủ
+            for key in ("energy_consumption", "occupancy_history", "temperature_history"):
+                analytics[key] = downsample_points(analytics[key], max_points)
         
         except Exception as e:
             logger.error(f"❌ Room analytics error: {e}")
         
         cursor.close()
         return analytics
+
+    def _energy_kwh(self, cursor, hours: float, room_id: Optional[str] = None) -> Dict[str, float]:
+        """
+        kWh theo phòng trong cửa sổ hours: công suất TB mỗi bucket ENERGY_ROLLUP × số giây bucket nằm trong cửa sổ
+        → không phụ thuộc tần số lấy mẫu hay resolution của chuỗi hiển thị
+        """
+        now = time.time()
+        cutoff = now - hours * 3600
+        start = int(cutoff // ENERGY_ROLLUP) * ENERGY_ROLLUP
+        if room_id:
+            rows = self.sql.tuples("rollups.energy_room", (ENERGY_ROLLUP, start, room_id), cursor)
+        else:
+            rows = self.sql.tuples("rollups.energy", (ENERGY_ROLLUP, start), cursor)
+        totals: Dict[str, float] = defaultdict(float)
+        for rid, bucket_start, watts in rows:
+            # Bucket đầu / bucket đang chạy chỉ tính phần nằm trong cửa sổ
+            seconds = min(bucket_start + ENERGY_ROLLUP, now) - max(bucket_start, cutoff)
+            if seconds > 0 and watts is not None:
+                totals[rid] += watts * seconds / 3.6e6
+        return dict(totals)
+
+    def _avg_occupancy(self, cursor, hours: float, rollup: int, room_id: Optional[str] = None) -> Dict[str, float]:
+        """
+        Số người TB theo phòng trong cửa sổ hours = Σ các sensor occupancy của phòng (trung bình mọi reading của sensor)
+        → occupancy cộng dồn giữa các sensor (ADDITIVE_SENSOR_TYPES); cùng kết quả cho analytics 1 phòng và
+          nhiều phòng, dù đọc rollup hay dữ liệu gốc, không phụ thuộc resolution của chuỗi hiển thị
+        """
+        cutoff = time.time() - hours * 3600
+        room = (room_id,) if room_id else ()
+        suffix = "_room" if room_id else ""
+        if rollup:
+            rows = self.sql.tuples(f"rollups.occupancy{suffix}", (rollup, self._rollup_start(hours, rollup)) + room, cursor)
+        elif self.partitions:
+            room_filter = " AND room_id = ?" if room_id else ""
+            rows = []
+            with self.engine.reader() as conn:
+                for tables in chain([["sensor_readings"]], self.partitions.source_groups(conn, cutoff, time.time() + 1)):
+                    union = " UNION ALL ".join(
+                        f"SELECT room_id, sensor_id, SUM(value), COUNT(value) FROM {t}"
+                        f" WHERE sensor_type = 'occupancy' AND timestamp > ?{room_filter} GROUP BY room_id, sensor_id" for t in tables
+                    )
+                    rows.extend(tuple(row) for row in conn.execute(union, ((cutoff,) + room) * len(tables)))
+        else:
+            rows = self.sql.tuples(f"readings.occupancy{suffix}", (self.sql.ts(cutoff),) + room, cursor)
+        sensors: Dict[Tuple, List[float]] = defaultdict(lambda: [0.0, 0])
+        for rid, sensor_id, total, count in rows:
+            if count:
+                acc = sensors[(rid, sensor_id)]  # 1 sensor có thể nằm ở nhiều phân vùng
+                acc[0] += total
+                acc[1] += count
+        occupancy: Dict[str, float] = defaultdict(float)
+        for (rid, _), (total, count) in sensors.items():
+            occupancy[rid] += total / count
+        return dict(occupancy)
+
+    def _room_points(self, cursor, hours: float) -> List[Tuple]:
+        """(room_id, sensor_type, value) của mọi reading gốc trong cửa sổ (mọi phòng, 1 lượt đọc)"""
+        cutoff = time.time() - hours * 3600
+        if self.partitions:
+            points = []
+            with self.engine.reader() as conn:
+                for tables in chain([["sensor_readings"]], self.partitions.source_groups(conn, cutoff, time.time() + 1)):
+                    union = " UNION ALL ".join(
+                        f"SELECT room_id, sensor_type, value FROM {t} WHERE timestamp > ?"
+                        f" AND sensor_type IN ('power', 'occupancy', 'temperature')" for t in tables
+                    )
+                    points.extend(tuple(row) for row in conn.execute(union, (cutoff,) * len(tables)))
+            return points
+        return self.sql.tuples("readings.rooms", (self.sql.ts(cutoff),), cursor)
+
+    def get_rooms_analytics(self, hours: int = 24, resolution: Optional[int] = None, sort: str = "efficiency_score",
+                            descending: bool = True, limit: Optional[int] = None) -> Dict:
+        """
+        Phân tích TẤT CẢ phòng trong 1 lượt (xếp hạng toàn trường):
+        1 query danh sách phòng + 1 query gộp theo (phòng, loại sensor), thống kê theo nhóm bằng NumPy
+        """
+        cursor = self.sql.read_cursor("rooms.active", "rollups.rooms", "readings.rooms", "rollups.energy",
+                                      "rollups.occupancy", "readings.occupancy")
+        rollup = self._pick_rollup(hours, resolution)
+        types = ("power", "occupancy", "temperature")
+        rooms, energy, headcount = [], {}, {}
+        sums, counts, mins, maxs = [], [], [], []
+        try:
+            rooms = self.sql.dicts("rooms.active", (), cursor)
+            index = {room["room_id"]: i for i, room in enumerate(rooms)}
+            # Nhóm = phòng * 3 + loại; mọi chỉ số tính trên toàn bộ reading của nhóm, dù đọc rollup hay dữ liệu gốc
+            if rollup:
+                groups = len(rooms) * 3
+                sums, counts = [0.0] * groups, [0] * groups
+                mins, maxs = [float("inf")] * groups, [float("-inf")] * groups
+                for room_id, sensor_type, total, low, high, count in self.sql.tuples(
+                        "rollups.rooms", (rollup, self._rollup_start(hours, rollup)), cursor):
+                    i = index.get(room_id)
+                    if i is not None and count:
+                        g = i * 3 + types.index(sensor_type)
+                        sums[g], counts[g], mins[g], maxs[g] = total, count, low, high
+            else:
+                codes, values = [], []
+                for room_id, sensor_type, value in self._room_points(cursor, hours):
+                    i = index.get(room_id)
+                    if i is not None and value is not None:
+                        codes.append(i * 3 + types.index(sensor_type))
+                        values.append(value)
+                sums, counts, mins, maxs = group_stats(codes, values, len(rooms) * 3)
+            # kWh tích phân theo thời gian, không phụ thuộc tần số lấy mẫu / resolution
+            energy = self._energy_kwh(cursor, hours)
+            headcount = self._avg_occupancy(cursor, hours, rollup)
+        except Exception as e:
+            logger.error(f"❌ Rooms analytics error: {e}")
+            rooms = []
+        cursor.close()
+
+        results = []
+        for i, room in enumerate(rooms):
+            power, occupancy, temperature = i * 3, i * 3 + 1, i * 3 + 2
+            avg_occupancy = headcount.get(room["room_id"], 0.0)
+            energy_kwh = energy.get(room["room_id"], 0.0)
+            score, recommendations = (room_efficiency(energy_kwh, avg_occupancy)
+                                      if counts[power] and counts[occupancy] else (0, []))
+            results.append({
+                "room_id": room["room_id"],
+                "name": room.get("name"),
+                "building": room.get("building"),
+                "floor": room.get("floor"),
+                "energy_kwh": round(energy_kwh, 3),
+                "avg_occupancy": round(avg_occupancy, 3),
+                "avg_temperature": round(sums[temperature] / counts[temperature], 2) if counts[temperature] else None,
+                "min_temperature": mins[temperature] if counts[temperature] else None,
+                "max_temperature": maxs[temperature] if counts[temperature] else None,
+                "points": counts[power] + counts[occupancy] + counts[temperature],
+                "efficiency_score": score,
+                "recommendations": recommendations
+            })
+
+        # Phòng thiếu dữ liệu cho khóa sắp xếp luôn đứng cuối
+        ranked = sorted((r for r in results if r[sort] is not None), key=lambda r: r[sort], reverse=descending)
+        ranked += [r for r in results if r[sort] is None]
+        return {
+            "rooms": ranked[:limit] if limit else ranked,
+            "total": len(ranked),
+            "sort": sort,
+            "order": "desc" if descending else "asc",
+            "time_range": hours,
+            "resolution": rollup
+        }
     
     # ========================================================================
     # 📡 SENSOR & DEVICE MANAGEMENT
@@ -895,32 +3991,15 @@ class UltimateDatabaseManager:
     def add_sensor(self, sensor_id: str, room_id: str, sensor_type: str, unit: str) -> Dict:
         """Thêm cảm biến"""
         try:
-            cursor = self._get_cursor()
-            
             # Check if room exists
-            if self.use_mysql:
-                cursor.execute("SELECT room_id FROM rooms WHERE room_id = %s", (room_id,))
-            else:
-                cursor.execute("SELECT room_id FROM rooms WHERE room_id = ?", (room_id,))
-            
-            if not cursor.fetchone():
-                cursor.close()
+            room = self.sql.row("rooms.name", (room_id,))
+            if not room:
                 return {"success": False, "error": f"Room {room_id} not found"}
-            
-            if self.use_mysql:
-                cursor.execute(
-                    "INSERT INTO sensors (sensor_id, room_id, sensor_type, unit, status) VALUES (%s, %s, %s, %s, %s)",
-                    (sensor_id, room_id, sensor_type, unit, "WAITING")
-                )
-            else:
-                cursor.execute(
-                    "INSERT INTO sensors VALUES (?, ?, ?, ?, ?, ?, ?)",
-                    (sensor_id, room_id, sensor_type, unit, 0, time.time(), "WAITING")
-                )
-                self.connection.commit()
-            
-            cursor.close()
+
+            self.sql.execute("sensors.insert", (sensor_id, room_id, sensor_type, unit, self.sql.ts(time.time())))
+            self.sensor_state.add_sensor(sensor_id, room_id, sensor_type, unit, room.name)
             logger.info(f"✅ Sensor added: {sensor_id}")
+            event_bus.publish("sensor.added", sensor_id=sensor_id, room_id=room_id, sensor_type=sensor_type)
             return {"success": True, "sensor_id": sensor_id, "message": f"Đã thêm cảm biến {sensor_id}"}
         except Exception as e:
             logger.error(f"❌ Add sensor error: {e}")
@@ -929,52 +4008,289 @@ class UltimateDatabaseManager:
     def delete_sensor(self, sensor_id: str) -> Dict:
         """Xóa cảm biến"""
         try:
-            cursor = self._get_cursor()
-            
-            if self.use_mysql:
-                cursor.execute("DELETE FROM sensors WHERE sensor_id = %s", (sensor_id,))
-            else:
-                cursor.execute("DELETE FROM sensors WHERE sensor_id = ?", (sensor_id,))
-                self.connection.commit()
-            
-            cursor.close()
+            self.sql.execute("sensors.delete", (sensor_id,))
+            self.sensor_state.remove_sensor(sensor_id)
             logger.info(f"🗑️  Sensor deleted: {sensor_id}")
+            event_bus.publish("sensor.deleted", sensor_id=sensor_id)
             return {"success": True, "message": f"Đã xóa cảm biến {sensor_id}"}
         except Exception as e:
             logger.error(f"❌ Delete sensor error: {e}")
             return {"success": False, "error": str(e)}
     
-    def log_sensor_reading(self, sensor_id: str, value: float, quality: str = "GOOD") -> bool:
-        """Ghi dữ liệu cảm biến"""
-        try:
-            cursor = self._get_cursor()
-            
-            if self.use_mysql:
-                cursor.execute(
-                    "INSERT INTO sensor_readings (sensor_id, value, quality) VALUES (%s, %s, %s)",
-                    (sensor_id, value, quality)
-                )
-                cursor.execute(
-                    "UPDATE sensors SET last_value = %s, last_update = NOW(), status = 'ONLINE' WHERE sensor_id = %s",
-                    (value, sensor_id)
+    def _compress(self, rows: List[Tuple]) -> Tuple[List[Tuple], Optional[Dict]]:
+        """
+        Cho các reading (sensor_id, value, ts, quality) qua ReadingCompressor nếu bật
+        Trả về (rows cần lưu, checkpoint) - gọi _restore_compressor(checkpoint) nếu ghi DB thất bại
+        """
+        if not self.compressor:
+            return rows, None
+        checkpoint = self.compressor.checkpoint(row[0] for row in rows)
+        out = []
+        for sensor_id, value, ts, quality in rows:
+            entry = self.sensor_state.sensors.get(sensor_id)
+            out.extend(self.compressor.process(sensor_id, entry['sensor_type'] if entry else None, value, ts, quality))
+        return out, checkpoint
+
+    def _restore_compressor(self, checkpoint: Optional[Dict]):
+        """Ghi thất bại / rollback → trả state compressor về trước lô (không mất điểm đang giữ)"""
+        if checkpoint:
+            self.compressor.restore(checkpoint)
+
+    def _insert_readings(self, cursor, rows: List[Tuple]):
+        """Ghi reading kèm room_id/sensor_type (lấy từ SensorStateCache, không cần JOIN khi đọc)"""
+        if not rows:
+            return
+        sensors = self.sensor_state.sensors
+        full = []
+        for sid, val, ts, q in rows:
+            entry = sensors.get(sid) or {}
+            full.append((sid, val, ts, q, entry.get('room_id'), entry.get('sensor_type')))
+        if self.use_mysql or self.use_supabase:
+            self.sql.execute_many("readings.insert",
+                                  [(sid, val, self.sql.ts(ts), q, room, stype) for sid, val, ts, q, room, stype in full], cursor)
+        elif self.partitions:
+            by_key: Dict[str, List[Tuple]] = defaultdict(list)
+            for row in full:
+                by_key[self.partitions.key_for(row[2])].append(row)
+            keys = sorted(by_key)
+
+            def insert(conn):
+                # Các phân vùng đã được ATTACH trước transaction (_write_readings); attach() chỉ lấy alias
+                for alias, key in zip(self.partitions.attach(conn, keys, create=True), keys):
+                    conn.executemany(self.sql.statements["readings.insert"].replace(
+                        "INTO sensor_readings", f"INTO {alias}.sensor_readings"), by_key[key])
+            self.engine.write(insert)
+        else:
+            self.sql.execute_many("readings.insert", full, cursor)
+
+    def _write_readings(self, stored_rows: List[Tuple], rollup_rows: List[Tuple]):
+        """
+        Ghi reading (sau nén) + cập nhật rollup trong 1 transaction.
+        SQLite phân vùng: lô trải trên > SQLITE_MAX_ATTACHED phân vùng không ATTACH được cùng lúc →
+        ghi trước các nhóm phân vùng cũ, mỗi nhóm 1 transaction (không nguyên tử, đếm ở split_batches)
+        """
+        def write(cursor, rows):
+            self._insert_readings(cursor, rows)
+            if rollup_rows:
+                self._update_rollups(cursor, rollup_rows)
+
+        if not self.partitions or not stored_rows:
+            return self._transaction(lambda cursor: write(cursor, stored_rows))
+        by_key: Dict[str, List[Tuple]] = defaultdict(list)
+        for row in stored_rows:
+            by_key[self.partitions.key_for(row[2])].append(row)
+        keys = sorted(by_key)
+        groups = [keys[i:i + SQLITE_MAX_ATTACHED] for i in range(0, len(keys), SQLITE_MAX_ATTACHED)]
+        if len(groups) > 1:
+            self.partitions.split_batches += 1
+            logger.warning(f"⚠️  Reading batch spans {len(keys)} partitions: written in {len(groups)} transactions")
+        for group in groups[:-1]:
+            rows = [row for key in group for row in by_key[key]]
+            self._transaction(lambda cursor: self._insert_readings(cursor, rows), group)
+        rows = [row for key in groups[-1] for row in by_key[key]]
+        return self._transaction(lambda cursor: write(cursor, rows), groups[-1])
+
+    def _update_rollups(self, cursor, rows: List[Tuple]):
+        """Cập nhật tăng dần bảng sensor_rollups (min, max, sum, count, last) cho mọi độ phân giải"""
+        buckets: Dict[Tuple, List] = {}
+        for sensor_id, value, ts, _ in rows:
+            entry = self.sensor_state.sensors.get(sensor_id)
+            if entry is None:
+                continue
+            for res in ROLLUP_RESOLUTIONS:
+                key = (res, int(ts // res) * res, sensor_id)
+                agg = buckets.get(key)
+                if agg is None:
+                    buckets[key] = [entry['room_id'], entry['sensor_type'], value, value, value, 1, value, ts]
+                    continue
+                agg[2] = min(agg[2], value)
+                agg[3] = max(agg[3], value)
+                agg[4] += value
+                agg[5] += 1
+                if ts >= agg[7]:
+                    agg[6], agg[7] = value, ts
+        if not buckets:
+            return
+        params = [(res, bucket, sid, *agg) for (res, bucket, sid), agg in buckets.items()]
+        self.sql.execute_many("rollups.upsert", params, cursor)
+
+    def _readings_between(self, cursor, start: float, end: float) -> List[Tuple]:
+        """(sensor_id, value, timestamp) trong [start, end): bảng chính + các phân vùng SQLite giao khoảng"""
+        if self.partitions:
+            conn = cursor.connection
+            rows = []
+            for tables in chain([["sensor_readings"]], self.partitions.source_groups(conn, start, end)):
+                union = " UNION ALL ".join(
+                    f"SELECT sensor_id, value, timestamp FROM {t} WHERE timestamp >= ? AND timestamp < ?" for t in tables
                 )
+                rows.extend(conn.execute(union, (start, end) * len(tables)))
+            return rows
+        return [(sid, value, to_epoch(ts))
+                for sid, value, ts in self.sql.tuples("readings.between", (self.sql.ts(start), self.sql.ts(end)), cursor)]
+
+    def backfill_rollups(self, before: float) -> int:
+        """
+        Compactor: dựng rollup cho reading ghi trước khi có rollup (trước lúc áp dụng migration 002)
+        - Mỗi ngày (UTC, chia hết mọi resolution) 1 transaction: xóa rollup của ngày rồi dựng lại từ reading gốc
+          → chạy lại an toàn, không cộng 2 lần reading đã được ingest cộng dồn
+        - High-water mark rollups.backfilled_before trong app_meta ghi cùng transaction → crash thì chạy tiếp
+        - Đọc cả các phân vùng SQLite
+        """
+        if self.use_supabase:
+            return 0  # Supabase: rollup được cộng dồn qua rpc ecoschool_upsert_rollups ngay khi ingest
+        try:
+            applied_at = to_epoch(self.sql.scalar("migrations.applied_at", (2,)))
+            end = min(before, applied_at or before)
+            mark = self.sql.scalar("meta.get", ("rollups.backfilled_before",))
+            if mark is not None:
+                start = float(mark)
             else:
-                cursor.execute(
-                    "INSERT INTO sensor_readings (sensor_id, value, timestamp, quality) VALUES (?, ?, ?, ?)",
-                    (sensor_id, value, time.time(), quality)
-                )
-                cursor.execute(
-                    "UPDATE sensors SET last_value = ?, last_update = ?, status = ? WHERE sensor_id = ?",
-                    (value, time.time(), "ONLINE", sensor_id)
-                )
-                self.connection.commit()
+                firsts = [to_epoch(self.sql.scalar("readings.min_ts"))]
+                if self.partitions and self.partitions.keys():
+                    firsts.append(self.partitions.key_range(self.partitions.keys()[0])[0])
+                firsts = [ts for ts in firsts if ts is not None]
+                if not firsts:
+                    self._transaction(lambda cursor: self.sql.execute("meta.set", ("rollups.backfilled_before", str(end)), cursor))
+                    return 0
+                start = min(firsts)
+            day = max(ROLLUP_RESOLUTIONS)
+            total = 0
+            chunk = int(start // day) * day
+            while chunk < end:
+                def rebuild(cursor, chunk=chunk):
+                    rows = self._readings_between(cursor, chunk, chunk + day)
+                    self.sql.execute("rollups.delete_range", (chunk, chunk + day), cursor)
+                    self._update_rollups(cursor, [(sid, value, ts, None) for sid, value, ts in rows])
+                    self.sql.execute("meta.set", ("rollups.backfilled_before", str(chunk + day)), cursor)
+                    return len(rows)
+                keys = self.partitions.keys_for_range(chunk, chunk + day) if self.partitions else None
+                total += self._transaction(rebuild, keys, raw=True)
+                chunk += day
+            if total:
+                logger.info(f"📊 Rollups backfilled from {total} readings")
+            return total
+        except Exception as e:
+            logger.error(f"❌ Rollup backfill error: {e}")
+            return 0
+
+    def log_sensor_reading(self, sensor_id: str, value: float, quality: str = "GOOD") -> bool:
+        """Ghi dữ liệu cảm biến (last value cập nhật vào SensorStateCache)"""
+        try:
+            now = time.time()
+            reading = (sensor_id, value, now, quality)
+            stored_rows, checkpoint = self._compress([reading])
+            try:
+                self._write_readings(stored_rows, [reading])
+            except Exception:
+                self._restore_compressor(checkpoint)
+                raise
             
-            cursor.close()
+            self.energy.add([reading], self.sensor_state.sensors)
+            changes = self._reading_changes({sensor_id: (now, value)})
+            self.sensor_state.update(sensor_id, value, now)
+            if self.sensor_state_write_through:
+                self.flush_sensor_state()
+            event_bus.publish("reading", count=1, sensors=changes)
             return True
         except Exception as e:
             logger.error(f"❌ Log reading error: {e}")
             return False
-    
+
+    def flush_compressor(self) -> int:
+        """Ghi các điểm swinging-door đang giữ (khi shutdown)"""
+        if not self.compressor:
+            return 0
+        checkpoint = self.compressor.checkpoint()
+        rows = self.compressor.flush()
+        if rows:
+            try:
+                self._write_readings(rows, [])
+            except Exception:
+                self._restore_compressor(checkpoint)
+                raise
+        return len(rows)
+
+    def _reading_changes(self, latest: Dict[str, Tuple[float, float]]) -> List[Dict]:
+        """Giá trị mới / cũ từng sensor cho sự kiện "reading" (gọi trước khi cập nhật SensorStateCache)"""
+        changes = []
+        for sid, (ts, val) in latest.items():
+            entry = self.sensor_state.sensors.get(sid) or {}
+            changes.append({"sensor_id": sid, "room_id": entry.get('room_id'), "sensor_type": entry.get('sensor_type'),
+                            "value": val, "previous": entry.get('last_value'), "timestamp": ts})
+        return changes
+
+    def log_sensor_readings_batch(self, readings: List[Dict]) -> Dict:
+        """
+        Ghi dữ liệu cảm biến theo lô (1 transaction):
+        - INSERT bằng executemany
+        - Rollup cập nhật trong cùng transaction
+        - Last value cập nhật vào SensorStateCache (flush lazily)
+        - Trả về trạng thái từng phần tử
+        """
+        results = []
+        rows = []
+        latest: Dict[str, Tuple[float, float]] = {}
+        now = time.time()
+
+        known = self.sensor_state.sensors
+        for index, item in enumerate(readings):
+            sensor_id = item.get('sensor_id')
+            value = item.get('value')
+            ts = item.get('timestamp')
+            quality = item.get('quality') or "GOOD"
+
+            error = None
+            if sensor_id not in known:
+                error = f"Sensor {sensor_id} not found"
+            elif not is_finite_number(value):
+                error = "Invalid value"
+            elif ts is not None and not is_finite_number(ts):
+                error = "Invalid timestamp (epoch seconds expected)"
+
+            if error:
+                results.append({"index": index, "sensor_id": sensor_id, "status": "REJECTED", "error": error})
+                continue
+
+            ts = now if ts is None else float(ts)
+            rows.append((sensor_id, float(value), ts, quality))
+            if sensor_id not in latest or ts >= latest[sensor_id][0]:
+                latest[sensor_id] = (ts, float(value))
+            results.append({"index": index, "sensor_id": sensor_id, "status": "OK"})
+
+        accepted = len(rows)
+        stored = 0
+        if rows:
+            try:
+                stored_rows, checkpoint = self._compress(rows)
+                try:
+                    self._write_readings(stored_rows, rows)
+                except Exception:
+                    self._restore_compressor(checkpoint)
+                    raise
+                stored = len(stored_rows)
+                self.energy.add(rows, known)
+                changes = self._reading_changes(latest)
+                for sid, (ts, val) in latest.items():
+                    self.sensor_state.update(sid, val, ts)
+                if self.sensor_state_write_through:
+                    self.flush_sensor_state()
+                event_bus.publish("reading", count=accepted, sensors=changes)
+            except Exception as e:
+                logger.error(f"❌ Batch reading error: {e}")
+                accepted = 0
+                for item in results:
+                    if item["status"] == "OK":
+                        item["status"] = "FAILED"
+                        item["error"] = str(e)
+
+        return {
+            "success": accepted > 0 or not readings,
+            "accepted": accepted,
+            "stored": stored,
+            "rejected": len(readings) - accepted,
+            "results": results
+        }
+
     # ========================================================================
     # 🔌 IOT DEVICE CONTROL
     # ========================================================================
@@ -982,22 +4298,9 @@ class UltimateDatabaseManager:
     def add_iot_device(self, device_id: str, room_id: str, device_type: str, device_name: str) -> Dict:
         """Thêm thiết bị IoT"""
         try:
-            cursor = self._get_cursor()
-            
-            if self.use_mysql:
-                cursor.execute(
-                    "INSERT INTO iot_devices (device_id, room_id, device_type, device_name, status) VALUES (%s, %s, %s, %s, %s)",
-                    (device_id, room_id, device_type, device_name, "OFF")
-                )
-            else:
-                cursor.execute(
-                    "INSERT INTO iot_devices VALUES (?, ?, ?, ?, ?, ?, ?)",
-                    (device_id, room_id, device_type, device_name, "OFF", "", time.time())
-                )
-                self.connection.commit()
-            
-            cursor.close()
+            self.sql.execute("devices.insert", (device_id, room_id, device_type, device_name, self.sql.ts(time.time())))
             logger.info(f"✅ IoT device added: {device_id}")
+            event_bus.publish("device.added", device_id=device_id, room_id=room_id, device_type=device_type)
             return {"success": True, "device_id": device_id, "message": f"Đã thêm thiết bị {device_name}"}
         except Exception as e:
             logger.error(f"❌ Add device error: {e}")
@@ -1006,24 +4309,11 @@ class UltimateDatabaseManager:
     def control_device(self, device_id: str, command: str) -> Dict:
         """Điều khiển thiết bị (ON/OFF)"""
         try:
-            cursor = self._get_cursor()
-            
             status = "ON" if command.upper() == "ON" else "OFF"
-            
-            if self.use_mysql:
-                cursor.execute(
-                    "UPDATE iot_devices SET status = %s, last_command = %s, last_update = NOW() WHERE device_id = %s",
-                    (status, command, device_id)
-                )
-            else:
-                cursor.execute(
-                    "UPDATE iot_devices SET status = ?, last_command = ?, last_update = ? WHERE device_id = ?",
-                    (status, command, time.time(), device_id)
-                )
-                self.connection.commit()
-            
-            cursor.close()
+            updated = self.sql.execute("devices.control", (status, command, self.sql.ts(time.time()), device_id))
             logger.info(f"🔌 Device {device_id} -> {status}")
+            if updated:
+                event_bus.publish("device.control", device_id=device_id, status=status, command=command)
             return {"success": True, "status": status, "message": f"Đã {command} thiết bị"}
         except Exception as e:
             logger.error(f"❌ Control device error: {e}")
@@ -1031,177 +4321,196 @@ class UltimateDatabaseManager:
     
     def get_all_devices(self) -> List[Dict]:
         """Lấy danh sách thiết bị"""
-        cursor = self._get_cursor()
-        
-        if self.use_mysql:
-            cursor.execute("""
-                SELECT d.*, r.name as room_name 
-                FROM iot_devices d
-                LEFT JOIN rooms r ON d.room_id = r.room_id
-                ORDER BY d.last_update DESC
-            """)
-            devices = cursor.fetchall()
-        else:
-            cursor.execute("""
-                SELECT d.*, r.name as room_name 
-                FROM iot_devices d
-                LEFT JOIN rooms r ON d.room_id = r.room_id
-                ORDER BY d.last_update DESC
-            """)
-            devices = [dict(row) for row in cursor.fetchall()]
-        
-        cursor.close()
-        return devices
+        return self.sql.dicts("devices.with_room")
     
     # ========================================================================
     # 📈 ANALYTICS & REPORTING
     # ========================================================================
     
     def get_real_time_data(self) -> Dict:
-        """Lấy dữ liệu real-time"""
-        cursor = self._get_cursor()
+        """Lấy dữ liệu real-time (từ SensorStateCache, không query DB)"""
+        sensors = self.sensor_state.snapshot()
         
-        try:
-            if self.use_mysql:
-                cursor.execute("""
-                    SELECT s.*, r.name as room_name
-                    FROM sensors s
-                    LEFT JOIN rooms r ON s.room_id = r.room_id
-                    WHERE s.status = 'ONLINE'
-                    AND s.last_update >= NOW() - INTERVAL 5 MINUTE
-                """)
-                sensors = cursor.fetchall()
-            else:
-                cursor.execute("""
-                    SELECT s.*, r.name as room_name
-                    FROM sensors s
-                    LEFT JOIN rooms r ON s.room_id = r.room_id
-                    WHERE s.status = 'ONLINE'
-                    AND s.last_update > ?
-                """, (time.time() - 300,))
-                sensors = [dict(row) for row in cursor.fetchall()]
-            
-            # Aggregate
-            total_occupancy = 0
-            temps = []
-            total_power = 0.0
-            
-            for sensor in sensors:
-                stype = sensor['sensor_type'] if isinstance(sensor, dict) else sensor['sensor_type']
-                value = sensor['last_value'] if isinstance(sensor, dict) else sensor['last_value']
-                
-                if stype == 'occupancy':
-                    total_occupancy += int(value)
-                elif stype == 'temperature':
-                    temps.append(value)
-                elif stype == 'power':
-                    total_power += value
+        # Aggregate
+        total_occupancy = 0
+        temps = []
+        total_power = 0.0
+        
+        for sensor in sensors:
+            stype = sensor['sensor_type']
+            value = sensor['last_value']
             
+            if stype == 'occupancy':
+                total_occupancy += int(value)
+            elif stype == 'temperature':
+                temps.append(value)
+            elif stype == 'power':
+                total_power += value
+        
+        return {
+            "sensors": sensors,
+            "total_occupancy": total_occupancy,
+            "avg_temperature": sum(temps) / len(temps) if temps else 0,
+            "total_power": total_power,
+            "energy_today": self.energy.total(),
+            "sensor_count": len(sensors)
+        }
+    
+    # ========================================================================
+    # 🗃️ RETENTION & ARCHIVE
+    # ========================================================================
+
+    def run_retention(self, now: Optional[float] = None) -> Dict:
+        """Chuyển reading cũ hơn RETENTION_DAYS sang archive cột rồi xóa khỏi sensor_readings"""
+        if RETENTION_DAYS <= 0:
+            return {"archived": 0}
+        cutoff = (now or time.time()) - RETENTION_DAYS * 86400
+        cutoff_param = self.sql.ts(cutoff)
+        archived = 0
+        started = time.time()
+
+        try:
+            cursor = self._get_cursor(raw=True)
+            if self.partitions:
+                archived += self._retire_partitions(cursor, cutoff)
+            while True:
+                rows = self.sql.tuples("readings.expired", (cutoff_param, RETENTION_CHUNK), cursor)
+                if not rows:
+                    break
+
+                by_sensor: Dict[str, List[Tuple[float, float]]] = defaultdict(list)
+                for _, sensor_id, ts, value in rows:
+                    by_sensor[sensor_id].append((to_epoch(ts), value))
+                for sensor_id, points in by_sensor.items():
+                    self.archive.append(sensor_id, points)
+
+                # Chỉ xóa sau khi segment đã fsync
+                self.sql.execute("readings.delete_expired", (rows[-1][0], cutoff_param), cursor)
+                if not self.use_mysql:
+                    self.connection.commit()
+                archived += len(rows)
+                if len(rows) < RETENTION_CHUNK:
+                    break
             cursor.close()
-            
-            return {
-                "sensors": sensors,
-                "total_occupancy": total_occupancy,
-                "avg_temperature": sum(temps) / len(temps) if temps else 0,
-                "total_power": total_power,
-                "sensor_count": len(sensors)
-            }
         except Exception as e:
-            logger.error(f"❌ Get real-time data error: {e}")
-            cursor.close()
-            return {
-                "sensors": [],
-                "total_occupancy": 0,
-                "avg_temperature": 0,
-                "total_power": 0,
-                "sensor_count": 0
-            }
-    
-    def get_analytics_data(self, hours: int = 24) -> Dict:
-        """Lấy dữ liệu phân tích tổng hợp"""
-        cursor = self._get_cursor()
+            logger.error(f"❌ Retention error: {e}")
+
+        if archived:
+            logger.info(f"🗃️  Retention: archived {archived} readings in {time.time() - started:.1f}s")
+        return {"archived": archived, "cutoff": cutoff}
+
+    def _retire_partitions(self, cursor, cutoff: float) -> int:
+        """Chuyển nguyên phân vùng cũ sang archive rồi xóa file phân vùng"""
+        archived = 0
+        for key in self.partitions.keys():
+            if self.partitions.key_range(key)[1] > cutoff:
+                continue
+            with self.engine.reader() as conn:
+                alias = self.partitions.attach(conn, [key])[0]
+                rows = conn.execute(f"SELECT sensor_id, timestamp, value FROM {alias}.sensor_readings").fetchall()
+            by_sensor: Dict[str, List[Tuple[float, float]]] = defaultdict(list)
+            for row in rows:
+                by_sensor[row['sensor_id']].append((row['timestamp'], row['value']))
+            for sensor_id, points in by_sensor.items():
+                self.archive.append(sensor_id, points)
+            self.drop_partition(key)
+            archived += len(rows)
+        return archived
+
+    def drop_partition(self, key: str) -> bool:
+        """Xóa 1 phân vùng SQLite (DETACH + xóa file)"""
+        if not self.partitions:
+            return False
+        with self.engine.all_readers() as readers:
+            dropped = self.engine.autocommit(lambda conn: self.partitions.drop(key, [conn] + readers))
+        if dropped:
+            logger.info(f"🧩 Partition dropped: {key}")
+        return dropped
+
+    def _archive_history(self, sensor_type: str, start: float, end: float, room_id: Optional[str] = None) -> List[Dict]:
+        """Đọc phần chuỗi đã nằm trong archive (cũ hơn mốc retention)"""
+        if RETENTION_DAYS <= 0:
+            return []
+        end = min(end, time.time() - RETENTION_DAYS * 86400)
+        if start >= end:
+            return []
+        sensor_ids = [sid for sid, e in self.sensor_state.sensors.items()
+                      if e['sensor_type'] == sensor_type and (room_id is None or e['room_id'] == room_id)]
+        return self.archive.query(sensor_ids, start, end)
+
+    def _pick_rollup(self, hours: float, resolution: Optional[int] = None) -> int:
+        """Chọn rollup thô nhất thỏa độ phân giải yêu cầu (0 = đọc dữ liệu gốc)"""
+        if resolution is None:
+            resolution = hours * 3600 / ANALYTICS_TARGET_POINTS
+        candidates = [r for r in ROLLUP_RESOLUTIONS if r <= resolution]
+        return max(candidates) if candidates else 0
+
+    @staticmethod
+    def _rollup_start(hours: float, rollup: int) -> int:
+        """bucket_start đầu tiên nằm trọn trong cửa sổ hours (làm tròn lên, không kéo thêm tới 1 bucket trước cutoff)"""
+        cutoff = time.time() - hours * 3600
+        return -int(-cutoff // rollup) * rollup
+
+    def _series(self, cursor, sensor_type: str, hours: float, rollup: int, room_id: Optional[str] = None) -> List[Tuple]:
+        """Chuỗi (timestamp, value) của 1 loại sensor (từ rollup hoặc sensor_readings)"""
+        cutoff = time.time() - hours * 3600
+        room = (room_id,) if room_id else ()
+        if rollup:
+            agg = "sum" if sensor_type in ADDITIVE_SENSOR_TYPES else "avg"
+            name = f"rollups.series_room_{agg}" if room_id else f"rollups.series_{agg}"
+            series = self.sql.tuples(name, (rollup, sensor_type, self._rollup_start(hours, rollup)) + room, cursor)
+        elif self.partitions:
+            room_filter = " AND room_id = ?" if room_id else ""
+            series = []
+            with self.engine.reader() as conn:
+                # source_groups ATTACH từng nhóm khi được duyệt tới → query ngay trong vòng lặp
+                for tables in chain([["sensor_readings"]], self.partitions.source_groups(conn, cutoff, time.time() + 1)):
+                    # Mỗi nhánh UNION đọc thẳng index phủ (room_id, sensor_type, timestamp, value)
+                    union = " UNION ALL ".join(
+                        f"SELECT timestamp, value FROM {t} WHERE sensor_type = ? AND timestamp > ?{room_filter}" for t in tables
+                    )
+                    series.extend(tuple(row) for row in conn.execute(union, ((sensor_type, cutoff) + room) * len(tables)))
+            series.sort()
+        else:
+            name = "readings.series_room" if room_id else "readings.series"
+            series = self.sql.tuples(name, (sensor_type, self.sql.ts(cutoff)) + room, cursor)
+        if not rollup:
+            archived = self._archive_history(sensor_type, cutoff, time.time(), room_id)
+            if archived:
+                return [(p["timestamp"], p["value"]) for p in archived] + [(to_epoch(ts), value) for ts, value in series]
+        return series
+
+    def _history(self, cursor, sensor_type: str, hours: float, rollup: int, room_id: Optional[str] = None) -> List[Dict]:
+        """Chuỗi {timestamp, value} của 1 loại sensor"""
+        return [{"timestamp": ts, "value": value} for ts, value in self._series(cursor, sensor_type, hours, rollup, room_id)]
+
+    def get_analytics_data(self, hours: int = 24, resolution: Optional[int] = None,
+                           bucket: Optional[int] = None, agg: str = "avg", max_points: Optional[int] = None) -> Dict:
+        """Lấy dữ liệu phân tích tổng hợp (tự động đọc từ rollup phù hợp)"""
+        if bucket:
+            return self._bucketed_analytics(hours, resolution, bucket, agg, max_points)
+        cursor = self.sql.read_cursor("rollups.series_sum", "readings.series", "decisions.count_since", "alerts.by_severity_since")
+        rollup = self._pick_rollup(hours, resolution)
         
         try:
-            if self.use_mysql:
-                cursor.execute("""
-                    SELECT timestamp, value FROM sensor_readings 
-                    WHERE sensor_id IN (SELECT sensor_id FROM sensors WHERE sensor_type='power')
-                    AND timestamp >= NOW() - INTERVAL %s HOUR
-                    ORDER BY timestamp
-                """, (hours,))
-                energy_history = cursor.fetchall()
-                
-                cursor.execute("""
-                    SELECT timestamp, value FROM sensor_readings 
-                    WHERE sensor_id IN (SELECT sensor_id FROM sensors WHERE sensor_type='occupancy')
-                    AND timestamp >= NOW() - INTERVAL %s HOUR
-                    ORDER BY timestamp
-                """, (hours,))
-                occupancy_history = cursor.fetchall()
-                
-                cursor.execute("""
-                    SELECT timestamp, value FROM sensor_readings 
-                    WHERE sensor_id IN (SELECT sensor_id FROM sensors WHERE sensor_type='temperature')
-                    AND timestamp >= NOW() - INTERVAL %s HOUR
-                    ORDER BY timestamp
-                """, (hours,))
-                temp_history = cursor.fetchall()
-                
-                cursor.execute("SELECT COUNT(*) as count FROM ai_decisions WHERE timestamp >= NOW() - INTERVAL %s HOUR", (hours,))
-                ai_count = cursor.fetchone()['count']
-                
-                cursor.execute("""
-                    SELECT severity, COUNT(*) as count FROM alerts 
-                    WHERE timestamp >= NOW() - INTERVAL %s HOUR 
-                    GROUP BY severity
-                """, (hours,))
-                alerts_by_severity = {row['severity']: row['count'] for row in cursor.fetchall()}
-            else:
-                cutoff = time.time() - (hours * 3600)
-                
-                cursor.execute("""
-                    SELECT timestamp, value FROM sensor_readings 
-                    WHERE sensor_id IN (SELECT sensor_id FROM sensors WHERE sensor_type='power')
-                    AND timestamp > ?
-                    ORDER BY timestamp
-                """, (cutoff,))
-                energy_history = [dict(row) for row in cursor.fetchall()]
-                
-                cursor.execute("""
-                    SELECT timestamp, value FROM sensor_readings 
-                    WHERE sensor_id IN (SELECT sensor_id FROM sensors WHERE sensor_type='occupancy')
-                    AND timestamp > ?
-                    ORDER BY timestamp
-                """, (cutoff,))
-                occupancy_history = [dict(row) for row in cursor.fetchall()]
-                
-                cursor.execute("""
-                    SELECT timestamp, value FROM sensor_readings 
-                    WHERE sensor_id IN (SELECT sensor_id FROM sensors WHERE sensor_type='temperature')
-                    AND timestamp > ?
-                    ORDER BY timestamp
-                """, (cutoff,))
-                temp_history = [dict(row) for row in cursor.fetchall()]
-                
-                cursor.execute("SELECT COUNT(*) as count FROM ai_decisions WHERE timestamp > ?", (cutoff,))
-                ai_count = cursor.fetchone()['count']
-                
-                cursor.execute("""
-                    SELECT severity, COUNT(*) as count FROM alerts 
-                    WHERE timestamp > ? 
-                    GROUP BY severity
-                """, (cutoff,))
-                alerts_by_severity = {row['severity']: row['count'] for row in cursor.fetchall()}
+            energy_history = self._history(cursor, 'power', hours, rollup)
+            occupancy_history = self._history(cursor, 'occupancy', hours, rollup)
+            temp_history = self._history(cursor, 'temperature', hours, rollup)
             
+            cutoff = self.sql.ts(time.time() - hours * 3600)
+            ai_count = self.sql.scalar("decisions.count_since", (cutoff,), cursor)
+            alerts_by_severity = dict(self.sql.tuples("alerts.by_severity_since", (cutoff,), cursor))
+
             cursor.close()
             
             return {
-                "energy_history": energy_history,
-                "occupancy_history": occupancy_history,
-                "temp_history": temp_history,
+                "energy_history": downsample_points(energy_history, max_points),
+                "occupancy_history": downsample_points(occupancy_history, max_points),
+                "temp_history": downsample_points(temp_history, max_points),
                 "ai_decisions_count": ai_count,
                 "alerts_by_severity": alerts_by_severity,
-                "time_range": hours
+                "time_range": hours,
+                "resolution": rollup
             }
         except Exception as e:
             logger.error(f"❌ Get analytics error: {e}")
@@ -1212,9 +4521,57 @@ class UltimateDatabaseManager:
                 "temp_history": [],
                 "ai_decisions_count": 0,
                 "alerts_by_severity": {},
-                "time_range": hours
+                "time_range": hours,
+                "resolution": rollup
             }
     
+    def _partials(self, cursor, sensor_type: str, hours: float, rollup: int) -> List[Tuple]:
+        """(timestamp, sum, min, max, count) của 1 loại sensor: mỗi bucket rollup (mọi sensor) hoặc mỗi reading"""
+        if rollup:
+            return self.sql.tuples("rollups.buckets", (rollup, sensor_type, self._rollup_start(hours, rollup)), cursor)
+        return [(ts, value, value, value, 1) for ts, value in self._series(cursor, sensor_type, hours, 0) if value is not None]
+
+    def _bucketed_analytics(self, hours: int, resolution: Optional[int], bucket: int, agg: str,
+                            max_points: Optional[int] = None) -> Dict:
+        """
+        Analytics dạng cột: timestamps[] + series{power, occupancy, temperature}[] căn theo bucket cố định
+        → kích thước response chỉ phụ thuộc số bucket, không phụ thuộc khoảng thời gian
+        """
+        if agg not in ANALYTICS_AGGS:
+            raise ValueError(f"invalid agg: {agg}")
+        if resolution is None:
+            # Rollup thô nhất chia hết bucket → mỗi bucket gộp đúng từ các bucket rollup con
+            candidates = [r for r in ROLLUP_RESOLUTIONS if r <= bucket and bucket % r == 0]
+            rollup = max(candidates) if candidates else 0
+        else:
+            rollup = self._pick_rollup(hours, resolution)
+        cursor = self.sql.read_cursor("rollups.buckets", "readings.series", "decisions.count_since", "alerts.by_severity_since")
+        try:
+            buckets = {name: bucket_partials(self._partials(cursor, name, hours, rollup), bucket, agg)
+                       for name in ('power', 'occupancy', 'temperature')}
+            cutoff = self.sql.ts(time.time() - hours * 3600)
+            ai_count = self.sql.scalar("decisions.count_since", (cutoff,), cursor)
+            alerts_by_severity = dict(self.sql.tuples("alerts.by_severity_since", (cutoff,), cursor))
+        except Exception as e:
+            logger.error(f"❌ Get analytics error: {e}")
+            buckets, ai_count, alerts_by_severity = {'power': {}, 'occupancy': {}, 'temperature': {}}, 0, {}
+        finally:
+            cursor.close()
+        timestamps = sorted(set().union(*buckets.values()))
+        series = {name: [round(values[t], 3) if t in values else None for t in timestamps]
+                  for name, values in buckets.items()}
+        timestamps, series = downsample_columns(timestamps, series, max_points)
+        return {
+            "bucket": bucket,
+            "agg": agg,
+            "resolution": rollup,
+            "timestamps": timestamps,
+            "series": series,
+            "ai_decisions_count": ai_count,
+            "alerts_by_severity": alerts_by_severity,
+            "time_range": hours
+        }
+
     # ========================================================================
     # 🔐 USER & AUTH
     # ========================================================================
@@ -1222,25 +4579,8 @@ class UltimateDatabaseManager:
     def verify_user(self, username: str, password: str) -> Optional[Dict]:
         """Xác thực người dùng"""
         input_hash = hashlib.sha256(password.encode()).hexdigest()
-        cursor = self._get_cursor()
-        
-        if self.use_mysql:
-            cursor.execute(
-                "SELECT role, language FROM users WHERE username = %s AND password_hash = %s",
-                (username, input_hash)
-            )
-            row = cursor.fetchone()
-        else:
-            cursor.execute(
-                "SELECT role, language FROM users WHERE username = ? AND password_hash = ?",
-                (username, input_hash)
-            )
-            row = cursor.fetchone()
-            if row:
-                row = dict(row)
-        
-        cursor.close()
-        return row
+        rows = self.sql.dicts("users.verify", (username, input_hash))
+        return rows[0] if rows else None
     
     # ========================================================================
     # 💬 CHAT & KNOWLEDGE
@@ -1248,59 +4588,16 @@ class UltimateDatabaseManager:
     
     def save_chat(self, user_msg: str, ai_response: str, language: str = 'vi', context: Dict = None):
         """Lưu lịch sử chat"""
-        cursor = self._get_cursor()
-        
-        if self.use_mysql:
-            cursor.execute(
-                "INSERT INTO chat_history (user_msg, ai_response, language, context) VALUES (%s, %s, %s, %s)",
-                (user_msg, ai_response, language, json.dumps(context) if context else None)
-            )
-        else:
-            cursor.execute(
-                "INSERT INTO chat_history (user_msg, ai_response, timestamp, language, context) VALUES (?, ?, ?, ?, ?)",
-                (user_msg, ai_response, time.time(), language, json.dumps(context) if context else None)
-            )
-            self.connection.commit()
-        
-        cursor.close()
+        self.sql.execute("chat.insert", (user_msg, ai_response, self.sql.ts(time.time()), language,
+                                         json.dumps(context) if context else None))
     
     def get_chat_history(self, limit: int = 50) -> List[Dict]:
         """Lấy lịch sử chat"""
-        cursor = self._get_cursor()
-        
-        if self.use_mysql:
-            cursor.execute(
-                "SELECT * FROM chat_history ORDER BY timestamp DESC LIMIT %s",
-                (limit,)
-            )
-            history = cursor.fetchall()
-        else:
-            cursor.execute(
-                "SELECT * FROM chat_history ORDER BY timestamp DESC LIMIT ?",
-                (limit,)
-            )
-            history = [dict(row) for row in cursor.fetchall()]
-        
-        cursor.close()
-        return history
+        return self.sql.dicts("chat.recent", (limit,))
     
     def save_knowledge(self, topic: str, content: str, source: str = "CHAT", importance: int = 5):
         """Lưu kiến thức học được"""
-        cursor = self._get_cursor()
-        
-        if self.use_mysql:
-            cursor.execute(
-                "INSERT INTO ai_knowledge (topic, content, source, importance) VALUES (%s, %s, %s, %s)",
-                (topic, content, source, importance)
-            )
-        else:
-            cursor.execute(
-                "INSERT INTO ai_knowledge (topic, content, source, timestamp, importance) VALUES (?, ?, ?, ?, ?)",
-                (topic, content, source, time.time(), importance)
-            )
-            self.connection.commit()
-        
-        cursor.close()
+        self.sql.execute("knowledge.insert", (topic, content, source, self.sql.ts(time.time()), importance))
         logger.info(f"📚 Knowledge saved: {topic}")
     
     # ========================================================================
@@ -1309,57 +4606,24 @@ class UltimateDatabaseManager:
     
     def log_ai_decision(self, decision: Dict):
         """Ghi quyết định AI"""
-        cursor = self._get_cursor()
-        
-        if self.use_mysql:
-            cursor.execute("""
-                INSERT INTO ai_decisions (id, agent_name, decision_type, target, action, reasoning, confidence, status, approved_by)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """, (
-                decision['id'], decision['agent'], decision['type'],
-                decision['target'], decision['action'], decision['reasoning'],
-                decision['confidence'], decision['status'], decision.get('approved_by')
-            ))
-        else:
-            cursor.execute("""
-                INSERT OR REPLACE INTO ai_decisions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                decision['id'], decision['agent'], decision['type'],
-                decision['target'], decision['action'], decision['reasoning'],
-                decision['confidence'], decision['timestamp'], decision['status'], decision.get('approved_by')
-            ))
-            self.connection.commit()
-        
-        cursor.close()
+        self.sql.execute("decisions.upsert", (
+            decision['id'], decision['agent'], decision['type'],
+            decision['target'], decision['action'], decision['reasoning'],
+            decision['confidence'], self.sql.ts(decision['timestamp']), decision['status'], decision.get('approved_by')
+        ))
+        event_bus.publish("decision.logged", id=decision['id'], agent=decision['agent'], type=decision['type'],
+                          target=decision['target'], action=decision['action'])
     
     def get_ai_decisions(self, limit: int = 20) -> List[Dict]:
         """Lấy lịch sử quyết định"""
-        cursor = self._get_cursor()
-        if self.use_mysql:
-            cursor.execute("SELECT * FROM ai_decisions ORDER BY timestamp DESC LIMIT %s", (limit,))
-            res = cursor.fetchall()
-        else:
-            cursor.execute("SELECT * FROM ai_decisions ORDER BY timestamp DESC LIMIT ?", (limit,))
-            res = [dict(row) for row in cursor.fetchall()]
-        cursor.close()
-        return res
+        return self.sql.dicts("decisions.recent", (limit,))
 
     def log_ai_decision(self, agent_name: str, d_type: str, target: str, action: str, reasoning: str, confidence: float, status: str = "COMPLETED"):
         try:
-            cursor = self._get_cursor()
             id = f"DEC-{secrets.token_hex(4).upper()}"
-            if self.use_mysql:
-                cursor.execute(
-                    "INSERT INTO ai_decisions (id, agent_name, decision_type, target, action, reasoning, confidence, status) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
-                    (id, agent_name, d_type, target, action, reasoning, confidence, status)
-                )
-            else:
-                cursor.execute(
-                    "INSERT INTO ai_decisions (id, agent_name, decision_type, target, action, reasoning, confidence, timestamp, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                    (id, agent_name, d_type, target, action, reasoning, confidence, time.time(), status)
-                )
-                self.connection.commit()
-            cursor.close()
+            self.sql.execute("decisions.insert", (id, agent_name, d_type, target, action, reasoning, confidence,
+                                                  self.sql.ts(time.time()), status))
+            event_bus.publish("decision.logged", id=id, agent=agent_name, type=d_type, target=target, action=action)
             return id
         except Exception as e:
             logger.error(f"Error logging decision: {e}")
@@ -1367,19 +4631,7 @@ class UltimateDatabaseManager:
 
     def log_safety_event(self, location: str, risk: str, e_type: str, desc: str, action: str):
         try:
-            cursor = self._get_cursor()
-            if self.use_mysql:
-                cursor.execute(
-                    "INSERT INTO safety_watchdog_logs (location_id, risk_level, event_type, description, automated_action) VALUES (%s, %s, %s, %s, %s)",
-                    (location, risk, e_type, desc, action)
-                )
-            else:
-                cursor.execute(
-                    "INSERT INTO safety_watchdog_logs (location_id, risk_level, event_type, description, automated_action, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
-                    (location, risk, e_type, desc, action, time.time())
-                )
-                self.connection.commit()
-            cursor.close()
+            self.sql.execute("safety.insert", (location, risk, e_type, desc, action, self.sql.ts(time.time())))
             return True
         except Exception as e:
             logger.error(f"Error logging safety event: {e}")
@@ -1387,45 +4639,908 @@ class UltimateDatabaseManager:
     
     def save_alert(self, alert: Dict):
         """Lưu cảnh báo"""
-        cursor = self._get_cursor()
-        
-        if self.use_mysql:
-            cursor.execute("""
-                INSERT INTO alerts (alert_id, severity, title, message, location)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (
-                alert['alert_id'], alert['severity'], alert['title'],
-                alert['message'], alert['location']
-            ))
-        else:
-            cursor.execute("""
-                INSERT OR REPLACE INTO alerts VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                alert['alert_id'], alert['severity'], alert['title'],
-                alert['message'], alert['location'], alert['timestamp'],
-                alert.get('acknowledged', 0), alert.get('resolved', 0)
-            ))
-            self.connection.commit()
-        
-        cursor.close()
+        self.sql.execute("alerts.upsert", (
+            alert['alert_id'], alert['severity'], alert['title'],
+            alert['message'], alert['location'], self.sql.ts(alert['timestamp']),
+            alert.get('acknowledged', 0), alert.get('resolved', 0)
+        ))
+        event_bus.publish("alert.saved", alert_id=alert['alert_id'], severity=alert['severity'],
+                          title=alert['title'], location=alert['location'])
     
     def get_active_alerts(self) -> List[Dict]:
         """Lấy cảnh báo active"""
-        cursor = self._get_cursor()
-        
-        if self.use_mysql:
-            cursor.execute("SELECT * FROM alerts WHERE resolved = FALSE ORDER BY timestamp DESC")
-            alerts = cursor.fetchall()
-        else:
-            cursor.execute("SELECT * FROM alerts WHERE resolved = 0 ORDER BY timestamp DESC")
-            alerts = [dict(row) for row in cursor.fetchall()]
-        
-        cursor.close()
-        return alerts
+        return self.sql.dicts("alerts.active")
 
 # Initialize database
 db = UltimateDatabaseManager()
 
+# ============================================================================
+# ⚡ ASYNC DATA ACCESS (non-blocking facade cho endpoint & agent)
+# ============================================================================
+
+class DataAccessTimeout(TimeoutError):
+    """Lời gọi database vượt quá timeout của nhóm method (future: lời gọi vẫn đang chạy trên executor)"""
+
+    def __init__(self, message: str, future: Optional[asyncio.Future] = None):
+        super().__init__(message)
+        self.future = future
+
+
+class AsyncDataAccess:
+    """
+    Bọc các method của UltimateDatabaseManager thành coroutine:
+    - Chạy trên ThreadPoolExecutor giới hạn → event loop không bị chặn
+    - Mỗi nhóm method (ingest / control / analytics / ...) có semaphore riêng
+      → query analytics dài không chiếm hết worker của ingest và điều khiển
+    - Timeout theo nhóm (DataAccessTimeout → HTTP 504)
+    Dùng: await adb.get_analytics_data(24)
+    """
+
+    def __init__(self, manager: UltimateDatabaseManager):
+        self.db = manager
+        # MySQL: mỗi worker mượn connection riêng từ pool → không vượt quá kích thước pool
+        self.max_workers = min(DAL_MAX_WORKERS, MYSQL_POOL_MAX) if manager.use_mysql else DAL_MAX_WORKERS
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="dal")
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._loop = None
+        self.stats: Dict[str, Dict] = {group: {"calls": 0, "active": 0, "timeouts": 0, "errors": 0, "max_ms": 0.0}
+                                       for group in DAL_LIMITS}
+
+    def _semaphore(self, group: str) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Semaphore gắn với event loop → tạo lại khi loop đổi (uvicorn reload, test client)
+            self._loop = loop
+            self._semaphores = {}
+        if group not in self._semaphores:
+            self._semaphores[group] = asyncio.Semaphore(DAL_LIMITS[group][0])
+        return self._semaphores[group]
+
+    async def call(self, name: str, *args, **kwargs):
+        group = DAL_METHOD_GROUPS.get(name, "default")
+        timeout = DAL_LIMITS[group][1]
+        stats = self.stats[group]
+        semaphore = self._semaphore(group)
+        started = time.perf_counter()
+        await semaphore.acquire()
+        stats["calls"] += 1
+        stats["active"] += 1
+
+        def done(_):
+            # Slot chỉ được trả khi luồng thật sự xong (kể cả khi caller đã timeout)
+            stats["active"] -= 1
+            stats["max_ms"] = max(stats["max_ms"], round((time.perf_counter() - started) * 1000, 2))
+            semaphore.release()
+
+        future = asyncio.get_running_loop().run_in_executor(self.executor, partial(getattr(self.db, name), *args, **kwargs))
+        future.add_done_callback(done)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            stats["timeouts"] += 1
+            logger.warning(f"⏱️ DB call {name} exceeded {timeout:g}s ({group})")
+            raise DataAccessTimeout(f"{name} timed out after {timeout:g}s", future)
+        except Exception:
+            stats["errors"] += 1
+            raise
+
+    def __getattr__(self, name: str):
+        if name.startswith("_") or not callable(getattr(self.db, name, None)):
+            raise AttributeError(name)
+        return partial(self.call, name)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def get_stats(self) -> Dict:
+        return {
+            "max_workers": self.max_workers,
+            "groups": {group: {**stats, "limit": DAL_LIMITS[group][0], "timeout": DAL_LIMITS[group][1]}
+                       for group, stats in self.stats.items()}
+        }
+
+adb = AsyncDataAccess(db)
+
+# ============================================================================
+# 📥 WRITE-BEHIND INGESTION BUFFER (Group Commit)
+# ============================================================================
+
+class ReadingWriteBuffer:
+    """
+    Hàng đợi ghi dữ liệu cảm biến (write-behind):
+    - Nhận reading ngay lập tức, không chặn event loop
+    - Group commit khi đủ batch_size hoặc hết flush_interval
+    - Backpressure khi hàng đợi đầy
+    - Lô quá timeout vẫn có thể được commit → giữ "in-flight" tới khi lời gọi thật sự xong (không tính lỗi, không trả credit)
+    - Flush sạch khi shutdown
+    """
+
+    def __init__(self, batch_size: int = INGEST_BATCH_SIZE, flush_interval: float = INGEST_FLUSH_INTERVAL,
+                 max_queue: int = INGEST_QUEUE_SIZE, enqueue_timeout: float = INGEST_ENQUEUE_TIMEOUT):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.enqueue_timeout = enqueue_timeout
+        self.queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._in_flight = set()  # future của các lô đã quá timeout nhưng còn chạy
+        self.stats = {
+            "enqueued": 0,
+            "flushed": 0,
+            "rejected": 0,
+            "failed": 0,
+            "in_flight": 0,
+            "flush_timeouts": 0,
+            "backpressure_waits": 0,
+            "backpressure_timeouts": 0,
+            "batches": 0,
+            "batched": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "last_flush_ms": 0.0,
+            "avg_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "last_queue_age_ms": 0.0
+        }
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        """Khởi động task flush nền"""
+        if self.running:
+            return
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"📥 Ingest buffer started (batch={self.batch_size}, interval={self.flush_interval}s, queue={self.max_queue})")
+
+    async def submit(self, sensor_id: str, value: float, quality: str = "GOOD", timestamp: Optional[float] = None,
+                     stream: Optional[Dict] = None) -> bool:
+        """
+        Đưa reading vào hàng đợi; chờ tối đa enqueue_timeout nếu đầy (backpressure → False)
+        ValueError nếu value / timestamp không phải số hữu hạn
+        stream: bộ đếm {"pending": n} của kết nối, giảm khi reading được flush xong
+        """
+        if not is_finite_number(value) or (timestamp is not None and not is_finite_number(timestamp)):
+            raise ValueError("value and timestamp must be finite numbers")
+        item = {
+            "sensor_id": sensor_id,
+            "value": float(value),
+            "quality": quality,
+            "timestamp": time.time() if timestamp is None else float(timestamp)
+        }
+        if stream is not None:
+            item["_stream"] = stream
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.stats["backpressure_waits"] += 1
+            try:
+                await asyncio.wait_for(self.queue.put(item), timeout=self.enqueue_timeout)
+            except asyncio.TimeoutError:
+                self.stats["backpressure_timeouts"] += 1
+                return False
+        self.stats["enqueued"] += 1
+        if stream is not None:
+            stream["pending"] += 1
+        return True
+
+    async def submit_many(self, items: List[Dict], stream: Optional[Dict] = None) -> int:
+        """Đưa nhiều reading vào hàng đợi, trả về số reading đã nhận"""
+        accepted = 0
+        for item in items:
+            try:
+                if not await self.submit(item["sensor_id"], item["value"], item.get("quality") or "GOOD",
+                                         item.get("timestamp"), stream):
+                    break
+            except ValueError:
+                self.stats["rejected"] += 1
+                continue
+            accepted += 1
+        return accepted
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                # Không để 1 lô lỗi làm dừng task (hàng đợi sẽ không bao giờ được xả)
+                logger.error(f"❌ Ingest flush loop error: {e}")
+
+    def _settle(self, batch: List[Dict], result: Optional[Dict]):
+        """Ghi nhận kết quả 1 lô (result None = lỗi) và trả credit cho kết nối stream"""
+        if result is None:
+            self.stats["failed"] += len(batch)
+        else:
+            self.stats["flushed"] += result.get("accepted", 0)
+            failed = sum(1 for r in result.get("results", []) if r["status"] == "FAILED")
+            self.stats["failed"] += failed
+            self.stats["rejected"] += result.get("rejected", 0) - failed
+        # Trả credit (kể cả khi lỗi, để client không bị treo)
+        for item in batch:
+            stream = item.get("_stream")
+            if stream is not None:
+                stream["pending"] -= 1
+
+    def _settle_late(self, batch: List[Dict], future: asyncio.Future):
+        """Lô đã quá timeout chạy xong trên executor → mới tính flushed / failed"""
+        self._in_flight.discard(future)
+        self.stats["in_flight"] -= len(batch)
+        error = future.exception()
+        if error:
+            logger.error(f"❌ Ingest flush error (after timeout): {error}")
+        self._settle(batch, None if error else future.result())
+
+    async def _flush(self, batch: List[Dict]):
+        started = time.time()
+        try:
+            self._settle(batch, await adb.log_sensor_readings_batch(batch))
+        except DataAccessTimeout as e:
+            if e.future is None:
+                self._settle(batch, None)
+            else:
+                # Writer vẫn có thể commit lô này → chưa phải lỗi, giữ credit tới khi future xong
+                logger.warning(f"⏱️ Ingest flush of {len(batch)} readings still running after timeout")
+                self.stats["flush_timeouts"] += 1
+                self.stats["in_flight"] += len(batch)
+                self._in_flight.add(e.future)
+                e.future.add_done_callback(partial(self._settle_late, batch))
+        except Exception as e:
+            logger.error(f"❌ Ingest flush error: {e}")
+            self._settle(batch, None)
+
+        elapsed_ms = (time.time() - started) * 1000
+        s = self.stats
+        s["batches"] += 1
+        s["batched"] += len(batch)
+        s["last_batch_size"] = len(batch)
+        s["max_batch_size"] = max(s["max_batch_size"], len(batch))
+        s["last_flush_ms"] = round(elapsed_ms, 2)
+        s["avg_flush_ms"] = round(elapsed_ms if s["batches"] == 1 else s["avg_flush_ms"] * 0.9 + elapsed_ms * 0.1, 2)
+        s["max_flush_ms"] = round(max(s["max_flush_ms"], elapsed_ms), 2)
+        timestamp = batch[0].get("timestamp")
+        if is_finite_number(timestamp):
+            s["last_queue_age_ms"] = round((started - timestamp) * 1000, 2)
+
+    async def stop(self):
+        """Flush toàn bộ hàng đợi rồi dừng"""
+        if not self.running:
+            return
+        await self.queue.put(None)
+        await self._task
+        if self._in_flight:
+            await asyncio.wait(list(self._in_flight))
+        logger.info(f"📥 Ingest buffer stopped ({self.stats['flushed']} readings flushed)")
+
+    def get_stats(self) -> Dict:
+        return {
+            **self.stats,
+            "compression": db.compressor.get_stats() if db.compressor else {"enabled": False},
+            "running": self.running,
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "max_queue": self.max_queue,
+            "batch_size_limit": self.batch_size,
+            "flush_interval": self.flush_interval,
+            "avg_batch_size": round(self.stats["batched"] / self.stats["batches"], 1) if self.stats["batches"] else 0
+        }
+
+ingest_buffer = ReadingWriteBuffer()
+
+async def sensor_state_flush_loop():
+    """Flush định kỳ SensorStateCache xuống bảng sensors"""
+    while True:
+        await asyncio.sleep(SENSOR_STATE_FLUSH_INTERVAL)
+        try:
+            await adb.flush_sensor_state()
+        except Exception as e:
+            logger.error(f"❌ Sensor state flush error: {e}")
+
+class NDJSONReadingParser:
+    """Parse NDJSON readings tăng dần (dòng có thể bị cắt giữa các frame)"""
+
+    def __init__(self, max_line: int = INGEST_MAX_LINE):
+        self._tail = ""
+        self._overflow = False  # đang bỏ qua phần còn lại của 1 dòng quá dài
+        self.max_line = max_line
+        self.line_no = 0
+
+    def feed(self, chunk: str) -> Tuple[List[Dict], List[Dict]]:
+        data = self._tail + chunk
+        lines = data.split("\n")
+        self._tail = lines.pop()
+        if self._overflow:
+            if not lines:
+                self._tail = ""
+                return [], []
+            # Dòng quá dài kết thúc ở frame này → bỏ phần đuôi của nó
+            lines.pop(0)
+            self._overflow = False
+        readings, errors = self._parse_lines(lines)
+        if len(self._tail) > self.max_line:
+            # Không giữ dòng chưa kết thúc vô hạn trong bộ nhớ
+            self.line_no += 1
+            errors.append({"line": self.line_no, "error": f"line exceeds {self.max_line} chars"})
+            self._tail = ""
+            self._overflow = True
+        return readings, errors
+
+    def close(self) -> Tuple[List[Dict], List[Dict]]:
+        tail, self._tail = self._tail, ""
+        if self._overflow:
+            self._overflow = False
+            return [], []
+        return self._parse_lines([tail])
+
+    def _parse_lines(self, lines: List[str]) -> Tuple[List[Dict], List[Dict]]:
+        readings, errors = [], []
+        for line in lines:
+            self.line_no += 1
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                obj = json.loads(line)
+                value = obj["value"]
+                timestamp = obj.get("timestamp")
+                if not isinstance(obj["sensor_id"], str) or not is_finite_number(value):
+                    raise ValueError("sensor_id must be string, value must be number")
+                if timestamp is not None and not is_finite_number(timestamp):
+                    raise ValueError("timestamp must be epoch seconds (number) or null")
+                readings.append({
+                    "sensor_id": obj["sensor_id"],
+                    "value": float(value),
+                    "timestamp": float(timestamp) if timestamp is not None else None,
+                    "quality": obj.get("quality") or "GOOD"
+                })
+            except (ValueError, KeyError, TypeError) as e:
+                errors.append({"line": self.line_no, "error": str(e)})
+        return readings, errors
+
+# ============================================================================
+# 📡 LIVE DASHBOARD BROADCAST (/ws)
+# ============================================================================
+
+# Khoá định danh từng danh sách trong payload dashboard (dùng cho delta)
+DASHBOARD_LIST_KEYS = {
+    "rooms": "room_id",
+    "sensors_data": "sensor_id",
+    "devices": "device_id",
+    "decisions": "id",
+    "alerts": "alert_id",
+    "ai_agents": "name"
+}
+
+def diff_dashboard(prev: Dict, cur: Dict) -> Dict:
+    """
+    So sánh 2 snapshot (đã jsonable_encoder):
+    - set: giá trị đơn (KPI, timestamp) thay đổi
+    - lists: upsert / remove theo id, order khi thứ tự id đổi
+    """
+    changes: Dict[str, Any] = {"set": {k: v for k, v in cur.items()
+                                       if k not in DASHBOARD_LIST_KEYS and prev.get(k) != v}}
+    lists = {}
+    for name, key in DASHBOARD_LIST_KEYS.items():
+        old_items = {item.get(key): item for item in prev.get(name) or []}
+        new_items = cur.get(name) or []
+        ids = [item.get(key) for item in new_items]
+        entry = {}
+        upsert = [item for item in new_items if old_items.get(item.get(key)) != item]
+        if upsert:
+            entry["upsert"] = upsert
+        seen = set(ids)
+        remove = [i for i in old_items if i not in seen]
+        if remove:
+            entry["remove"] = remove
+        if ids != list(old_items):
+            entry["order"] = ids
+        if entry:
+            lists[name] = entry
+    if lists:
+        changes["lists"] = lists
+    return changes
+
+# Loại dữ liệu client có thể subscribe -> khoá trong payload
+DASHBOARD_KINDS = {
+    "kpi": ("kpi_energy", "kpi_occupancy", "kpi_temp", "kpi_sensors", "data_quality"),
+    "sensors": ("sensors_data",),
+    "devices": ("devices",),
+    "alerts": ("alerts",),
+    "decisions": ("decisions",),
+    "agents": ("ai_agents",)
+}
+
+def parse_dashboard_subscription(message: Dict) -> Tuple:
+    """{"buildings", "floors", "rooms", "kinds"} -> khoá nhóm (tuple đã sắp xếp, rỗng = tất cả)"""
+    def values(name):
+        raw = message.get(name) or []
+        if not isinstance(raw, (list, tuple)):
+            raw = [raw]
+        return tuple(sorted({str(v) for v in raw}))
+    kinds = tuple(k for k in values("kinds") if k in DASHBOARD_KINDS)
+    return values("buildings"), values("floors"), values("rooms"), kinds
+
+def filter_dashboard(state: Dict, spec: Tuple) -> Dict:
+    """
+    Lọc snapshot theo subscription:
+    - building / floor / room giao nhau (AND), KPI tính lại trên sensor đã lọc
+    - alerts / decisions của phòng khác bị bỏ, loại toàn hệ thống (SYSTEM, ...) giữ lại
+    """
+    buildings, floors, rooms, kinds = spec
+    if not any(spec):
+        return state
+
+    view = {"timestamp": state.get("timestamp")}
+    all_rooms = state.get("rooms") or []
+    scoped = bool(buildings or floors or rooms)
+    if scoped:
+        selected = [r for r in all_rooms
+                    if (not buildings or str(r.get("building")) in buildings)
+                    and (not floors or str(r.get("floor")) in floors)
+                    and (not rooms or str(r.get("room_id")) in rooms)]
+        allowed = {r.get("room_id") for r in selected} | {r.get("name") for r in selected}
+        known = {r.get("room_id") for r in all_rooms} | {r.get("name") for r in all_rooms}
+    else:
+        selected, allowed, known = all_rooms, set(), set()
+
+    def pick(items, field, system_wide=False):
+        if not scoped:
+            return items or []
+        return [x for x in items or [] if x.get(field) in allowed or (system_wide and x.get(field) not in known)]
+
+    view["rooms"] = selected
+    sensors = pick(state.get("sensors_data"), "room_id")
+    wanted = set(kinds or DASHBOARD_KINDS)
+    if "kpi" in wanted:
+        if scoped:
+            temps = [x.get("last_value") or 0 for x in sensors if x.get("sensor_type") == "temperature"]
+            view.update({
+                "kpi_energy": db.energy.total(room_ids=[r.get("room_id") for r in selected]),
+                "kpi_occupancy": sum(int(x.get("last_value") or 0) for x in sensors if x.get("sensor_type") == "occupancy"),
+                "kpi_temp": sum(temps) / len(temps) if temps else 0,
+                "kpi_sensors": len(sensors),
+                "data_quality": "EXCELLENT" if sensors else "NO_DATA"
+            })
+        else:
+            view.update({k: state.get(k) for k in DASHBOARD_KINDS["kpi"]})
+    if "sensors" in wanted:
+        view["sensors_data"] = sensors
+    if "devices" in wanted:
+        view["devices"] = pick(state.get("devices"), "room_id")
+    if "alerts" in wanted:
+        view["alerts"] = pick(state.get("alerts"), "location", system_wide=True)
+    if "decisions" in wanted:
+        view["decisions"] = pick(state.get("decisions"), "target", system_wide=True)
+    if "agents" in wanted:
+        view["ai_agents"] = state.get("ai_agents") or []
+    return view
+
+class DashboardGroup:
+    """Nhóm client cùng subscription: lọc + encode 1 lần / tick cho cả nhóm"""
+
+    def __init__(self, spec: Tuple):
+        self.spec = spec
+        self.state: Optional[Dict] = None  # view mới nhất (đã lọc)
+        self.seq = 0
+        self.updated_at = 0.0
+        self.used_at = time.time()  # lần cuối có client (giữ nhóm để SSE resume)
+        self.delta: Optional[str] = None  # JSON delta của tick hiện tại
+        self.replay: deque = deque(maxlen=SSE_REPLAY_SIZE)  # (seq, delta JSON) cho Last-Event-ID
+        self.encodes = 0
+        self._frames: Dict[Tuple[str, bool], Tuple[int, str]] = {}
+
+    def update(self, full_state: Dict, seq: int, want_delta: bool):
+        """Lọc snapshot mới, tính delta so với tick trước"""
+        view = filter_dashboard(full_state, self.spec)
+        self.delta = None
+        if want_delta and self.state is not None:
+            self.delta = json.dumps({"type": "delta", "seq": seq, **diff_dashboard(self.state, view)})
+            self.encodes += 1
+            if self.replay and self.replay[-1][0] != self.seq:
+                self.replay.clear()  # hụt tick → không nối tiếp được
+            self.replay.append((seq, self.delta))
+        self.state, self.seq, self.updated_at = view, seq, time.time()
+
+    def frame(self, kind: str, sse: bool = False) -> str:
+        """Frame full (payload cũ), snapshot hoặc delta; encode 1 lần / seq / transport"""
+        cached = self._frames.get((kind, sse))
+        if cached and cached[0] == self.seq:
+            return cached[1]
+        if kind == "snapshot":
+            text = json.dumps({"type": "snapshot", "seq": self.seq, "subscription": self.describe(), "data": self.state})
+        elif kind == "delta":
+            text = self.delta
+        else:
+            text = json.dumps(self.state)
+        if sse:
+            text = sse_frame(self.seq, kind, text)
+        self._frames[(kind, sse)] = (self.seq, text)
+        self.encodes += 1
+        return text
+
+    def since(self, seq: int) -> Optional[List[Tuple[int, str]]]:
+        """Các delta sau seq (Last-Event-ID) nếu buffer còn đủ, None nếu phải gửi snapshot"""
+        if seq == self.seq:
+            return []
+        if not self.replay or not self.replay[0][0] <= seq + 1 <= self.seq:
+            return None
+        return [(n, text) for n, text in self.replay if n > seq]
+
+    def describe(self) -> Dict:
+        buildings, floors, rooms, kinds = self.spec
+        return {"buildings": list(buildings), "floors": list(floors), "rooms": list(rooms), "kinds": list(kinds)}
+
+def sse_frame(seq: int, event: str, data: str) -> str:
+    """1 sự kiện text/event-stream (data là JSON 1 dòng)"""
+    return f"id: {seq}\nevent: {event}\ndata: {data}\n\n"
+
+# Topic event_bus -> phần snapshot cần query lại (reading / sensor: chỉ đọc SensorStateCache)
+# Không có "schedule": snapshot dashboard không chứa lịch; lịch mới chỉ đánh thức Scheduling AI
+# (event_topics riêng), quyết định của agent đó tới dashboard qua topic "decision"
+DASHBOARD_EVENT_PARTS = {
+    "reading": (),
+    "sensor": (),
+    "room": ("rooms", "devices"),
+    "device": ("devices",),
+    "alert": ("alerts",),
+    "decision": ("decisions",)
+}
+
+class DashboardSubscriber:
+    """1 client /ws hoặc SSE: hộp thư frame, nhóm subscription, seq đã nhận (chế độ delta)"""
+
+    __slots__ = ("mailbox", "delta", "sse", "seq", "group")
+
+    def __init__(self, delta: bool, sse: bool = False, size: int = 1):
+        self.mailbox: asyncio.Queue = asyncio.Queue(maxsize=size)
+        self.delta = delta
+        self.sse = sse
+        self.seq: Optional[int] = None  # None = cần snapshot đầy đủ
+        self.group: Tuple = ((), (), (), ())
+
+class DashboardBroadcaster:
+    """
+    Phát snapshot dashboard cho mọi client /ws:
+    - 1 producer task build ui_data 1 lần / tick
+    - Tick chạy khi event_bus có sự kiện (gom trong WS_MIN_INTERVAL), chỉ query lại phần bị đổi;
+      không có sự kiện thì chỉ dựng lại sau WS_BROADCAST_INTERVAL
+    - Client gom theo subscription ({"type": "subscribe", buildings, floors, rooms, kinds}):
+      mỗi nhóm lọc + serialize JSON 1 lần, gửi cùng frame cho cả nhóm
+    - Mỗi client có hộp thư 1 frame: client chưa gửi xong thì frame cũ bị thay (skip)
+    - Client gửi quá WS_SEND_TIMEOUT bị ngắt, không làm chậm client khác
+    - Producer chỉ chạy khi có client
+    - Chế độ delta (/ws?mode=delta): snapshot khi kết nối, sau đó chỉ gửi thay đổi kèm seq;
+      client thấy hụt seq thì gửi {"type": "resync"}
+    - SSE (/api/stream): cùng snapshot/delta, frame SSE cũng encode 1 lần / nhóm
+    """
+
+    def __init__(self, interval: float = WS_BROADCAST_INTERVAL, send_timeout: float = WS_SEND_TIMEOUT,
+                 min_interval: float = WS_MIN_INTERVAL):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.send_timeout = send_timeout
+        self.subscribers: Dict[WebSocket, DashboardSubscriber] = {}
+        self.groups: Dict[Tuple, DashboardGroup] = {}
+        self.seq = 0
+        self._parts: Dict[str, List[Dict]] = {}  # kết quả query gần nhất (rooms, decisions, alerts, devices)
+        self._state: Optional[Dict] = None  # snapshot đầy đủ gần nhất (đã encode)
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            "ticks": 0,
+            "event_ticks": 0,
+            "heartbeat_ticks": 0,
+            "events": 0,
+            "queries": 0,
+            "frames_sent": 0,
+            "frames_skipped": 0,
+            "delta_frames": 0,
+            "snapshot_frames": 0,
+            "resyncs": 0,
+            "subscriptions": 0,
+            "sse_resumes": 0,
+            "group_encodes": 0,
+            "clients_dropped": 0,
+            "errors": 0,
+            "max_subscribers": 0,
+            "last_build_ms": 0.0,
+            "avg_build_ms": 0.0,
+            "last_frame_bytes": 0,
+            "last_delta_bytes": 0
+        }
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def build_snapshot(self, dirty: Optional[set] = None) -> Dict:
+        """Dữ liệu dashboard (giống payload /ws cũ); dirty = phần cần query lại (None = tất cả)"""
+        fetch = {
+            "rooms": adb.get_all_rooms,
+            "decisions": partial(adb.get_ai_decisions, 10),
+            "alerts": adb.get_active_alerts,
+            "devices": adb.get_all_devices
+        }
+        names = [n for n in fetch if dirty is None or n in dirty or n not in self._parts]
+        if names:
+            self._parts.update(zip(names, await asyncio.gather(*(fetch[n]() for n in names))))
+            self.stats["queries"] += len(names)
+        rooms, decisions, alerts, devices = (self._parts[n] for n in fetch)
+        real_time = db.get_real_time_data()
+        return {
+            "kpi_energy": real_time['energy_today'],
+            "kpi_occupancy": real_time['total_occupancy'],
+            "kpi_temp": real_time['avg_temperature'],
+            "kpi_sensors": real_time['sensor_count'],
+            "data_quality": "EXCELLENT" if real_time['sensor_count'] > 0 else "NO_DATA",
+            "rooms": rooms,
+            "sensors_data": real_time['sensors'],
+            "decisions": decisions,
+            "alerts": alerts,
+            "ai_agents": ai_system.get_agent_status(),
+            "devices": devices,
+            "timestamp": time.time()
+        }
+
+    async def _run(self):
+        events = event_bus.subscribe(tuple(DASHBOARD_EVENT_PARTS), name="dashboard")
+        dirty = None
+        try:
+            while self.subscribers:
+                started = time.time()
+                await self._tick(dirty)
+                dirty = await self._wait_changes(events, started)
+        finally:
+            event_bus.unsubscribe(events)
+
+    async def _wait_changes(self, events: EventSubscription, last_tick: float) -> Optional[set]:
+        """Chờ sự kiện (hoặc hết WS_BROADCAST_INTERVAL), gom trong WS_MIN_INTERVAL; trả về phần cần query lại"""
+        first = await events.get(timeout=self.interval)
+        if first is None:
+            self.stats["heartbeat_ticks"] += 1
+            return None
+        await asyncio.sleep(max(0.0, last_tick + self.min_interval - time.time()))
+        batch = [first] + events.drain()
+        self.stats["event_ticks"] += 1
+        self.stats["events"] += len(batch)
+        dirty = set()
+        for event in batch:
+            dirty.update(DASHBOARD_EVENT_PARTS.get(event.topic.split(".")[0], ()))
+        return dirty
+
+    async def _tick(self, dirty: Optional[set]):
+        """Dựng snapshot, cập nhật các nhóm và đưa frame vào hộp thư client"""
+        started = time.time()
+        try:
+            state = jsonable_encoder(await self.build_snapshot(dirty))
+        except Exception as e:
+            logger.error(f"❌ Dashboard snapshot error: {e}")
+            self.stats["errors"] += 1
+            self._parts.clear()
+            return
+
+        self.seq += 1
+        self._state = state
+        s = self.stats
+        subs = list(self.subscribers.values())
+        active = {sub.group for sub in subs}
+        now = time.time()
+        for key, group in list(self.groups.items()):
+            if key in active:
+                group.used_at = now
+            elif not group.replay or now - group.used_at > SSE_REPLAY_GRACE:
+                del self.groups[key]  # nhóm SSE vừa rời được giữ lại 1 lúc để resume bằng Last-Event-ID
+        encodes = 0
+        for key in active | set(self.groups):
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = DashboardGroup(key)
+            encodes -= group.encodes
+            group.update(state, self.seq, bool(group.replay) or any(sub.delta and sub.group == key for sub in subs))
+            if group.delta:
+                s["last_delta_bytes"] = len(group.delta)
+
+        for sub in subs:
+            group = self.groups[sub.group]
+            if not sub.delta:
+                self._offer(sub, group.frame("full"))
+            elif group.delta and sub.seq == self.seq - 1 and not sub.mailbox.full():
+                sub.mailbox.put_nowait(group.frame("delta", sub.sse))
+                sub.seq = self.seq
+                s["delta_frames"] += 1
+            else:
+                self._offer_snapshot(sub)
+        s["group_encodes"] += encodes + sum(group.encodes for group in self.groups.values())
+
+        elapsed_ms = (time.time() - started) * 1000
+        s["ticks"] += 1
+        s["last_build_ms"] = round(elapsed_ms, 2)
+        s["avg_build_ms"] = round(elapsed_ms if s["ticks"] == 1 else s["avg_build_ms"] * 0.9 + elapsed_ms * 0.1, 2)
+        default = self.groups.get(((), (), (), ()))
+        if default and default._frames.get(("full", False)):
+            s["last_frame_bytes"] = len(default._frames[("full", False)][1])
+
+    def _offer(self, sub: DashboardSubscriber, frame: str):
+        """Đặt frame mới vào hộp thư, bỏ frame cũ nếu client chưa gửi xong"""
+        if sub.mailbox.full():
+            sub.mailbox.get_nowait()
+            self.stats["frames_skipped"] += 1
+        sub.mailbox.put_nowait(frame)
+
+    def _offer_snapshot(self, sub: DashboardSubscriber):
+        """
+        Snapshot đầy đủ cho client delta (kết nối mới, hụt frame, resync, đổi subscription);
+        các frame đang chờ bị gộp vào snapshot
+        """
+        group = self._group(sub.group)
+        if group is None:
+            sub.seq = None
+            return
+        while not sub.mailbox.empty():
+            sub.mailbox.get_nowait()
+            self.stats["frames_skipped"] += 1
+        sub.mailbox.put_nowait(group.frame("snapshot", sub.sse))
+        sub.seq = group.seq
+        self.stats["snapshot_frames"] += 1
+
+    def _group(self, key: Tuple) -> Optional[DashboardGroup]:
+        """Nhóm theo subscription; nhóm mới lọc ngay từ snapshot gần nhất, không chờ tick sau"""
+        group = self.groups.get(key)
+        if group is None and self._state is not None:
+            group = self.groups[key] = DashboardGroup(key)
+            group.update(self._state, self.seq, False)
+        return group
+
+    def _subscribe(self, sub: DashboardSubscriber, key: Tuple):
+        """Chuyển client sang nhóm subscription khác, gửi ngay view hiện tại nếu đã có"""
+        sub.group = key
+        sub.seq = None
+        self.stats["subscriptions"] += 1
+        group = self._group(key)
+        if group is None:
+            return
+        if sub.delta:
+            self._offer_snapshot(sub)
+        elif time.time() - group.updated_at < self.interval:
+            self._offer(sub, group.frame("full"))
+
+    def _attach(self, key: Any, sub: DashboardSubscriber):
+        """Đăng ký client, khởi động producer nếu chưa chạy"""
+        self.subscribers[key] = sub
+        self.stats["max_subscribers"] = max(self.stats["max_subscribers"], len(self.subscribers))
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+
+    async def serve(self, websocket: WebSocket, delta: bool = False):
+        """Gửi frame cho 1 client tới khi client ngắt hoặc quá chậm"""
+        sub = DashboardSubscriber(delta)
+        group = self._group(sub.group)
+        if group:
+            if delta:
+                self._offer_snapshot(sub)
+            elif time.time() - group.updated_at < self.interval:
+                sub.mailbox.put_nowait(group.frame("full"))
+        self._attach(websocket, sub)
+
+        closed = asyncio.create_task(self._receive(websocket, sub))
+        try:
+            while True:
+                getter = asyncio.create_task(sub.mailbox.get())
+                await asyncio.wait({getter, closed}, return_when=asyncio.FIRST_COMPLETED)
+                if not getter.done():
+                    getter.cancel()
+                    return
+                try:
+                    await asyncio.wait_for(websocket.send_text(getter.result()), timeout=self.send_timeout)
+                except asyncio.TimeoutError:
+                    self.stats["clients_dropped"] += 1
+                    logger.warning("🐢 WebSocket client too slow, dropped")
+                    try:
+                        await websocket.close(code=1013)
+                    except Exception:
+                        pass
+                    return
+                self.stats["frames_sent"] += 1
+        finally:
+            closed.cancel()
+            self.subscribers.pop(websocket, None)
+
+    async def _receive(self, websocket: WebSocket, sub: DashboardSubscriber):
+        """Đọc message từ client (subscribe / resync) tới khi ngắt kết nối"""
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            try:
+                request = json.loads(message.get("text") or "{}")
+            except ValueError:
+                continue
+            if not isinstance(request, dict):
+                continue
+            if request.get("type") == "subscribe":
+                self._subscribe(sub, parse_dashboard_subscription(request))
+            elif request.get("type") == "resync" and sub.delta:
+                self.stats["resyncs"] += 1
+                self._offer_snapshot(sub)
+
+    async def stream(self, spec: Tuple, last_event_id: Optional[str] = None):
+        """
+        Luồng SSE (text/event-stream) cho 1 client:
+        - snapshot rồi delta (id = seq), resume từ Last-Event-ID nếu replay buffer còn đủ
+        - hộp thư SSE_QUEUE_SIZE frame; đầy thì gộp thành 1 snapshot
+        - comment heartbeat mỗi SSE_HEARTBEAT giây
+        """
+        sub = DashboardSubscriber(delta=True, sse=True, size=SSE_QUEUE_SIZE)
+        sub.group = spec
+        group = self._group(spec)
+        replay = None
+        if group and last_event_id and last_event_id.isdigit():
+            replay = group.since(int(last_event_id))
+        if replay is not None and len(replay) < SSE_QUEUE_SIZE:
+            for seq, text in replay:
+                sub.mailbox.put_nowait(sse_frame(seq, "delta", text))
+            sub.seq = group.seq
+            self.stats["sse_resumes"] += 1
+        elif group:
+            self._offer_snapshot(sub)
+        self._attach(sub, sub)
+
+        try:
+            yield f"retry: {int(SSE_RETRY * 1000)}\n\n"
+            while True:
+                try:
+                    frame = await asyncio.wait_for(sub.mailbox.get(), timeout=SSE_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                yield frame
+                self.stats["frames_sent"] += 1
+        finally:
+            self.subscribers.pop(sub, None)
+
+    async def stop(self):
+        if self.running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def get_stats(self) -> Dict:
+        return {
+            **self.stats,
+            "running": self.running,
+            "subscribers": len(self.subscribers),
+            "delta_subscribers": sum(1 for sub in self.subscribers.values() if sub.delta),
+            "sse_subscribers": sum(1 for sub in self.subscribers.values() if sub.sse),
+            "groups": len(self.groups),
+            "seq": self.seq,
+            "interval": self.interval
+        }
+
+dashboard_broadcaster = DashboardBroadcaster()
+
 # ============================================================================
 # 🧠 ULTRA-INTELLIGENT CHATBOT (Memory + Self-Learning + Confirmation)
 # ============================================================================
@@ -1522,14 +5637,14 @@ class UltraIntelligentChatbot:
         if self.pending_confirmations.get(user):
             if self._is_confirmation(question):
                 action = self.pending_confirmations.pop(user)
-                result = self._execute_ai_action(action)
+                result = await self._execute_ai_action(action)
                 return f"✅ Đã xác nhận: {result}"
             elif self._is_rejection(question):
                 self.pending_confirmations.pop(user)
                 return "❌ Đã hủy thao tác."
 
         # 2. Get system context
-        rooms = db.get_all_rooms()
+        rooms = await adb.get_all_rooms()
         real_time = db.get_real_time_data()
         
         # 3. Build memory context
@@ -1622,15 +5737,15 @@ HÃY TRẢ LỜI (Nếu có hành động CRUD, kèm block JSON ở cuối):
                          # Store for confirmation if AI didn't ask (safety net), or if AI decided to act immediately.
                          # Better approach: If AI outputs JSON, it means it's ready.
                          # We'll execute non-destructive immediately. Destructive ones... let's execute for "Manager" role efficiency.
-                         exec_result = self._execute_ai_action(action)
+                         exec_result = await self._execute_ai_action(action)
                          final_answer += f"\n\n⚙️ SYSTEM: {exec_result}"
                     else:
-                         exec_result = self._execute_ai_action(action)
+                         exec_result = await self._execute_ai_action(action)
                          final_answer += f"\n\n⚙️ SYSTEM: {exec_result}"
 
                 # Save to memory
                 self.conversation_memory.append({"q": question, "a": final_answer})
-                db.save_chat(question, final_answer, language, {"raw": raw_answer})
+                await adb.save_chat(question, final_answer, language, {"raw": raw_answer})
                 
                 return final_answer
             else:
@@ -1658,7 +5773,7 @@ HÃY TRẢ LỜI (Nếu có hành động CRUD, kèm block JSON ở cuối):
                 pass
         return text, None
 
-    def _execute_ai_action(self, action_data: Dict) -> str:
+    async def _execute_ai_action(self, action_data: Dict) -> str:
         """Dạy AI cách thực thi database"""
         act = action_data.get("action")
         p = action_data.get("params", {})
@@ -1667,24 +5782,24 @@ HÃY TRẢ LỜI (Nếu có hành động CRUD, kèm block JSON ở cuối):
             if act == "add_room":
                 # Generate random ID if missing
                 rid = p.get("id", f"R{secrets.token_hex(2).upper()}")
-                res = db.add_room(rid, p.get("name", "New Room"), p.get("area", 30), p.get("floor", 1), p.get("building", "A"))
+                res = await adb.add_room(rid, p.get("name", "New Room"), p.get("area", 30), p.get("floor", 1), p.get("building", "A"))
                 return res.get("message", "Failed")
                 
             elif act == "delete_room":
-                res = db.delete_room(p.get("id"))
+                res = await adb.delete_room(p.get("id"))
                 return res.get("message", "Failed")
                 
             elif act == "add_sensor":
                 sid = p.get("id", f"S{secrets.token_hex(2).upper()}")
-                res = db.add_sensor(sid, p.get("room_id"), p.get("type", "power"), p.get("unit", "W"))
+                res = await adb.add_sensor(sid, p.get("room_id"), p.get("type", "power"), p.get("unit", "W"))
                 return res.get("message", "Failed")
                 
             elif act == "delete_sensor":
-                res = db.delete_sensor(p.get("id"))
+                res = await adb.delete_sensor(p.get("id"))
                 return res.get("message", "Failed")
                 
             elif act == "control_device":
-                res = db.control_device(p.get("id"), p.get("command", "OFF"))
+                res = await adb.control_device(p.get("id"), p.get("command", "OFF"))
                 return res.get("message", "Failed")
 
             elif act == "teach_agent":
@@ -1729,6 +5844,8 @@ chatbot = UltraIntelligentChatbot()
 
 class BaseAgent:
     """Base class cho tất cả AI Agents"""
+    event_topics: Tuple[str, ...] = ()  # prefix topic event_bus đánh thức agent sớm (rỗng = chỉ chạy định kỳ)
+
     def __init__(self, name: str, role: str, expertise: str):
         self.name = name
         self.role = role
@@ -1752,13 +5869,38 @@ class BaseAgent:
             logger.info(f"⏭️  {self.name}: Background loop skipped on Vercel.")
             return
 
-        while self.active:
-            try:
-                await self.execute_duty()
-                await asyncio.sleep(15)  # Check every 15 seconds
-            except Exception as e:
-                logger.error(f"{self.name} error: {e}")
-                await asyncio.sleep(5)
+        events = event_bus.subscribe(self.event_topics, name=self.name) if self.event_topics else None
+        try:
+            while self.active:
+                try:
+                    started = time.time()
+                    await self.execute_duty()
+                    await self.wait_next(events, started)
+                except Exception as e:
+                    logger.error(f"{self.name} error: {e}")
+                    await asyncio.sleep(5)
+        finally:
+            if events:
+                event_bus.unsubscribe(events)
+
+    async def wait_next(self, events: Optional[EventSubscription], started: float):
+        """Chờ tới lần chạy sau: sự kiện liên quan (cách lần trước >= AGENT_MIN_INTERVAL) hoặc AGENT_POLL_INTERVAL"""
+        if events is None:
+            await asyncio.sleep(AGENT_POLL_INTERVAL)
+            return
+        deadline = started + AGENT_POLL_INTERVAL
+        while True:
+            event = await events.get(timeout=max(0.0, deadline - time.time()))
+            if event is None:
+                return
+            if self.wants(event):
+                await asyncio.sleep(max(0.0, started + AGENT_MIN_INTERVAL - time.time()))
+                events.drain()
+                return
+
+    def wants(self, event: BusEvent) -> bool:
+        """Sự kiện có cần chạy execute_duty ngay không (override in subclass)"""
+        return True
     
     async def execute_duty(self):
         """Override in subclass"""
@@ -1790,12 +5932,14 @@ class OccupancyPresenceAI(BaseAgent):
 
 # 4. Scheduling & Behavior Learning AI
 class BehaviorLearningAI(BaseAgent):
+    event_topics = ("schedule.",)
+
     def __init__(self):
         super().__init__("Scheduling AI", "Scheduling", "Học thói quen và quản lý lịch trình Enterprise")
     
     async def execute_duty(self):
         now = datetime.now()
-        schedules = db.get_upcoming_schedules(limit=20)
+        schedules = await adb.get_upcoming_schedules(limit=20)
         
         for sch in schedules:
             start_dt = sch['start_time'] if isinstance(sch['start_time'], datetime) else datetime.fromisoformat(sch['start_time'])
@@ -1804,24 +5948,31 @@ class BehaviorLearningAI(BaseAgent):
             
             # Pre-condition: 15 mins before start
             if now <= start_dt <= (now + timedelta(minutes=15)):
-                db.log_ai_decision(self.name, "PRE_CONDITION", room_id, "Prepare Environment", f"Event '{sch['event_name']}' starts in <15m", 0.95)
+                await adb.log_ai_decision(self.name, "PRE_CONDITION", room_id, "Prepare Environment", f"Event '{sch['event_name']}' starts in <15m", 0.95)
                 # Simulated IOT action: Bật điều hòa/đèn
-                db.control_device(f"AC_{room_id}", "ON")
-                db.control_device(f"LIGHT_{room_id}", "ON")
+                await adb.control_device(f"AC_{room_id}", "ON")
+                await adb.control_device(f"LIGHT_{room_id}", "ON")
 
             # Post-condition: 15 mins before end
             if now <= end_dt <= (now + timedelta(minutes=15)):
                  # Trình tự tắt dần
-                 db.log_ai_decision(self.name, "PRE_SHUTDOWN", room_id, "Efficiency Mode", f"Event '{sch['event_name']}' ends in <15m", 0.9)
-                 db.control_device(f"AC_{room_id}", "OFF") # Tắt AC trước 15p là chiến thuật phổ biến
+                 await adb.log_ai_decision(self.name, "PRE_SHUTDOWN", room_id, "Efficiency Mode", f"Event '{sch['event_name']}' ends in <15m", 0.9)
+                 await adb.control_device(f"AC_{room_id}", "OFF") # Tắt AC trước 15p là chiến thuật phổ biến
 
 # 5. Energy Optimization AI
 class EnergyOptimizationAI(BaseAgent):
+    event_topics = ("reading",)
+
     def __init__(self):
         super().__init__("Energy Optimization AI", "Optimization", "Chiến lược tiết kiệm điện dựa trên AI")
+
+    def wants(self, event: BusEvent) -> bool:
+        # Phòng vừa hết người (occupancy chuyển về 0)
+        return any(s["sensor_type"] == "occupancy" and s["value"] == 0 and s["previous"] != 0
+                   for s in event.data["sensors"])
     
     async def execute_duty(self):
-        rooms = db.get_all_rooms()
+        rooms = await adb.get_all_rooms()
         real_time = db.get_real_time_data()
         
         for room in rooms:
@@ -1830,9 +5981,9 @@ class EnergyOptimizationAI(BaseAgent):
             # (Simplification for simulation: check current occupancy)
             room_sensors = [s for s in real_time['sensors'] if s['room_id'] == rid and s['sensor_type'] == 'occupancy']
             if room_sensors and room_sensors[0]['last_value'] == 0:
-                 db.log_ai_decision(self.name, "AUTO_OFF", rid, "Power Cut", "No occupancy detected", 0.99)
-                 db.control_device(f"LIGHT_{rid}", "OFF")
-                 db.control_device(f"AC_{rid}", "OFF")
+                 await adb.log_ai_decision(self.name, "AUTO_OFF", rid, "Power Cut", "No occupancy detected", 0.99)
+                 await adb.control_device(f"LIGHT_{rid}", "OFF")
+                 await adb.control_device(f"AC_{rid}", "OFF")
 
 # 6. Actuator Control AI
 class ActuatorControlAI(BaseAgent):
@@ -1844,16 +5995,23 @@ class ActuatorControlAI(BaseAgent):
 
 # 7. System Monitoring & Safety AI
 class SafetyMonitoringAI(BaseAgent):
+    event_topics = ("reading",)
+
     def __init__(self):
         super().__init__("Safety Monitoring AI", "Safety", "Giám sát an toàn & cháy nổ 24/7")
+
+    def wants(self, event: BusEvent) -> bool:
+        # Nhiệt độ vừa vượt ngưỡng 50°C
+        return any(s["sensor_type"] == "temperature" and s["value"] > 50 and (s["previous"] or 0) <= 50
+                   for s in event.data["sensors"])
     
     async def execute_duty(self):
         real_time = db.get_real_time_data()
         for s in real_time['sensors']:
             if s['sensor_type'] == 'temperature' and s['last_value'] > 50:
                 msg = f"Nguy cơ hỏa hoạn tại {s['room_name']}! Nhiệt độ {s['last_value']}°C"
-                db.log_safety_event(s['room_id'], "CRITICAL", "FIRE_RISK", msg, "SYSTEM_LOCKDOWN")
-                db.save_alert({
+                await adb.log_safety_event(s['room_id'], "CRITICAL", "FIRE_RISK", msg, "SYSTEM_LOCKDOWN")
+                await adb.save_alert({
                     "alert_id": str(uuid.uuid4())[:8],
                     "severity": "CRITICAL",
                     "title": "CẢNH BÁO NHIỆT ĐỘ",
@@ -1862,15 +6020,24 @@ class SafetyMonitoringAI(BaseAgent):
                     "timestamp": time.time()
                 })
                 # Ngắt toàn bộ điện phòng đó
-                db.control_device(f"MAIN_POWER_{s['room_id']}", "OFF")
+                await adb.control_device(f"MAIN_POWER_{s['room_id']}", "OFF")
 
 # 8. Data Management AI
 class DataManagementAI(BaseAgent):
     def __init__(self):
         super().__init__("Data Management AI", "Data", "Quản lý lưu trữ và tính toàn vẹn dữ liệu MySQL/SQLite")
+        self.last_retention = 0
     
     async def execute_duty(self):
-        pass
+        # Retention: chuyển dữ liệu cũ sang archive định kỳ
+        if time.time() - self.last_retention >= RETENTION_INTERVAL:
+            self.last_retention = time.time()
+            result = await adb.run_retention()
+            if result["archived"]:
+                self.decisions_made += 1
+                self.last_action_time = time.time()
+                await adb.log_ai_decision(self.name, "RETENTION", "sensor_readings", "Archive",
+                                   f"Archived {result['archived']} readings older than {RETENTION_DAYS:g} days", 1.0)
 
 # 9. Reporting & Analytics AI
 class ReportingAnalyticsAI(BaseAgent):
@@ -1902,11 +6069,11 @@ class PredictiveMaintenanceAI(BaseAgent):
         super().__init__("Predictive Maintenance AI", "Maintenance", "Dự đoán bảo trì và tuổi thọ thiết bị")
     
     async def execute_duty(self):
-        devices = db.get_all_devices()
+        devices = await adb.get_all_devices()
         for d in devices:
             usage_hours = 0 # In a real system, we'd calculate this from history
             if usage_hours > 5000: # Threshold for maintenance
-                db.add_alert("WARNING", "🔧 BẢO TRÌ ĐỊNH KỲ", f"Thiết bị {d['device_name']} đã vượt quá 5000 giờ chạy.", d['room_name'])
+                await adb.add_alert("WARNING", "🔧 BẢO TRÌ ĐỊNH KỲ", f"Thiết bị {d['device_name']} đã vượt quá 5000 giờ chạy.", d['room_name'])
 
 # 13. Global Optimization AI
 class GlobalOptimizationAI(BaseAgent):
@@ -1916,7 +6083,7 @@ class GlobalOptimizationAI(BaseAgent):
     async def execute_duty(self):
         real_time = db.get_real_time_data()
         if real_time['total_power'] > 1000: # Example high load threshold
-             db.log_ai_decision(self.name, "GLOBAL_CAP", "SYSTEM", "Load Shedding", "Total consumption exceeds 1000kW. Dimming non-essential areas.", 0.9)
+             await adb.log_ai_decision(self.name, "GLOBAL_CAP", "SYSTEM", "Load Shedding", "Total consumption exceeds 1000kW. Dimming non-essential areas.", 0.9)
              # Simulate reducing power across multiple rooms
 
 # 14. Self-Learning AI
@@ -1926,7 +6093,6 @@ class SelfLearningAI(BaseAgent):
     
     async def execute_duty(self):
         # AI tự kiểm tra chat history để học các chỉ dẫn mới của User
-        cursor = db._get_cursor()
         # Logic to extract 'teaching' patterns from chat
         pass
 
@@ -2030,6 +6196,15 @@ class SensorReadingRequest(BaseModel):
     sensor_id: str
     value: float
 
+class SensorReadingItem(BaseModel):
+    sensor_id: str
+    value: float
+    timestamp: Optional[float] = None  # Unix epoch (giây), mặc định = thời điểm nhận
+    quality: str = "GOOD"
+
+class SensorReadingBatchRequest(BaseModel):
+    readings: List[SensorReadingItem]
+
 class SearchRequest(BaseModel):
     query: str
 
@@ -2070,6 +6245,10 @@ class AddScheduleRequest(BaseModel):
 # 🚀 API ENDPOINTS
 # ============================================================================
 
+@app.exception_handler(DataAccessTimeout)
+async def data_access_timeout_handler(request: Request, exc: DataAccessTimeout):
+    return JSONResponse(status_code=504, content={"success": False, "error": str(exc)})
+
 # Health Check
 @app.get("/api/health")
 async def health_check():
@@ -2085,7 +6264,7 @@ async def health_check():
 # Auth
 @app.post("/login")
 async def login(creds: LoginRequest):
-    user = db.verify_user(creds.username, creds.password)
+    user = await adb.verify_user(creds.username, creds.password)
     if user:
         token = secrets.token_hex(16)
         resp = JSONResponse({
@@ -2140,82 +6319,162 @@ def serialize_for_json(obj):
 @app.post("/api/rooms/add")
 async def add_room(request: AddRoomRequest):
     """➕ Thêm phòng"""
-    return db.add_room(request.room_id, request.name, request.area, request.floor, request.building)
+    return await adb.add_room(request.room_id, request.name, request.area, request.floor, request.building)
 
 @app.delete("/api/rooms/delete")
 async def delete_room(request: DeleteRoomRequest):
     """❌ Xóa phòng"""
-    return db.delete_room(request.room_id)
+    return await adb.delete_room(request.room_id)
 
 @app.get("/api/rooms")
+@response_cache.cached("rooms", ("rooms",))
 async def get_rooms():
     """📋 Danh sách phòng"""
-    return serialize_for_json({"rooms": db.get_all_rooms()})
+    return serialize_for_json({"rooms": await adb.get_all_rooms()})
+
+@app.get("/api/rooms/analytics")
+async def get_rooms_analytics(hours: int = 24, resolution: Optional[int] = None, sort: str = "efficiency_score",
+                              order: str = "desc", limit: Optional[int] = None):
+    """🏫 Phân tích toàn bộ phòng (sort theo 1 chỉ số, limit = top-K)"""
+    if sort not in ROOMS_ANALYTICS_SORT or order not in ("asc", "desc"):
+        return JSONResponse(status_code=400, content={
+            "success": False, "error": f"sort must be one of {', '.join(ROOMS_ANALYTICS_SORT)}; order asc|desc"})
+    return serialize_for_json(await adb.get_rooms_analytics(hours, resolution, sort, order == "desc", limit))
 
 @app.get("/api/rooms/{room_id}/analytics")
-async def get_room_analytics(room_id: str, hours: int = 24):
-    """📊 Phân tích chi tiết từng phòng"""
-    return serialize_for_json(db.get_room_analytics(room_id, hours))
+async def get_room_analytics(room_id: str, hours: int = 24, resolution: Optional[int] = None, max_points: Optional[int] = None):
+    """📊 Phân tích chi tiết từng phòng (max_points: LTTB cho các chuỗi)"""
+    if max_points is not None and max_points < 3:
+        return JSONResponse(status_code=400, content={"success": False, "error": "max_points must be >= 3"})
+    return serialize_for_json(await adb.get_room_analytics(room_id, hours, resolution, max_points))
 
 # Enterprise Management
 @app.post("/api/buildings/add")
 async def add_building(request: AddBuildingRequest):
     """➕ Thêm tòa nhà"""
-    return db.add_building(request.building_id, request.name, request.address, request.total_floors, request.manager_name)
+    return await adb.add_building(request.building_id, request.name, request.address, request.total_floors, request.manager_name)
 
 @app.post("/api/floors/add")
 async def add_floor(request: AddFloorRequest):
     """➕ Thêm tầng"""
-    return db.add_floor(request.floor_id, request.building_id, request.floor_number, request.name, request.energy_target)
+    return await adb.add_floor(request.floor_id, request.building_id, request.floor_number, request.name, request.energy_target)
 
 @app.post("/api/schedules/add")
 async def add_schedule(request: AddScheduleRequest):
     """➕ Thêm lịch trình Enterprise"""
-    return db.add_schedule(request.room_id, request.event_name, request.start_time, request.end_time, request.min_temp, request.max_temp, request.priority)
+    return await adb.add_schedule(request.room_id, request.event_name, request.start_time, request.end_time, request.min_temp, request.max_temp, request.priority)
 
 @app.get("/api/schedules/upcoming")
+@response_cache.cached("schedules", ("schedules",))
 async def get_upcoming_schedules():
     """📋 Lịch trình sắp tới"""
-    return serialize_for_json({"schedules": db.get_upcoming_schedules()})
+    return serialize_for_json({"schedules": await adb.get_upcoming_schedules()})
 
 # Sensor Management
 @app.post("/api/sensors/add")
 async def add_sensor(request: AddSensorRequest):
     """➕ Thêm cảm biến"""
-    return db.add_sensor(request.sensor_id, request.room_id, request.sensor_type, request.unit)
+    return await adb.add_sensor(request.sensor_id, request.room_id, request.sensor_type, request.unit)
 
 @app.delete("/api/sensors/delete")
 async def delete_sensor(request: DeleteSensorRequest):
     """❌ Xóa cảm biến"""
-    return db.delete_sensor(request.sensor_id)
+    return await adb.delete_sensor(request.sensor_id)
 
 @app.post("/api/sensors/reading")
 async def log_reading(request: SensorReadingRequest):
     """📡 Ghi dữ liệu cảm biến"""
-    success = db.log_sensor_reading(request.sensor_id, request.value)
+    if not db.sensor_state.has(request.sensor_id):
+        return {"success": False, "error": f"Sensor {request.sensor_id} not found"}
+    if ingest_buffer.running:
+        if not await ingest_buffer.submit(request.sensor_id, request.value):
+            return JSONResponse(status_code=503, headers={"Retry-After": "1"},
+                                content={"success": False, "error": "Ingest queue full"})
+        return {"success": True, "queued": True}
+    success = await adb.log_sensor_reading(request.sensor_id, request.value)
     return {"success": success}
 
+@app.post("/api/sensors/readings/batch")
+async def log_readings_batch(request: SensorReadingBatchRequest):
+    """📡 Ghi dữ liệu cảm biến theo lô"""
+    if len(request.readings) > MAX_BATCH_READINGS:
+        return JSONResponse(status_code=413, content={"success": False, "error": f"Batch too large (max {MAX_BATCH_READINGS})"})
+    return await adb.log_sensor_readings_batch([item.dict() for item in request.readings])
+
+@app.get("/api/sensors/aggregates")
+async def get_sensor_aggregates():
+    """🧮 Aggregate last value theo phòng và theo loại sensor"""
+    return db.sensor_state.get_aggregates()
+
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    """🗂️ Thống kê cache response (hit / miss / invalidate theo tag)"""
+    return response_cache.get_stats()
+
+@app.get("/api/energy")
+async def get_energy(day: Optional[str] = None):
+    """⚡ Điện năng (kWh) theo ngày: campus → building → floor → room, so với energy_target"""
+    return {**db.energy.report(day), "stats": db.energy.get_stats()}
+
+@app.get("/api/archive/stats")
+async def get_archive_stats():
+    """🗃️ Thống kê archive (số segment, dung lượng)"""
+    return {
+        **db.archive.get_stats(),
+        "retention_days": RETENTION_DAYS,
+        "partitions": db.partitions.get_stats() if db.partitions else None
+    }
+
+@app.get("/api/db/stats")
+async def get_db_stats():
+    """🗄️ Thống kê engine SQLite / MySQL pool + replica / Supabase REST và async data access"""
+    return {
+        "database": db.db_type,
+        "engine": db.engine.get_stats() if db.engine else None,
+        "mysql_pool": db.mysql_pool.get_stats() if db.mysql_pool else None,
+        "supabase": db.rest.get_stats() if db.rest else None,
+        "replicas": db.replicas.get_stats() if db.replicas else None,
+        "queries": db.sql.get_stats(),
+        "data_access": adb.get_stats()
+    }
+
+@app.get("/api/ingest/stats")
+async def get_ingest_stats():
+    """📊 Thống kê hàng đợi ghi (độ trễ flush, batch size, queue depth)"""
+    return ingest_buffer.get_stats()
+
+@app.get("/api/events/stats")
+async def get_event_stats():
+    """📣 Thống kê event bus (sự kiện theo topic, subscriber, hàng đợi)"""
+    return event_bus.get_stats()
+
+@app.get("/api/ws/stats")
+async def get_ws_stats():
+    """📡 Thống kê broadcast dashboard (/ws)"""
+    return dashboard_broadcaster.get_stats()
+
 # IoT Device Control
 @app.post("/api/devices/add")
 async def add_device(request: AddDeviceRequest):
     """➕ Thêm thiết bị IoT"""
-    return db.add_iot_device(request.device_id, request.room_id, request.device_type, request.device_name)
+    return await adb.add_iot_device(request.device_id, request.room_id, request.device_type, request.device_name)
 
 @app.post("/api/devices/control")
 async def control_device(request: ControlDeviceRequest):
     """🔌 Điều khiển thiết bị (ON/OFF)"""
-    return db.control_device(request.device_id, request.command)
+    return await adb.control_device(request.device_id, request.command)
 
 @app.get("/api/devices")
+@response_cache.cached("devices", ("devices",))
 async def get_devices():
     """📋 Danh sách thiết bị"""
-    return serialize_for_json({"devices": db.get_all_devices()})
+    return serialize_for_json({"devices": await adb.get_all_devices()})
 
 # Search
 @app.post("/api/search")
 async def smart_search(request: SearchRequest):
     """🔍 Tìm kiếm thông minh"""
-    return serialize_for_json(db.smart_search(request.query))
+    return serialize_for_json(await adb.smart_search(request.query))
 
 # Dashboard (Enterprise Pro)
 @app.get("/dashboard")
@@ -2227,12 +6486,30 @@ async def dashboard(request: Request):
 
 # Analytics
 @app.get("/api/analytics")
-async def get_analytics(hours: int = 24):
-    """📈 Dữ liệu phân tích"""
-    return serialize_for_json(db.get_analytics_data(hours))
+@response_cache.cached("analytics", ("analytics",))
+async def get_analytics(hours: int = 24, resolution: Optional[int] = None, bucket: Optional[str] = None, agg: str = "avg",
+                        max_points: Optional[int] = None):
+    """
+    📈 Dữ liệu phân tích (resolution: giây / điểm, mặc định tự chọn rollup)
+    bucket=5m|1h|auto&agg=avg|min|max|sum|count → mảng song song timestamps[] / series{}[]
+    max_points → LTTB, giữ đỉnh / đáy nhưng giới hạn số điểm mỗi chuỗi
+    """
+    if max_points is not None and max_points < 3:
+        return JSONResponse(status_code=400, content={"success": False, "error": "max_points must be >= 3"})
+    if not bucket:
+        return serialize_for_json(await adb.get_analytics_data(hours, resolution, max_points=max_points))
+    try:
+        seconds = parse_bucket(bucket, hours)
+        if agg not in ANALYTICS_AGGS:
+            raise ValueError(f"invalid agg: {agg} (one of {', '.join(ANALYTICS_AGGS)})")
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"success": False, "error": str(e)})
+    # Chỉ số nguyên / float / None → trả thẳng, bỏ qua serialize_for_json
+    return JSONResponse(content=await adb.get_analytics_data(hours, resolution, seconds, agg, max_points))
 
 # AI System
 @app.get("/api/ai/status")
+@response_cache.cached("ai_status")
 async def get_ai_status():
     """🤖 Trạng thái AI Agents"""
     return serialize_for_json({"agents": ai_system.get_agent_status()})
@@ -2240,58 +6517,119 @@ async def get_ai_status():
 @app.get("/api/ai/decisions")
 async def get_decisions(limit: int = 20):
     """📜 Quyết định AI"""
-    return serialize_for_json({"decisions": db.get_ai_decisions(limit)})
+    return serialize_for_json({"decisions": await adb.get_ai_decisions(limit)})
 
 # Alerts
 @app.get("/api/alerts")
 async def get_alerts():
     """🚨 Cảnh báo"""
-    return serialize_for_json({"alerts": db.get_active_alerts()})
+    return serialize_for_json({"alerts": await adb.get_active_alerts()})
 
 # WebSocket
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
+async def websocket_endpoint(websocket: WebSocket, mode: str = "full"):
+    """🔌 Live dashboard: mode=full (snapshot mỗi tick) hoặc mode=delta (snapshot + thay đổi theo seq)"""
     await websocket.accept()
     logger.info("🔌 WebSocket connected")
     
     try:
-        while True:
-            rooms = db.get_all_rooms()
-            real_time = db.get_real_time_data()
-            decisions = db.get_ai_decisions(10)
-            alerts = db.get_active_alerts()
-            ai_status = ai_system.get_agent_status()
-            devices = db.get_all_devices()
-            
-            ui_data = {
-                "kpi_energy": real_time['total_power'] * 24 / 1000,
-                "kpi_occupancy": real_time['total_occupancy'],
-                "kpi_temp": real_time['avg_temperature'],
-                "kpi_sensors": real_time['sensor_count'],
-                "data_quality": "EXCELLENT" if real_time['sensor_count'] > 0 else "NO_DATA",
-                "rooms": rooms,
-                "sensors_data": real_time['sensors'],
-                "decisions": decisions,
-                "alerts": alerts,
-                "ai_agents": ai_status,
-                "devices": devices,
-                "timestamp": time.time()
-            }
-            
-            # Use JSONEncoder to handle datetime
-            await websocket.send_json(jsonable_encoder(ui_data))
-            await asyncio.sleep(2)
-    
+        await dashboard_broadcaster.serve(websocket, delta=mode == "delta")
     except WebSocketDisconnect:
         logger.info("🔌 WebSocket disconnected")
     except Exception as e:
         logger.error(f"❌ WebSocket error: {e}")
 
+@app.get("/api/stream")
+async def live_stream(request: Request, building: Optional[str] = None, floor: Optional[str] = None,
+                      room: Optional[str] = None, kinds: str = "kpi,alerts,devices"):
+    """📺 Live KPI / alert / device qua Server-Sent Events (lọc building, floor, room: phân tách bằng dấu phẩy)"""
+    spec = parse_dashboard_subscription({
+        "buildings": building.split(",") if building else [],
+        "floors": floor.split(",") if floor else [],
+        "rooms": room.split(",") if room else [],
+        "kinds": kinds.split(",") if kinds else []
+    })
+    last_event_id = request.headers.get("last-event-id") or request.query_params.get("lastEventId")
+    return StreamingResponse(
+        dashboard_broadcaster.stream(spec, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.websocket("/ws/ingest")
+async def ingest_websocket(websocket: WebSocket):
+    """
+    📡 Streaming ingest cho edge gateway:
+    - Client gửi NDJSON (mỗi dòng 1 reading), 1 frame có thể chứa nhiều dòng
+    - Server ack từng frame kèm số credit còn lại (flow control):
+      credit = INGEST_STREAM_WINDOW - số reading của kết nối chưa được ghi xong
+    - Reading vượt credit hoặc vượt MAX_BATCH_READINGS / frame bị từ chối (dropped)
+    """
+    await websocket.accept()
+    parser = NDJSONReadingParser()
+    stream = {"pending": 0}
+    seq = 0
+    received = 0
+    accepted = 0
+    logger.info("📡 Ingest stream connected")
+    await websocket.send_json({"type": "ready", "window": INGEST_STREAM_WINDOW})
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            chunk = message.get("text")
+            if chunk is None:
+                chunk = (message.get("bytes") or b"").decode("utf-8", errors="replace")
+
+            readings, errors = parser.feed(chunk)
+            seq += 1
+            received += len(readings)
+            allowed = max(0, min(MAX_BATCH_READINGS, INGEST_STREAM_WINDOW - stream["pending"]))
+            if len(readings) > allowed:
+                errors.insert(0, {"error": f"window exceeded: {len(readings) - allowed} readings rejected, wait for credit"})
+            batch = readings[:allowed]
+            if ingest_buffer.running:
+                ok = await ingest_buffer.submit_many(batch, stream)
+            elif batch:
+                result = await adb.log_sensor_readings_batch(batch)
+                ok = result.get("accepted", 0)
+            else:
+                ok = 0
+            accepted += ok
+
+            await websocket.send_json({
+                "type": "ack",
+                "seq": seq,
+                "received": received,
+                "accepted": accepted,
+                "dropped": len(readings) - ok,
+                "errors": errors[:20],
+                "window": max(0, INGEST_STREAM_WINDOW - stream["pending"])
+            })
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logger.error(f"❌ Ingest stream error: {e}")
+
+    readings, _ = parser.close()
+    readings = readings[:max(0, INGEST_STREAM_WINDOW - stream["pending"])]
+    if readings:
+        if ingest_buffer.running:
+            await ingest_buffer.submit_many(readings)
+        else:
+            await adb.log_sensor_readings_batch(readings)
+    logger.info(f"📡 Ingest stream closed ({received} readings, {seq} frames)")
+
 # Startup
 @app.on_event("startup")
 async def startup():
     # Start AI agents only if not on Vercel
     if not IS_VERCEL:
+        await adb.backfill_rollups(time.time())
+        await ingest_buffer.start()
+        asyncio.create_task(sensor_state_flush_loop())
         asyncio.create_task(ai_system.start_all())
     
     logger.info("="*80)
@@ -2299,7 +6637,7 @@ async def startup():
     logger.info("="*80)
     logger.info(f"🗄️  Database: {db.db_type}")
     logger.info(f"🤖 AI Agents: {len(ai_system.agents)}")
-    logger.info(f"🏢 Rooms: {len(db.get_all_rooms())}")
+    logger.info(f"🏢 Rooms: {len(await adb.get_all_rooms())}")
     logger.info(f"💬 Chatbot: Ultra-Intelligent (Memory + Confirmation)")
     logger.info(f"🔌 IoT: Device Control Enabled")
     logger.info("="*80)
@@ -2313,6 +6651,17 @@ async def startup():
     except:
         pass
 
+@app.on_event("shutdown")
+async def shutdown():
+    await dashboard_broadcaster.stop()
+    await ingest_buffer.stop()
+    adb.shutdown()
+    db.flush_compressor()
+    db.flush_sensor_state()
+    if db.replicas:
+        db.replicas.close()
+    db.connection.close()
+
 # ============================================================================
 # 🎬 MAIN
 # ============================================================================
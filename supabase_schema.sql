@@ -0,0 +1,183 @@
+-- EcoSchool AI ULTIMATE - Supabase (PostgreSQL) schema
+-- Chạy 1 lần trong Supabase SQL Editor trước khi đặt SUPABASE_URL / SUPABASE_KEY.
+-- Backend gọi PostgREST bằng service role key (RLS không áp dụng cho key này).
+
+create table if not exists users (
+    username text primary key,
+    password_hash text not null,
+    role text default 'ADMIN',
+    language text default 'vi',
+    created_at timestamptz default now()
+);
+
+create table if not exists rooms (
+    room_id text primary key,
+    name text not null,
+    area double precision,
+    floor integer,
+    building text,
+    created_at timestamptz default now(),
+    is_active boolean default true
+);
+
+create table if not exists sensors (
+    sensor_id text primary key,
+    room_id text references rooms(room_id) on delete cascade,
+    sensor_type text,
+    unit text,
+    last_value double precision default 0,
+    last_update timestamptz default now(),
+    status text default 'WAITING'
+);
+create index if not exists idx_sensors_room on sensors(room_id);
+
+create table if not exists sensor_readings (
+    id bigserial primary key,
+    sensor_id text references sensors(sensor_id) on delete cascade,
+    value double precision,
+    timestamp timestamptz default now(),
+    quality text default 'GOOD',
+    room_id text,
+    sensor_type text
+);
+create index if not exists idx_sensor_readings_time on sensor_readings(timestamp);
+create index if not exists idx_readings_type_time on sensor_readings(sensor_type, timestamp) include (value);
+create index if not exists idx_readings_room_type_time on sensor_readings(room_id, sensor_type, timestamp) include (value);
+
+create table if not exists sensor_rollups (
+    resolution integer,
+    bucket_start bigint,
+    sensor_id text,
+    room_id text,
+    sensor_type text,
+    min_value double precision,
+    max_value double precision,
+    sum_value double precision,
+    count integer,
+    last_value double precision,
+    last_ts double precision,
+    primary key (resolution, sensor_id, bucket_start)
+);
+create index if not exists idx_rollup_type on sensor_rollups(resolution, sensor_type, bucket_start);
+create index if not exists idx_rollup_room on sensor_rollups(resolution, room_id, sensor_type, bucket_start);
+
+create table if not exists iot_devices (
+    device_id text primary key,
+    room_id text references rooms(room_id) on delete cascade,
+    device_type text,
+    device_name text,
+    status text default 'OFF',
+    last_command text,
+    last_update timestamptz default now()
+);
+
+create table if not exists ai_decisions (
+    id text primary key,
+    agent_name text,
+    decision_type text,
+    target text,
+    action text,
+    reasoning text,
+    confidence double precision,
+    timestamp timestamptz default now(),
+    status text,
+    approved_by text
+);
+create index if not exists idx_decisions_time on ai_decisions(timestamp);
+
+create table if not exists alerts (
+    alert_id text primary key,
+    severity text,
+    title text,
+    message text,
+    location text,
+    timestamp timestamptz default now(),
+    acknowledged integer default 0,
+    resolved integer default 0
+);
+
+create table if not exists chat_history (
+    id bigserial primary key,
+    user_msg text,
+    ai_response text,
+    timestamp timestamptz default now(),
+    has_file integer default 0,
+    file_path text,
+    language text default 'vi',
+    context text
+);
+
+create table if not exists ai_knowledge (
+    id bigserial primary key,
+    topic text,
+    content text,
+    source text,
+    timestamp timestamptz default now(),
+    importance integer default 5
+);
+
+create table if not exists buildings (
+    building_id text primary key,
+    name text not null,
+    address text,
+    total_floors integer,
+    manager_name text,
+    is_active boolean default true,
+    created_at timestamptz default now()
+);
+
+create table if not exists floors (
+    floor_id text primary key,
+    building_id text references buildings(building_id) on delete cascade,
+    floor_number integer,
+    name text,
+    safety_status text default 'SAFE',
+    energy_target double precision
+);
+
+create table if not exists enterprise_schedules (
+    schedule_id bigserial primary key,
+    room_id text references rooms(room_id) on delete cascade,
+    event_name text,
+    start_time text,
+    end_time text,
+    min_temp double precision,
+    max_temp double precision,
+    priority integer default 1,
+    is_completed boolean default false
+);
+
+create table if not exists safety_watchdog_logs (
+    id bigserial primary key,
+    location_id text,
+    risk_level text,
+    event_type text,
+    description text,
+    automated_action text,
+    timestamp timestamptz default now()
+);
+
+-- Rollup cộng dồn (min/max/sum/count/last) cho 1 lô bucket - gọi qua POST /rest/v1/rpc/ecoschool_upsert_rollups
+create or replace function ecoschool_upsert_rollups(rows jsonb) returns void
+language sql as $$
+    insert into sensor_rollups (resolution, bucket_start, sensor_id, room_id, sensor_type,
+                                min_value, max_value, sum_value, count, last_value, last_ts)
+    select resolution, bucket_start, sensor_id, room_id, sensor_type,
+           min_value, max_value, sum_value, count, last_value, last_ts
+    from jsonb_to_recordset(rows) as r(resolution integer, bucket_start bigint, sensor_id text, room_id text,
+                                       sensor_type text, min_value double precision, max_value double precision,
+                                       sum_value double precision, count integer, last_value double precision,
+                                       last_ts double precision)
+    on conflict (resolution, sensor_id, bucket_start) do update set
+        min_value = least(sensor_rollups.min_value, excluded.min_value),
+        max_value = greatest(sensor_rollups.max_value, excluded.max_value),
+        sum_value = sensor_rollups.sum_value + excluded.sum_value,
+        count = sensor_rollups.count + excluded.count,
+        last_value = case when excluded.last_ts >= sensor_rollups.last_ts then excluded.last_value else sensor_rollups.last_value end,
+        last_ts = greatest(sensor_rollups.last_ts, excluded.last_ts);
+$$;
+
+-- Tài khoản quản trị mặc định (giống SQLite/MySQL)
+insert into users (username, password_hash, role, language)
+values ('funnylion1412', encode(sha256('tubilu1412'::bytea), 'hex'), 'ADMIN', 'vi')
+on conflict (username) do nothing;
@@ -0,0 +1,12 @@
+"""
+Chạy main.py trong thư mục tạm: import main tạo database SQLite + log ngay tại thư mục hiện hành
+Chạy: python -m pytest -q tests
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("PORT", "1")
+os.chdir(tempfile.mkdtemp(prefix="ecoschool-tests-"))
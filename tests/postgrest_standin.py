@@ -0,0 +1,98 @@
+"""
+PostgREST stand-in tối thiểu (in-memory) cho test PostgRESTClient:
+GET (select / eq / limit / offset), HEAD count, POST bulk (+ on_conflict merge), PATCH / DELETE theo eq
+fail_next: danh sách status trả về cho các request kế tiếp (giả lập 503 / 400 ...)
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+
+class StandIn:
+    def __init__(self, rest_path: str = "/rest/v1"):
+        self.rest_path = rest_path
+        self.tables = {}
+        self.fail_next = []
+        self.requests = []  # (method, table, số dòng body)
+        self.lock = threading.Lock()
+        handler = type("Handler", (_Handler,), {"standin": self})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def rows(self, table: str):
+        return self.tables.setdefault(table, [])
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _match(row, filters):
+    for column, expr in filters:
+        op, _, value = expr.partition(".")
+        if op != "eq" or str(row.get(column)) != value:
+            return False
+    return True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    standin: StandIn = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=None, headers=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def _handle(self):
+        s = self.standin
+        parts = urlsplit(self.path)
+        table = parts.path[len(s.rest_path) + 1:]
+        params = parse_qsl(parts.query, keep_blank_values=True)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        with s.lock:
+            s.requests.append((self.command, table, len(body) if isinstance(body, list) else int(body is not None)))
+            if s.fail_next:
+                return self._send(s.fail_next.pop(0), {"message": "injected failure"})
+            filters = [(k, v) for k, v in params if k not in ("select", "order", "limit", "offset", "on_conflict")]
+            rows = s.rows(table)
+            if self.command in ("GET", "HEAD"):
+                matched = [r for r in rows if _match(r, filters)]
+                p = dict(params)
+                offset = int(p.get("offset", 0))
+                page = matched[offset:offset + int(p["limit"])] if "limit" in p else matched
+                return self._send(200, page, {"Content-Range": f"*/{len(matched)}"})
+            if self.command == "POST":
+                key = dict(params).get("on_conflict")
+                for new in body if isinstance(body, list) else [body]:
+                    old = next((r for r in rows if key and r.get(key) == new.get(key)), None)
+                    if old is not None:
+                        old.update(new)
+                    else:
+                        rows.append(dict(new))
+                return self._send(201)
+            matched = [r for r in rows if _match(r, filters)]
+            if self.command == "PATCH":
+                for row in matched:
+                    row.update(body)
+            elif self.command == "DELETE":
+                s.tables[table] = [r for r in rows if r not in matched]
+            return self._send(204, None, {"Content-Range": f"*/{len(matched)}"})
+
+    do_GET = do_HEAD = do_POST = do_PATCH = do_DELETE = _handle
@@ -0,0 +1,121 @@
+"""MySQLReplicaRouter: đo lag đồng thời (pool giả) + primary/replica thật khi có MYSQL_REPLICAS"""
+import os
+import threading
+import time
+
+import pytest
+
+import main
+
+
+class FakeCursor:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql):
+        self.pool.probes += 1
+
+    def fetchone(self):
+        time.sleep(0.05)  # giữ lag_lock đủ lâu để các luồng khác chen vào
+        return {"Seconds_Behind_Source": self.pool.lag}
+
+
+class FakePool:
+    def __init__(self, lag=0):
+        self.lag = lag
+        self.probes = 0
+
+    def acquire(self):
+        return self
+
+    def release(self, conn, broken=False):
+        pass
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def get_stats(self):
+        return {}
+
+
+def route_concurrently(router, threads=8):
+    start = threading.Barrier(threads)
+    results = []
+
+    def worker():
+        start.wait()
+        results.append(router.route({"sensor_readings"}))
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return results
+
+
+def test_lag_probed_once_under_concurrent_routes():
+    router = main.MySQLReplicaRouter([], {})
+    pool = FakePool(lag=0)
+    router.add_replica("fake:3307", pool)
+
+    results = route_concurrently(router)
+    assert pool.probes == 1
+    assert results == [pool] * 8
+    stats = router.get_stats()
+    assert (stats["replica_reads"], stats["replicas"][0]["reads"]) == (8, 8)
+
+
+def test_lagging_replica_not_used_before_first_probe_finishes():
+    router = main.MySQLReplicaRouter([], {})
+    pool = FakePool(lag=main.REPLICA_MAX_LAG + 60)
+    router.add_replica("fake:3307", pool)
+
+    # Luồng không đo được lag vẫn phải chờ lần đo đầu, không dùng lag mặc định 0
+    assert route_concurrently(router) == [None] * 8
+    assert pool.probes == 1
+    assert router.get_stats()["lag_fallbacks"] == 8
+
+
+def test_read_your_writes_falls_back_to_primary():
+    router = main.MySQLReplicaRouter([], {})
+    pool = FakePool(lag=0)
+    router.add_replica("fake:3307", pool)
+
+    router.mark_write({"alerts", "sensor_readings"})
+    assert router.route({"alerts"}) is None
+    assert router.route({"sensor_readings"}) is pool  # REPLICA_STALE_OK_TABLES
+    assert router.get_stats()["ryw_fallbacks"] == 1
+
+
+@pytest.mark.skipif(not os.getenv("MYSQL_REPLICAS"), reason="MYSQL_REPLICAS not set (needs a local primary + replica)")
+def test_routes_reads_to_local_replica(monkeypatch):
+    # 2 instance MySQL local: MYSQL_HOST/MYSQL_PORT = primary, MYSQL_REPLICAS = replica (host:port)
+    # Hai instance độc lập (không cấu hình replication) → REPLICA_ASSUME_SYNC=1
+    if os.getenv("REPLICA_ASSUME_SYNC") is None:
+        monkeypatch.setattr(main, "REPLICA_ASSUME_SYNC", True)
+    router = main.MySQLReplicaRouter(main.MYSQL_REPLICAS[:1], main.MYSQL_CONFIG)
+    try:
+        assert router.replicas, "replica unreachable"
+        replica_port = int(main.MYSQL_REPLICAS[0].partition(":")[2] or 3306)
+
+        pool = router.route({"alerts"})
+        assert pool is not None
+        conn = pool.acquire()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT @@port AS port")
+                assert int(cursor.fetchone()["port"]) == replica_port
+        finally:
+            pool.release(conn)
+
+        router.mark_write({"alerts"})
+        assert router.route({"alerts"}) is None
+    finally:
+        router.close()
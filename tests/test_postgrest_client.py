@@ -0,0 +1,84 @@
+"""PostgRESTClient + handler Supabase chạy trên PostgREST stand-in (không cần Supabase thật)"""
+import pytest
+
+import main
+from postgrest_standin import StandIn
+
+
+@pytest.fixture
+def standin():
+    server = StandIn()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def client(standin, monkeypatch):
+    monkeypatch.setattr(main, "SUPABASE_BACKOFF", 0.001)
+    monkeypatch.setattr(main, "SUPABASE_DEFER_MAX_AGE", 60.0)  # chỉ flush khi test gọi
+    client = main.PostgRESTClient(standin.url, "test-key")
+    yield client
+    client.close()
+
+
+def test_bulk_insert_and_paged_select(standin, client, monkeypatch):
+    monkeypatch.setattr(main, "SUPABASE_BATCH_SIZE", 100)
+    monkeypatch.setattr(main, "SUPABASE_PAGE_SIZE", 40)
+    rows = [{"id": i, "value": i * 0.5} for i in range(250)]
+
+    assert client.insert("sensor_readings", rows) == 250
+    posts = [n for method, table, n in standin.requests if method == "POST"]
+    assert posts == [100, 100, 50]
+
+    assert client.select("sensor_readings") == rows
+    assert client.count("sensor_readings") == 250
+
+
+def test_retry_with_backoff_on_transient_errors(standin, client):
+    standin.fail_next = [503, 503]
+    client.insert("alerts", [{"alert_id": "a1"}])
+    assert standin.rows("alerts") == [{"alert_id": "a1"}]
+    assert client.get_stats()["retries"] == 2
+
+
+def test_plain_post_not_retried_after_server_error(standin, client):
+    # 500 có thể đã ghi một phần → POST không idempotent không được gửi lại
+    standin.fail_next = [500]
+    with pytest.raises(main.SupabaseError):
+        client.insert("alerts", [{"alert_id": "a1"}])
+    assert standin.rows("alerts") == []
+    assert client.get_stats()["retries"] == 0
+
+
+def test_deferred_batch_requeued_then_delivered_once(standin, client, monkeypatch):
+    monkeypatch.setattr(main, "SUPABASE_RETRIES", 1)
+    client.defer("ai_decisions", [{"id": "d1"}, {"id": "d2"}])
+    standin.fail_next = [503, 503]
+
+    assert client.flush_deferred() == 0
+    stats = client.get_stats()
+    assert (stats["deferred_requeued"], stats["deferred_dropped"], stats["deferred_rows"]) == (2, 0, 2)
+
+    client.defer("ai_decisions", [{"id": "d3"}])
+    assert client.flush_deferred() == 3
+    assert [r["id"] for r in standin.rows("ai_decisions")] == ["d1", "d2", "d3"]
+    assert client.get_stats()["deferred_rows"] == 0
+
+
+def test_deferred_batch_dropped_on_permanent_error(standin, client):
+    client.defer("ai_decisions", [{"id": "d1"}])
+    standin.fail_next = [400]
+
+    client.flush_deferred()
+    stats = client.get_stats()
+    assert (stats["deferred_dropped"], stats["deferred_rows"]) == (1, 0)
+    assert "400" in stats["last_deferred_error"]
+
+
+def test_rest_update_patches_by_key_without_ghost_rows(standin, client):
+    standin.rows("sensors").append({"sensor_id": "S1", "last_value": None, "status": "OFFLINE"})
+    update = main.SUPABASE_STATEMENTS["sensors.update_last"]
+
+    update.many(client, [(5.0, "2026-01-01T00:00:00+00:00", "S1"), (7.0, "2026-01-01T00:00:00+00:00", "S2")])
+    assert standin.rows("sensors") == [
+        {"sensor_id": "S1", "last_value": 5.0, "last_update": "2026-01-01T00:00:00+00:00", "status": "ONLINE"}]